@@ -0,0 +1,305 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import logging
+import threading
+import time
+
+import websockets.asyncio.client as websocketclient
+from websockets.asyncio.messages import SimpleQueue
+
+from . import proxy
+from .compression import COMPRESSION_ADAPTIVE, CompressionPolicy
+from .credentials import default_credential_manager
+
+logger = logging.getLogger(__name__)
+
+
+class _QueuedBytes(SimpleQueue):
+    """Receive queue of a websocket that reports its size in bytes.
+
+    The asyncio counterpart of `proxy._QueuedBytes`, so that the `max_queue`
+    limits of a websocket bound the bytes received but not yet read rather
+    than the number of frames.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._bytes = 0
+
+    def __len__(self):
+        return self._bytes
+
+    def put(self, frame):
+        self._bytes += len(frame.data)
+        super().put(frame)
+
+    async def get(self, block=True):
+        frame = await super().get(block)
+        self._bytes -= len(frame.data)
+        return frame
+
+    def reset(self, frames):
+        frames = list(frames)
+        super().reset(frames)
+        self._bytes += sum(len(frame.data) for frame in frames)
+
+
+class _ByteBoundedConnection(websocketclient.ClientConnection):
+    """Websocket client connection whose receive queue is bounded in bytes."""
+
+    @property
+    def recv_messages(self):
+        return self._recv_messages
+
+    @recv_messages.setter
+    def recv_messages(self, assembler):
+        # Set once the connection is made, before any frame is received.
+        assembler.frames = _QueuedBytes()
+        self._recv_messages = assembler
+
+
+class AsyncioSessionProxy(object):
+    """A TCP proxy for Dataproc Serverless Sessions built on asyncio.
+
+    This serves the same purpose as `proxy.DataprocSessionProxy`, but every
+    connection is handled by a single event loop running in one thread,
+    rather than by several threads per connection. This keeps the number of
+    threads contending for the GIL constant no matter how many connections
+    gRPC opens through the proxy.
+
+    Args:
+        port: The local port to listen on. Use `0` to pick a free port.
+        target_host: The backend to proxy connections to.
+        binary_frames: Whether to negotiate binary websocket frames with the
+          backend instead of hex-encoded text frames.
+        use_ssl: Whether to connect to the backend using SSL.
+        unix_socket_path: If set, listen on a Unix domain socket at this path,
+          accessible only to the current user, instead of the local port.
+        read_size: The maximum number of bytes read from a local connection
+          and sent to the backend in one websocket message.
+        credential_manager: The `CredentialManager` used to authenticate with
+          the backend. Defaults to the process-wide manager.
+        compression: Whether websockets use permessage-deflate compression:
+          `"off"`, `"always"`, or `"adaptive"`.
+        ping_interval: How often, in seconds, websockets are pinged to detect
+          dead connections. `None` disables pings.
+        ping_timeout: How long, in seconds, to wait for a pong before closing
+          a websocket as dead.
+        forward_watermarks: The `(high, low)` watermarks, in bytes, of the
+          bytes waiting to be written to the websocket. Reading from the
+          local connection pauses above `high` until no more than `low` are
+          waiting.
+        backward_watermarks: The `(high, low)` watermarks, in bytes, of the
+          replies waiting to be written to the local connection, applied to
+          both the websocket's receive queue and the connection's write
+          buffer. Reading pauses above `high` until no more than `low` are
+          waiting.
+    """
+
+    def __init__(
+        self,
+        port,
+        target_host,
+        binary_frames=True,
+        use_ssl=True,
+        unix_socket_path=None,
+        read_size=proxy.default_buffer_pool.max_size,
+        credential_manager=None,
+        compression=COMPRESSION_ADAPTIVE,
+        ping_interval=proxy.DEFAULT_PING_INTERVAL,
+        ping_timeout=proxy.DEFAULT_PING_TIMEOUT,
+        forward_watermarks=proxy.DEFAULT_WATERMARKS,
+        backward_watermarks=proxy.DEFAULT_WATERMARKS,
+    ):
+        self._port = port
+        self._target_host = target_host
+        self._binary_frames = binary_frames
+        self._use_ssl = use_ssl
+        self._unix_socket_path = unix_socket_path
+        self._read_size = read_size
+        self._credential_manager = credential_manager
+        self._compression_policy = CompressionPolicy(compression)
+        self._ping_interval = ping_interval
+        self._ping_timeout = ping_timeout
+        self._forward_watermarks = proxy.check_watermarks(forward_watermarks)
+        self._backward_watermarks = proxy.check_watermarks(backward_watermarks)
+        self._started = False
+        self._loop = None
+        self._thread = None
+        self._stopped = None
+        self._drain_timeout = 0.0
+        self._handlers = set()
+        self._conn_number = 0
+
+    @property
+    def port(self):
+        """The local port the proxy is listening on"""
+        return self._port
+
+    @property
+    def unix_socket_path(self):
+        """The Unix domain socket the proxy is listening on, if enabled"""
+        return self._unix_socket_path
+
+    def start(self, daemon=True):
+        """Start the proxy.
+
+        By the time this method returns the proxy has already started listening
+        on its local port will accept incoming connections.
+        """
+        if self._started:
+            raise Exception("Dataproc session proxy already started")
+        self._started = True
+        s = threading.Semaphore(value=0)
+        self._thread = threading.Thread(
+            target=self._run,
+            args=[s],
+            name="asyncio-session-proxy",
+            daemon=daemon,
+        )
+        self._thread.start()
+        s.acquire()
+
+    def _run(self, s):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve(s))
+        finally:
+            self._loop.close()
+
+    async def _serve(self, s):
+        self._stopped = asyncio.Event()
+        if self._unix_socket_path is not None:
+            server = await asyncio.start_unix_server(
+                self._handle,
+                sock=proxy.create_unix_server(self._unix_socket_path),
+            )
+        else:
+            server = await asyncio.start_server(
+                self._handle, "127.0.0.1", self._port
+            )
+            if self._port == 0:
+                self._port = server.sockets[0].getsockname()[1]
+        s.release()
+        await self._stopped.wait()
+        server.close()
+        if self._unix_socket_path is not None:
+            proxy.remove_unix_socket(self._unix_socket_path)
+        handlers = list(self._handlers)
+        if handlers and self._drain_timeout > 0:
+            await asyncio.wait(handlers, timeout=self._drain_timeout)
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        handler.add_done_callback(self._handlers.discard)
+        self._conn_number += 1
+        name = f"{self._conn_number}"
+        logger.debug(
+            f"Accepted a connection from {writer.get_extra_info('peername')}..."
+        )
+        subprotocols = (
+            [proxy.BINARY_FRAMES_SUBPROTOCOL] if self._binary_frames else None
+        )
+        try:
+            credential_manager = (
+                self._credential_manager or default_credential_manager()
+            )
+            token = credential_manager.cached_token()
+            if token is None:
+                # Refreshing credentials blocks, so it is done off the loop.
+                token = await asyncio.to_thread(credential_manager.token)
+            async with websocketclient.connect(
+                proxy.bridge_url(self._target_host, self._use_ssl),
+                additional_headers=proxy.bridge_auth_headers(token),
+                subprotocols=subprotocols,
+                ping_interval=self._ping_interval,
+                ping_timeout=self._ping_timeout,
+                write_limit=self._forward_watermarks,
+                max_queue=self._backward_watermarks,
+                create_connection=_ByteBoundedConnection,
+                **self._compression_policy.connect_options(),
+            ) as websocket_conn:
+                binary_frames = (
+                    websocket_conn.subprotocol
+                    == proxy.BINARY_FRAMES_SUBPROTOCOL
+                )
+                await asyncio.gather(
+                    self._forward(name, reader, websocket_conn, binary_frames),
+                    self._backward(name, websocket_conn, writer),
+                )
+        except asyncio.CancelledError:
+            # Connections are only cancelled when the proxy is stopped, so
+            # this is not propagated to the stream's connection callback.
+            logger.debug(f"[{name}] Connection cancelled by proxy stop")
+        except Exception as ex:
+            logger.debug(f"[{name}] Exception proxying connection: {ex}")
+        finally:
+            writer.close()
+
+    async def _forward(self, name, reader, websocket_conn, binary_frames):
+        """Stream bytes from the local connection to the websocket.
+
+        A websocket cannot be half-closed, so the end of the local stream
+        closes it, which ends `_backward` too.
+        """
+        try:
+            while True:
+                bs = await reader.read(self._read_size)
+                if not bs:
+                    return
+                await websocket_conn.send(bs if binary_frames else bs.hex())
+        except Exception as ex:
+            logger.debug(f"[{name}-forward] Exception forwarding bytes: {ex}")
+        finally:
+            await websocket_conn.close()
+
+    async def _backward(self, name, websocket_conn, writer):
+        """Stream bytes from the websocket to the local connection."""
+        high, low = self._backward_watermarks
+        writer.transport.set_write_buffer_limits(high=high, low=low)
+        try:
+            async for msg in websocket_conn:
+                writer.write(
+                    bytes.fromhex(msg) if isinstance(msg, str) else msg
+                )
+                await writer.drain()
+        except Exception as ex:
+            logger.debug(f"[{name}-backward] Exception forwarding bytes: {ex}")
+        finally:
+            writer.close()
+
+    def stop(self, drain_timeout=0.0):
+        """Stop the proxy.
+
+        This has the same semantics as `proxy.DataprocSessionProxy.stop`.
+
+        Args:
+            drain_timeout: How long, in seconds, to wait for open connections
+              to finish before cancelling them.
+
+        Returns:
+            How long the shutdown took, in seconds.
+        """
+        start = time.monotonic()
+        if self._loop is not None and self._stopped is not None:
+            self._drain_timeout = drain_timeout
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+        return time.monotonic() - start
@@ -0,0 +1,195 @@
+#!/bin/env python
+
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local stand-in for the websocket-over-TCP bridge backend.
+
+This lets the session proxy be exercised and benchmarked end to end without
+a Dataproc session: the stand-in accepts websocket connections the same way
+the real backend does, and forwards the carried bytes to a local TCP server.
+"""
+
+import argparse
+import contextlib
+import http
+import logging
+import socket
+import threading
+
+import websockets.sync.server as websocketserver
+
+from . import proxy
+from .mux import MUX_SUBPROTOCOL, MultiplexedBridge
+
+parser = argparse.ArgumentParser()
+parser.add_argument("port")
+parser.add_argument("target", help="The TCP server to forward to, as host:port")
+parser.add_argument(
+    "--hex-frames",
+    action="store_true",
+    help="Refuse binary frames so that clients fall back to hex text frames",
+)
+parser.add_argument(
+    "--no-multiplexing",
+    action="store_true",
+    help="Refuse to multiplex several streams over one websocket",
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalTcpBridge(object):
+    """A local websocket server speaking the TCP-bridge protocol.
+
+    Each websocket connection made to the bridge path is forwarded to a new
+    TCP connection to `target_address`.
+
+    Args:
+        target_address: The `(host, port)` of the TCP server to forward to.
+        port: The local port to listen on. Use `0` to pick a free port.
+        binary_frames: Whether to accept binary framing when it is offered.
+          If `False`, the bridge behaves like a backend that only supports
+          hex-encoded text frames.
+        multiplexing: Whether to accept multiplexing when it is offered. Each
+          stream of a multiplexed websocket gets its own TCP connection.
+    """
+
+    def __init__(
+        self, target_address, port=0, binary_frames=True, multiplexing=True
+    ):
+        self._target_address = target_address
+        self._port = port
+        self._binary_frames = binary_frames
+        self._multiplexing = multiplexing
+        self._server = None
+        self._conn_number = 0
+        self._stream_number = 0
+
+    @property
+    def connection_count(self):
+        """The number of websocket connections the bridge has accepted"""
+        return self._conn_number
+
+    @property
+    def stream_count(self):
+        """The number of TCP connections the bridge has forwarded to"""
+        return self._stream_number
+
+    @property
+    def port(self):
+        """The local port the bridge is listening on"""
+        return self._port
+
+    @property
+    def host(self):
+        """The `host:port` to use as the proxy target for this bridge"""
+        return f"localhost:{self._port}"
+
+    def start(self):
+        """Start the bridge.
+
+        By the time this method returns the bridge is accepting connections.
+        """
+        if self._server is not None:
+            raise Exception("Local TCP bridge already started")
+        self._server = websocketserver.serve(
+            self._handle,
+            "127.0.0.1",
+            self._port,
+            subprotocols=[MUX_SUBPROTOCOL, proxy.BINARY_FRAMES_SUBPROTOCOL],
+            select_subprotocol=self._select_subprotocol,
+            process_request=self._process_request,
+        )
+        self._port = self._server.socket.getsockname()[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stop the bridge."""
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _select_subprotocol(self, websocket_conn, subprotocols):
+        if self._multiplexing and MUX_SUBPROTOCOL in subprotocols:
+            return MUX_SUBPROTOCOL
+        if (
+            self._binary_frames
+            and proxy.BINARY_FRAMES_SUBPROTOCOL in subprotocols
+        ):
+            return proxy.BINARY_FRAMES_SUBPROTOCOL
+        return None
+
+    def _process_request(self, websocket_conn, request):
+        if request.path != f"/{proxy.BRIDGE_PATH}":
+            return websocket_conn.respond(http.HTTPStatus.NOT_FOUND, "")
+        return None
+
+    def _handle(self, websocket_conn):
+        self._conn_number += 1
+        if websocket_conn.subprotocol == MUX_SUBPROTOCOL:
+            bridge = MultiplexedBridge(
+                websocket_conn, on_open=self._forward_stream
+            )
+            # The server closes the connection once this handler returns.
+            bridge.wait_closed()
+            return
+        self._forward_stream(proxy.bridged_socket(websocket_conn))
+
+    def _forward_stream(self, backend_socket):
+        self._stream_number += 1
+        conn_number = f"bridge-{self._stream_number}"
+        with backend_socket:
+            with socket.create_connection(self._target_address) as conn:
+                proxy.tune_socket(conn)
+                proxy.connect_sockets(conn_number, backend_socket, conn)
+
+
+@contextlib.contextmanager
+def local_tcp_bridge(target_address, **kwargs):
+    """Context manager for running a local stand-in TCP bridge.
+
+    Usage:
+        with local_tcp_bridge(("127.0.0.1", server_port)) as bridge:
+           with dataproc_session_proxy(0, bridge.host, use_ssl=False) as p:
+               ...
+
+    Args:
+        target_address: The `(host, port)` of the TCP server to forward to.
+        **kwargs: Additional options passed to `LocalTcpBridge`.
+
+    Returns:
+        A context manager wrapping a LocalTcpBridge instance.
+    """
+    bridge = LocalTcpBridge(target_address, **kwargs)
+    try:
+        bridge.start()
+        yield bridge
+    finally:
+        bridge.stop()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    host, _, target_port = args.target.rpartition(":")
+    with local_tcp_bridge(
+        (host, int(target_port)),
+        port=int(args.port),
+        binary_frames=not args.hex_frames,
+        multiplexing=not args.no_multiplexing,
+    ) as b:
+        print(f"Bridge listening on port {b.port}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
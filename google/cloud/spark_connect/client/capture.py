@@ -0,0 +1,136 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Capture of the bytes forwarded by the session proxy.
+
+A capture file starts with `MAGIC`, followed by one record per chunk of
+bytes the proxy forwarded. Each record is a `RECORD_HEADER`, holding the
+connection number, the direction, the time since the capture started in
+seconds, and the length of the data, followed by the data itself. A record
+with no data marks the end of one direction of a connection.
+
+The `forward` direction carries the local client's requests, and the
+`backward` direction the backend's replies, so a capture can be replayed
+by `replay` without a session.
+"""
+
+import collections
+import os
+import struct
+import threading
+import time
+
+from .metrics import BACKWARD, FORWARD
+
+MAGIC = b"DPCAP\x01"
+
+RECORD_HEADER = struct.Struct("!IBdI")
+
+_DIRECTIONS = (FORWARD, BACKWARD)
+
+# Capture files hold the unencrypted session traffic, so only their owner
+# may read them.
+_CAPTURE_FILE_MODE = 0o600
+
+CaptureRecord = collections.namedtuple(
+    "CaptureRecord", ["connection", "direction", "timestamp", "data"]
+)
+
+
+class CaptureWriter(object):
+    """Writes the bytes forwarded by a proxy to a capture file.
+
+    Records from every connection and direction are appended to the file
+    as they are forwarded, from whichever thread forwarded them.
+
+    The file is created readable and writable only by its owner.
+
+    Args:
+        path: The path of the capture file. An existing file is replaced.
+    """
+
+    def __init__(self, path):
+        # An existing file keeps its mode when truncated, so it is removed
+        # and created afresh instead.
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        fd = os.open(
+            path,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+            _CAPTURE_FILE_MODE,
+        )
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._closed = False
+
+    def write(self, conn_number, direction, data):
+        """Record `data` forwarded in `direction` of a connection.
+
+        Empty `data` records the end of that direction.
+        """
+        header = RECORD_HEADER.pack(
+            conn_number,
+            _DIRECTIONS.index(direction),
+            time.perf_counter() - self._start,
+            len(data),
+        )
+        with self._lock:
+            if self._closed:
+                return
+            self._file.write(header)
+            self._file.write(data)
+
+    def recorder(self, conn_number, direction):
+        """Return a function recording the data of one connection direction."""
+        return lambda data: self.write(conn_number, direction, data)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_capture(path):
+    """Read the records of a capture file, in the order they were written.
+
+    Yields:
+        A `CaptureRecord` for each record.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session proxy capture")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                raise ValueError(f"{path} ends with a truncated record")
+            conn_number, direction, timestamp, length = RECORD_HEADER.unpack(
+                header
+            )
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError(f"{path} ends with a truncated record")
+            yield CaptureRecord(
+                conn_number, _DIRECTIONS[direction], timestamp, data
+            )
@@ -0,0 +1,238 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Control over permessage-deflate compression of bridge websockets.
+
+Query results are often already compressed, for example Arrow batches of
+Parquet-encoded data, and deflating them again costs CPU on both ends for
+little or no saving. A `CompressionPolicy` decides whether new websockets
+offer permessage-deflate at all, and in adaptive mode it samples how well
+each connection's messages compress and stops compressing when that does
+not pay off.
+
+The backend compresses the replies, and a websocket cannot renegotiate its
+extensions, so the ratio of the replies on one connection decides whether
+the following connections offer compression. The bytes sent to the backend
+are compressed locally, so those stop being compressed on the same
+connection as soon as its sample shows no gain; RFC 7692 allows sending
+uncompressed messages on a connection that negotiated compression.
+"""
+
+import threading
+import time
+
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    PerMessageDeflate,
+)
+from websockets.frames import DATA_OPCODES
+
+COMPRESSION_OFF = "off"
+COMPRESSION_ALWAYS = "always"
+COMPRESSION_ADAPTIVE = "adaptive"
+
+COMPRESSION_MODES = (COMPRESSION_OFF, COMPRESSION_ALWAYS, COMPRESSION_ADAPTIVE)
+
+# How many uncompressed bytes of each connection are sampled before
+# deciding whether compressing them pays off.
+DEFAULT_SAMPLE_BYTES = 256 * 1024
+
+# The smallest fraction of the bytes compression must save to be kept.
+DEFAULT_MIN_SAVINGS = 0.1
+
+# While compression is not offered, offer it again on every this many new
+# connections, in case the traffic has changed.
+DEFAULT_REPROBE_INTERVAL = 32
+
+
+class _Sample(object):
+    """The sizes of the first messages compressed in one direction."""
+
+    def __init__(self):
+        self.uncompressed = 0
+        self.compressed = 0
+        self.done = False
+
+    def add(self, uncompressed, compressed, sample_bytes):
+        """Add a message, returning whether the sample just completed."""
+        if self.done:
+            return False
+        self.uncompressed += uncompressed
+        self.compressed += compressed
+        self.done = self.uncompressed >= sample_bytes
+        return self.done
+
+
+class MeasuredPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that measures, and can stop, its compression.
+
+    If `metrics` is set to a `metrics.ConnectionMetrics`, the sizes of the
+    messages before and after compression, and the time spent compressing
+    and decompressing them, are recorded in it.
+    """
+
+    def __init__(self, *args, policy, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._policy = policy
+        self.metrics = None
+        self.compress_outgoing = True
+        self._outgoing_sample = _Sample()
+        self._incoming_sample = _Sample()
+
+    def decode(self, frame, *, max_size=None):
+        if frame.opcode not in DATA_OPCODES or not (
+            frame.rsv1 or self.decode_cont_data
+        ):
+            return super().decode(frame, max_size=max_size)
+        start = time.perf_counter()
+        decoded = super().decode(frame, max_size=max_size)
+        elapsed = time.perf_counter() - start
+        if self.metrics is not None:
+            backward = self.metrics.backward
+            backward.uncompressed_bytes += len(decoded.data)
+            backward.compressed_bytes += len(frame.data)
+            backward.compression_seconds += elapsed
+        if self._incoming_sample.add(
+            len(decoded.data), len(frame.data), self._policy.sample_bytes
+        ):
+            self._policy.record_sample(
+                self._incoming_sample.uncompressed,
+                self._incoming_sample.compressed,
+            )
+        return decoded
+
+    def encode(self, frame):
+        if frame.opcode not in DATA_OPCODES:
+            return super().encode(frame)
+        if not self.compress_outgoing:
+            return frame
+        start = time.perf_counter()
+        encoded = super().encode(frame)
+        elapsed = time.perf_counter() - start
+        if self.metrics is not None:
+            forward = self.metrics.forward
+            forward.uncompressed_bytes += len(frame.data)
+            forward.compressed_bytes += len(encoded.data)
+            forward.compression_seconds += elapsed
+        if (
+            self._outgoing_sample.add(
+                len(frame.data), len(encoded.data), self._policy.sample_bytes
+            )
+            and self._policy.adaptive
+        ):
+            self.compress_outgoing = self._policy.pays_off(
+                self._outgoing_sample.uncompressed,
+                self._outgoing_sample.compressed,
+            )
+        return encoded
+
+
+class _MeasuredDeflateFactory(ClientPerMessageDeflateFactory):
+    """Negotiates permessage-deflate as a `MeasuredPerMessageDeflate`."""
+
+    def __init__(self, policy):
+        # The same settings the websockets library offers by default.
+        super().__init__(compress_settings={"memLevel": 5})
+        self._policy = policy
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return MeasuredPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            policy=self._policy,
+        )
+
+
+class CompressionPolicy(object):
+    """Decides whether new bridge websockets use permessage-deflate.
+
+    Args:
+        mode: One of `COMPRESSION_OFF`, `COMPRESSION_ALWAYS`, or
+          `COMPRESSION_ADAPTIVE`.
+        sample_bytes: How many uncompressed bytes of each connection to
+          sample before deciding whether compression pays off.
+        min_savings: The smallest fraction of the sampled bytes compression
+          must save to stay enabled.
+        reprobe_interval: While compression is disabled, offer it again on
+          every this many new connections.
+    """
+
+    def __init__(
+        self,
+        mode=COMPRESSION_ADAPTIVE,
+        sample_bytes=DEFAULT_SAMPLE_BYTES,
+        min_savings=DEFAULT_MIN_SAVINGS,
+        reprobe_interval=DEFAULT_REPROBE_INTERVAL,
+    ):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError(
+                f"Unsupported compression mode {mode!r}. "
+                f"Supported modes: {list(COMPRESSION_MODES)}"
+            )
+        self._mode = mode
+        self._sample_bytes = sample_bytes
+        self._min_savings = min_savings
+        self._reprobe_interval = reprobe_interval
+        self._lock = threading.Lock()
+        self._offering = True
+        self._skipped = 0
+
+    @property
+    def mode(self):
+        """The compression mode"""
+        return self._mode
+
+    @property
+    def adaptive(self):
+        """Whether compression is turned off when it does not pay off"""
+        return self._mode == COMPRESSION_ADAPTIVE
+
+    @property
+    def offering(self):
+        """Whether new connections currently offer compression"""
+        return self._mode != COMPRESSION_OFF and self._offering
+
+    @property
+    def sample_bytes(self):
+        """How many bytes of each connection are sampled"""
+        return self._sample_bytes
+
+    def pays_off(self, uncompressed, compressed):
+        """Whether compressing `uncompressed` bytes to `compressed` is worth it."""
+        return uncompressed - compressed >= self._min_savings * uncompressed
+
+    def record_sample(self, uncompressed, compressed):
+        """Record how well the replies on one connection compressed."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._offering = self.pays_off(uncompressed, compressed)
+            self._skipped = 0
+
+    def connect_options(self):
+        """The websockets `connect` options for a new connection.
+
+        Returns:
+            A dict with the `compression` and `extensions` options.
+        """
+        with self._lock:
+            offer = self.offering
+            if self._mode == COMPRESSION_ADAPTIVE and not offer:
+                self._skipped += 1
+                offer = self._skipped % self._reprobe_interval == 0
+        extensions = [_MeasuredDeflateFactory(self)] if offer else None
+        return {"compression": None, "extensions": extensions}
@@ -11,11 +11,169 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
 import google
+import google.auth.transport.grpc
+import google.auth.transport.requests
 import grpc
+import pyspark.sql.connect.proto as pb2
 from pyspark.sql.connect.client import ChannelBuilder
 
-from . import proxy
+from . import asyncio_proxy, proxy
+from .credentials import default_credential_manager
+from .metrics import SETUP_LATENCY_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+PROXY_ENGINE_THREADS = "threads"
+PROXY_ENGINE_ASYNCIO = "asyncio"
+
+# The channel options `ChannelBuilder` sets on every channel it creates.
+_GRPC_DEFAULT_OPTIONS = [
+    ("grpc.max_send_message_length", ChannelBuilder.MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", ChannelBuilder.MAX_MESSAGE_LENGTH),
+]
+
+# The gRPC message compression algorithms, by name.
+GRPC_COMPRESSION_ALGORITHMS = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
+
+# Connection string parameters setting gRPC channel options, and the channel
+# options each one sets. The channel options reach the session end to end,
+# through the proxy too, which forwards the HTTP/2 connection unchanged.
+CHANNEL_OPTION_PARAMS = {
+    # The largest message, in bytes, sent or received.
+    "grpc_max_message_size": (
+        "grpc.max_send_message_length",
+        "grpc.max_receive_message_length",
+    ),
+    # How often, in milliseconds, to ping an idle connection.
+    "grpc_keepalive_time_ms": ("grpc.keepalive_time_ms",),
+    # How long, in milliseconds, to wait for a ping to be acknowledged.
+    "grpc_keepalive_timeout_ms": ("grpc.keepalive_timeout_ms",),
+    # The initial HTTP/2 flow control window of each stream, in bytes.
+    "grpc_window_size": ("grpc.http2.lookahead_bytes",),
+    # The algorithm compressing the messages sent, from
+    # `GRPC_COMPRESSION_ALGORITHMS`.
+    "grpc_compression": ("grpc.default_compression_algorithm",),
+}
+
+# Send each RPC of a channel pool over the next channel in turn.
+POOL_ROUND_ROBIN = "round_robin"
+# Send each RPC of a channel pool over the channel with the fewest RPCs in
+# flight.
+POOL_LEAST_LOADED = "least_loaded"
+
+POOL_POLICIES = (POOL_ROUND_ROBIN, POOL_LEAST_LOADED)
+
+# Reach the session through a local proxy, over the websocket bridge.
+TRANSPORT_PROXY = "proxy"
+# Reach the session with an authenticated gRPC channel, falling back to the
+# proxy if it cannot connect.
+TRANSPORT_DIRECT = "direct"
+
+TRANSPORTS = (TRANSPORT_PROXY, TRANSPORT_DIRECT)
+
+# How long, in seconds, the first direct channel to a host may take to
+# answer its probe before falling back to the proxy.
+DEFAULT_PROBE_TIMEOUT = 10.0
+
+# How long, in seconds, channels to a host whose direct channel probe failed
+# use the proxy before the direct channel is probed again, so that one
+# network blip does not rule it out for good.
+DIRECT_PROBE_RETRY_INTERVAL = 300.0
+
+# The method the direct channel probe calls. Asking for the Spark version is
+# cheap, and only a Spark Connect server answers it.
+_PROBE_METHOD = "/spark.connect.SparkConnectService/AnalyzePlan"
+
+# Whether a direct channel served Spark Connect, and when it was probed, by
+# destination. Successful probes are not repeated.
+_direct_probe_results: Dict[str, Tuple[bool, float]] = {}
+# One lock per destination, so that each is probed once at a time without
+# holding up probes to other hosts.
+_direct_probe_locks: Dict[str, threading.Lock] = collections.defaultdict(
+    threading.Lock
+)
+_direct_probe_lock = threading.Lock()
+
+# The lane of small, latency-sensitive RPCs, such as `AnalyzePlan`, `Config`
+# and `Interrupt`.
+LANE_CONTROL = "control"
+# The lane of RPCs streaming results or artifacts.
+LANE_BULK = "bulk"
+
+LANES = (LANE_CONTROL, LANE_BULK)
+
+# The Spark Connect methods carried by the bulk lane.
+_BULK_METHODS = frozenset(
+    [
+        "/spark.connect.SparkConnectService/ExecutePlan",
+        "/spark.connect.SparkConnectService/ReattachExecute",
+        "/spark.connect.SparkConnectService/AddArtifacts",
+    ]
+)
+
+_proxy_engines = {
+    PROXY_ENGINE_THREADS: proxy.DataprocSessionProxy,
+    PROXY_ENGINE_ASYNCIO: asyncio_proxy.AsyncioSessionProxy,
+}
+
+
+def channel_options_from_params(params):
+    """Convert connection string parameters to gRPC channel options.
+
+    Args:
+        params: A dict from the names of `CHANNEL_OPTION_PARAMS` to their
+          values, as strings.
+
+    Returns:
+        A list of `(name, value)` gRPC channel options.
+    """
+    options = []
+    for param, value in params.items():
+        if param not in CHANNEL_OPTION_PARAMS:
+            raise ValueError(
+                f"Unsupported channel option parameter {param!r}. "
+                f"Supported parameters: {list(CHANNEL_OPTION_PARAMS)}"
+            )
+        if param == "grpc_compression":
+            if value not in GRPC_COMPRESSION_ALGORITHMS:
+                raise ValueError(
+                    f"Unsupported gRPC compression {value!r}. "
+                    f"Supported algorithms: {list(GRPC_COMPRESSION_ALGORITHMS)}"
+                )
+            value = int(GRPC_COMPRESSION_ALGORITHMS[value])
+        else:
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(
+                    f"The {param} parameter must be an integer, got {value!r}"
+                )
+        options.extend((name, value) for name in CHANNEL_OPTION_PARAMS[param])
+    return options
+
+
+def _merge_channel_options(*option_lists):
+    """Merge lists of channel options, later values replacing earlier ones."""
+    merged = {}
+    for options in option_lists:
+        merged.update(options or [])
+    return list(merged.items())
 
 
 class DataprocChannelBuilder(ChannelBuilder):
@@ -34,8 +192,88 @@ class DataprocChannelBuilder(ChannelBuilder):
     >>> cb = ChannelBuilder("sc://localhost/;use_ssl=true;token=aaa")
     ... cb.secure
     True
+
+    The parameters of `CHANNEL_OPTION_PARAMS` set gRPC channel options, for
+    the direct and the proxied channel alike, and are not sent to the
+    server:
+
+    >>> cb = DataprocChannelBuilder("sc://localhost/;grpc_compression=gzip")
+    ... cb.channel_options[-1]
+    ('grpc.default_compression_algorithm', 2)
     """
 
+    def __init__(
+        self,
+        url: str,
+        channelOptions: Optional[List[Tuple[str, Any]]] = None,
+        proxy_options: Optional[Dict[str, Any]] = None,
+        transport: str = TRANSPORT_PROXY,
+        probe_timeout: float = DEFAULT_PROBE_TIMEOUT,
+        pool_size: int = 1,
+        pool_policy: str = POOL_LEAST_LOADED,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        url : str
+            Spark Connect connection string
+        channelOptions: list of tuple, optional
+            Additional options that can be passed to the GRPC channel construction.
+            Options set by the connection string take precedence.
+        proxy_options: dict, optional
+            Options for the local session proxy, passed to `ProxiedChannel`.
+        transport: str, optional
+            `"proxy"` to reach the session through the local proxy, or
+            `"direct"` to connect to it with an authenticated gRPC channel.
+            The first direct channel to a host is probed with a Spark
+            version request, and if that does not succeed within
+            `probe_timeout` seconds, that and every channel to the host for
+            the next `DIRECT_PROBE_RETRY_INTERVAL` seconds use the proxy
+            instead.
+        probe_timeout: float, optional
+            How long, in seconds, the direct channel probe waits for its
+            answer.
+        pool_size: int, optional
+            The number of channels, each with its own connection, to spread
+            the RPCs over. With more than one, `toChannel` returns a
+            `ChannelPool`.
+        pool_policy: str, optional
+            How a `ChannelPool` picks the channel of each RPC, either
+            `"least_loaded"` or `"round_robin"`.
+        """
+        super().__init__(url, channelOptions)
+        # Taken out of `params`, which are otherwise sent as request metadata.
+        params = {
+            param: self.params.pop(param)
+            for param in CHANNEL_OPTION_PARAMS
+            if param in self.params
+        }
+        self._channel_options = _merge_channel_options(
+            self._channel_options, channel_options_from_params(params)
+        )
+        if transport not in TRANSPORTS:
+            raise ValueError(
+                f"Unsupported transport {transport!r}. "
+                f"Supported transports: {list(TRANSPORTS)}"
+            )
+        if pool_size < 1:
+            raise ValueError(f"The pool size must be positive, got {pool_size}")
+        if pool_policy not in POOL_POLICIES:
+            raise ValueError(
+                f"Unsupported pool policy {pool_policy!r}. "
+                f"Supported policies: {list(POOL_POLICIES)}"
+            )
+        self._proxy_options = dict(proxy_options or {})
+        self._transport = transport
+        self._probe_timeout = probe_timeout
+        self._pool_size = pool_size
+        self._pool_policy = pool_policy
+
+    @property
+    def channel_options(self) -> List[Tuple[str, Any]]:
+        """The options of the gRPC channels created"""
+        return list(self._channel_options)
+
     def toChannel(self) -> grpc.Channel:
         """
         Applies the parameters of the connection string and creates a new
@@ -46,68 +284,663 @@ class DataprocChannelBuilder(ChannelBuilder):
         -------
         GRPC Channel instance.
         """
-        # TODO: Replace with a direct channel once all compatibility issues with
-        # grpc have been resolved.
-        return self._proxied_channel()
+        if self._pool_size == 1:
+            return self._channel(self._channel_options)
+        # gRPC shares connections between channels with the same target and
+        # options, so each pooled channel keeps its subchannels to itself.
+        options = _merge_channel_options(
+            self._channel_options, [("grpc.use_local_subchannel_pool", 1)]
+        )
+        return ChannelPool(
+            [self._channel(options) for _ in range(self._pool_size)],
+            self._pool_policy,
+        )
 
-    def _proxied_channel(self) -> grpc.Channel:
-        return ProxiedChannel(self.host)
+    def _channel(self, options) -> grpc.Channel:
+        if self._transport == TRANSPORT_DIRECT:
+            channel = self._probed_direct_channel(options)
+            if channel is not None:
+                return channel
+        return self._proxied_channel(options)
 
-    def _direct_channel(self) -> grpc.Channel:
-        destination = f"{self.host}:{self.port}"
+    def _probed_direct_channel(self, options) -> Optional[grpc.Channel]:
+        """Create a direct channel, or return `None` if it cannot be used."""
+        with _direct_probe_lock:
+            probe_lock = _direct_probe_locks[self.endpoint]
+        with probe_lock:
+            result = _direct_probe_results.get(self.endpoint)
+            if result is not None:
+                reachable, probed_at = result
+                if reachable:
+                    return self._direct_channel(options)
+                if time.monotonic() - probed_at < DIRECT_PROBE_RETRY_INTERVAL:
+                    return None
+            channel = self._direct_channel(options)
+            try:
+                self._probe(channel)
+            except (grpc.RpcError, ValueError) as ex:
+                channel.close()
+                logger.warning(
+                    f"Could not use a direct channel to {self.endpoint}, "
+                    f"falling back to the session proxy: {ex}"
+                )
+                _direct_probe_results[self.endpoint] = (False, time.monotonic())
+                return None
+            _direct_probe_results[self.endpoint] = (True, time.monotonic())
+            return channel
 
-        credentials, project = google.auth.default(
-            scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    def _probe(self, channel) -> None:
+        """Check that `channel` reaches a Spark Connect server.
+
+        A connection alone only shows that something speaks HTTP/2 at the
+        endpoint, such as a front end that does not route gRPC, so the
+        server is asked for its Spark version, in the session the channel
+        is for.
+        """
+        request = pb2.AnalyzePlanRequest(
+            session_id=self.session_id or str(uuid.uuid4()),
+            client_type=self.userAgent,
         )
+        if self.userId is not None:
+            request.user_context.user_id = self.userId
+        request.spark_version.SetInParent()
+        analyze = channel.unary_unary(
+            _PROBE_METHOD,
+            request_serializer=pb2.AnalyzePlanRequest.SerializeToString,
+            response_deserializer=pb2.AnalyzePlanResponse.FromString,
+        )
+        response = analyze(
+            request,
+            timeout=self._probe_timeout,
+            metadata=self.metadata(),
+            wait_for_ready=True,
+        )
+        if not response.spark_version.version:
+            raise ValueError("The server did not report a Spark version")
+
+    def _proxied_channel(self, options) -> grpc.Channel:
+        return ProxiedChannel(
+            self.host,
+            channel_options=options,
+            **self._proxy_options,
+        )
+
+    def _direct_channel(self, options) -> grpc.Channel:
+        destination = f"{self.host}:{self.port}"
+
+        credentials = default_credential_manager().credentials
         # Get an HTTP request function to refresh credentials.
         request = google.auth.transport.requests.Request()
         # Create a channel.
 
+        if not self.secure:
+            # Without TLS, as against a local stand-in, the access token is
+            # only ever sent to local addresses.
+            return grpc.secure_channel(
+                destination,
+                grpc.composite_channel_credentials(
+                    grpc.local_channel_credentials(),
+                    grpc.metadata_call_credentials(
+                        google.auth.transport.grpc.AuthMetadataPlugin(
+                            credentials, request
+                        )
+                    ),
+                ),
+                options=options,
+            )
         return google.auth.transport.grpc.secure_authorized_channel(
             credentials,
             request,
             destination,
             None,
             None,
-            options=self._channel_options,
+            options=options,
+        )
+
+
+def _local_channel(unix_socket_path, port, options=None):
+    """Create an insecure channel to a local proxy."""
+    if unix_socket_path is None:
+        target = f"localhost:{port}"
+    else:
+        target = f"unix:{unix_socket_path}"
+    # Created directly rather than with pyspark's `ChannelBuilder`, which
+    # only understands `sc://host:port` URLs, with the same default options.
+    return grpc.insecure_channel(
+        target, options=_merge_channel_options(_GRPC_DEFAULT_OPTIONS, options)
+    )
+
+
+def _lane_channels(unix_socket_path, port, separate_lanes, options=None):
+    """Create the channel of each lane to a local proxy."""
+    control = _local_channel(unix_socket_path, port, options)
+    if not separate_lanes:
+        return {LANE_CONTROL: control, LANE_BULK: control}
+    # gRPC shares connections between channels with the same target and
+    # options, so the bulk channel keeps its subchannels to itself.
+    bulk = _local_channel(
+        unix_socket_path,
+        port,
+        _merge_channel_options(
+            options, [("grpc.use_local_subchannel_pool", 1)]
+        ),
+    )
+    return {LANE_CONTROL: control, LANE_BULK: bulk}
+
+
+class _TimedResponses(object):
+    """Iterates over streamed responses, timing the first one to arrive."""
+
+    def __init__(self, responses, start, observe):
+        self._responses = responses
+        self._start = start
+        self._observe = observe
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        response = next(self._responses)
+        if self._observe is not None:
+            self._observe(time.perf_counter() - self._start)
+            self._observe = None
+        return response
+
+    def __getattr__(self, name):
+        # The response iterator is also the `grpc.Call` of the RPC.
+        return getattr(self._responses, name)
+
+
+class _TimedMultiCallable(object):
+    """Wraps a gRPC multi-callable to time the first response of each call.
+
+    Only direct calls are timed; `future` and `with_call` are passed through.
+    """
+
+    def __init__(self, multicallable, observe, streaming):
+        self._multicallable = multicallable
+        self._observe = observe
+        self._streaming = streaming
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        response = self._multicallable(*args, **kwargs)
+        if self._streaming:
+            return _TimedResponses(response, start, self._observe)
+        self._observe(time.perf_counter() - start)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._multicallable, name)
+
+
+class _SharedProxy(object):
+    """A started proxy, and the number of channels using it."""
+
+    def __init__(self, key, target_host, proxy, socket_dir):
+        self.key = key
+        self.target_host = target_host
+        self.proxy = proxy
+        self.socket_dir = socket_dir
+        self.references = 0
+
+
+class ProxyRegistry(object):
+    """Hands out session proxies shared by the channels to the same host.
+
+    Every `toChannel()` call used to start its own proxy, with its own
+    threads, listening socket and websockets. A registry keeps one proxy
+    per target host, engine and set of proxy options, counts the channels
+    using it, and stops it when the last one is closed. Unless set
+    otherwise, like those of the `daemon.ProxyDaemon`, threaded proxies keep
+    one pre-warmed bridge connection, so a new channel to a host that
+    already has a proxy skips the websocket handshake.
+
+    Proxies whose options cannot be hashed are not shared.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proxies = {}
+
+    @staticmethod
+    def _key(target_host, proxy_engine, unix_socket, proxy_options):
+        key = (
+            target_host,
+            proxy_engine,
+            unix_socket,
+            tuple(sorted(proxy_options.items())),
         )
+        try:
+            hash(key)
+        except TypeError:
+            return object()
+        return key
+
+    def acquire(
+        self, target_host, proxy_engine, unix_socket=None, **proxy_options
+    ):
+        """Return a started proxy to `target_host`, starting it if needed.
+
+        Each call must be matched by a call to `release`.
+        """
+        if unix_socket is None:
+            unix_socket = hasattr(socket, "AF_UNIX")
+        if proxy_engine == PROXY_ENGINE_THREADS:
+            proxy_options = {"pool_size": 1, **proxy_options}
+        key = self._key(target_host, proxy_engine, unix_socket, proxy_options)
+        with self._lock:
+            shared = self._proxies.get(key)
+            if shared is None:
+                shared = self._start(
+                    key, target_host, proxy_engine, unix_socket, proxy_options
+                )
+                self._proxies[key] = shared
+            shared.references += 1
+            return shared
+
+    @staticmethod
+    def _start(key, target_host, proxy_engine, unix_socket, proxy_options):
+        socket_dir = None
+        if unix_socket:
+            # The directory is created accessible only to the current user,
+            # and the proxy restricts the socket file itself too.
+            socket_dir = tempfile.mkdtemp(prefix="dataproc-proxy-")
+            proxy_options = dict(
+                proxy_options,
+                unix_socket_path=os.path.join(socket_dir, "proxy.sock"),
+            )
+        p = _proxy_engines[proxy_engine](0, target_host, **proxy_options)
+        try:
+            p.start()
+        except BaseException:
+            if socket_dir is not None:
+                shutil.rmtree(socket_dir, ignore_errors=True)
+            raise
+        logger.debug(f"Started a session proxy for {target_host}")
+        return _SharedProxy(key, target_host, p, socket_dir)
+
+    def release(self, shared, drain_timeout=1.0):
+        """Release a proxy returned by `acquire`.
+
+        The proxy is stopped once no channel is using it.
+
+        Returns:
+            How long stopping the proxy took, in seconds, or 0 if it is
+            still in use.
+        """
+        with self._lock:
+            shared.references -= 1
+            if shared.references:
+                return 0.0
+            if self._proxies.get(shared.key) is shared:
+                del self._proxies[shared.key]
+        duration = shared.proxy.stop(drain_timeout)
+        if shared.socket_dir is not None:
+            shutil.rmtree(shared.socket_dir, ignore_errors=True)
+        logger.debug(f"Stopped the session proxy in {duration:.3f}s")
+        return duration
+
+    def stats(self):
+        """Return the number of channels using each running proxy, by host."""
+        stats = {}
+        with self._lock:
+            for shared in self._proxies.values():
+                stats[shared.target_host] = (
+                    stats.get(shared.target_host, 0) + shared.references
+                )
+        return stats
+
+
+# The registry every `ProxiedChannel` of this process uses by default.
+default_proxy_registry = ProxyRegistry()
 
 
 class ProxiedChannel(grpc.Channel):
+    """A GRPC channel that reaches the session through a local proxy.
 
-    def __init__(self, target_host):
-        self._proxy = proxy.DataprocSessionProxy(0, target_host)
-        self._proxy.start()
-        self._proxied_connect_url = f"sc://localhost:{self._proxy.port}"
-        self._wrapped = ChannelBuilder(self._proxied_connect_url).toChannel()
+    Parameters
+    ----------
+    target_host : str
+        The host running the TCP-bridge backend for the session.
+    proxy_engine : str
+        Either `"threads"` to forward each connection using dedicated threads,
+        or `"asyncio"` to forward every connection from a single event loop.
+    drain_timeout : float
+        How long, in seconds, closing the channel waits for proxied
+        connections to finish before closing them.
+    unix_socket : bool, optional
+        Whether the proxy listens on a Unix domain socket, in a directory only
+        the current user can access, rather than on a loopback TCP port. This
+        skips the loopback TCP stack and keeps other local users out of the
+        authenticated tunnel. Defaults to using one wherever the platform
+        supports it.
+    daemon_socket : str, optional
+        The control socket of a `daemon.ProxyDaemon` to route the channel
+        through, instead of starting a proxy in this process. The proxy
+        options are then those of the daemon.
+    registry : ProxyRegistry, optional
+        The registry the proxy is acquired from. Defaults to
+        `default_proxy_registry`, so every channel of this process to the
+        same host, with the same options, shares one proxy.
+    separate_lanes : bool, optional
+        Whether result streams and artifact uploads (the bulk lane) go over
+        their own connection to the proxy, and so their own websocket, rather
+        than sharing one with every other RPC (the control lane). This keeps
+        an `Interrupt` or `AnalyzePlan` from queueing behind a large result.
+        With `multiplex`, the lanes share the websocket but not its streams.
+        Defaults to `True`.
+    channel_options : list of tuple, optional
+        Options of the gRPC channels to the proxy, such as message size
+        limits, keepalive, flow control windows or message compression. The
+        proxy forwards the HTTP/2 connection unchanged, so they apply end to
+        end, between the client and the session.
+    **proxy_options
+        Additional options passed to the proxy.
+    """
+
+    def __init__(
+        self,
+        target_host,
+        proxy_engine=PROXY_ENGINE_THREADS,
+        drain_timeout=1.0,
+        unix_socket=None,
+        daemon_socket=None,
+        registry=None,
+        separate_lanes=True,
+        channel_options=None,
+        **proxy_options,
+    ):
+        if proxy_engine not in _proxy_engines:
+            raise ValueError(
+                f"Unsupported proxy engine {proxy_engine!r}. "
+                f"Supported engines: {list(_proxy_engines)}"
+            )
+        self._drain_timeout = drain_timeout
+        self._shutdown_duration = None
+        self._registry = None
+        self._shared = None
+        self._proxy = None
+        self._daemon_client = None
+        self._separate_lanes = separate_lanes
+        self._lane_latency = {
+            lane: Histogram(SETUP_LATENCY_BUCKETS) for lane in LANES
+        }
+        if daemon_socket is not None:
+            # Imported here so that running the daemon module as a script
+            # does not import it twice.
+            from .daemon import DaemonClient
+
+            self._daemon_client = DaemonClient(daemon_socket)
+            address = self._daemon_client.register(target_host)
+            self._lanes = _lane_channels(
+                address["unix_socket_path"],
+                address["port"],
+                separate_lanes,
+                channel_options,
+            )
+            self._wrapped = self._lanes[LANE_CONTROL]
+            return
+        self._registry = registry or default_proxy_registry
+        self._shared = self._registry.acquire(
+            target_host, proxy_engine, unix_socket, **proxy_options
+        )
+        self._proxy = self._shared.proxy
+        self._lanes = _lane_channels(
+            self._proxy.unix_socket_path,
+            self._proxy.port,
+            separate_lanes,
+            channel_options,
+        )
+        self._wrapped = self._lanes[LANE_CONTROL]
 
     def __enter__(self):
         return self
 
+    @property
+    def shutdown_duration(self):
+        """How long stopping the proxy took, in seconds, once closed"""
+        return self._shutdown_duration
+
+    def lane_of(self, method):
+        """Return the lane carrying RPCs to `method`."""
+        if method in _BULK_METHODS:
+            return LANE_BULK
+        return LANE_CONTROL
+
+    def lane_latency(self):
+        """Return how long RPCs waited for their first response, by lane.
+
+        Time spent queued behind other traffic on the same connection, in
+        the proxy or on the websocket, shows up here.
+
+        Returns:
+            A dict from each lane to a `metrics.Histogram` snapshot of the
+            seconds from starting each RPC to its first response message.
+        """
+        return {
+            lane: histogram.snapshot()
+            for lane, histogram in self._lane_latency.items()
+        }
+
+    def _multicallable(self, kind, method, args, kwargs, streaming):
+        lane = self.lane_of(method)
+        multicallable = getattr(self._lanes[lane], kind)(
+            method, *args, **kwargs
+        )
+        return _TimedMultiCallable(
+            multicallable, self._lane_latency[lane].observe, streaming
+        )
+
+    def _close_bulk_lane(self):
+        if self._separate_lanes:
+            self._lanes[LANE_BULK].close()
+
+    def _stop_proxy(self):
+        if self._daemon_client is not None:
+            # The daemon stops its proxy once no process is using it.
+            start = time.monotonic()
+            self._daemon_client.close()
+            self._shutdown_duration = time.monotonic() - start
+            return
+        shared, self._shared = self._shared, None
+        if shared is None:
+            # Already closed.
+            return
+        # The gRPC channel has already closed its connections, so the proxy
+        # normally drains without waiting for the timeout.
+        self._shutdown_duration = self._registry.release(
+            shared, self._drain_timeout
+        )
+
     def __exit__(self, *args):
         ret = self._wrapped.__exit__(*args)
-        self._proxy.stop()
+        self._close_bulk_lane()
+        self._stop_proxy()
         return ret
 
     def close(self):
         ret = self._wrapped.close()
-        self._proxy.stop()
+        self._close_bulk_lane()
+        self._stop_proxy()
         return ret
 
-    def stream_stream(self, *args, **kwargs):
-        return self._wrapped.stream_stream(*args, **kwargs)
+    def stream_stream(self, method, *args, **kwargs):
+        return self._multicallable(
+            "stream_stream", method, args, kwargs, streaming=True
+        )
 
-    def stream_unary(self, *args, **kwargs):
-        return self._wrapped.stream_unary(*args, **kwargs)
+    def stream_unary(self, method, *args, **kwargs):
+        return self._multicallable(
+            "stream_unary", method, args, kwargs, streaming=False
+        )
 
     def subscribe(self, *args, **kwargs):
         return self._wrapped.subscribe(*args, **kwargs)
 
-    def unary_stream(self, *args, **kwargs):
-        return self._wrapped.unary_stream(*args, **kwargs)
+    def unary_stream(self, method, *args, **kwargs):
+        return self._multicallable(
+            "unary_stream", method, args, kwargs, streaming=True
+        )
 
-    def unary_unary(self, *args, **kwargs):
-        return self._wrapped.unary_unary(*args, **kwargs)
+    def unary_unary(self, method, *args, **kwargs):
+        return self._multicallable(
+            "unary_unary", method, args, kwargs, streaming=False
+        )
 
     def unsubscribe(self, *args, **kwargs):
         return self._wrapped.unsubscribe(*args, **kwargs)
+
+
+class _PooledMultiCallable(object):
+    """Sends each call of a method over one of the channels of a pool."""
+
+    def __init__(self, pool, multicallables, streaming):
+        self._pool = pool
+        self._multicallables = multicallables
+        self._streaming = streaming
+
+    def _invoke(self, attr, args, kwargs):
+        index = self._pool._select()
+        try:
+            response = getattr(self._multicallables[index], attr)(
+                *args, **kwargs
+            )
+        except BaseException:
+            self._pool._done(index)
+            raise
+        if self._streaming or attr == "future":
+            # Called right away if the RPC has already finished.
+            response.add_done_callback(lambda _: self._pool._done(index))
+        else:
+            self._pool._done(index)
+        return response
+
+    def __call__(self, *args, **kwargs):
+        return self._invoke("__call__", args, kwargs)
+
+    def with_call(self, *args, **kwargs):
+        return self._invoke("with_call", args, kwargs)
+
+    def future(self, *args, **kwargs):
+        return self._invoke("future", args, kwargs)
+
+
+class ChannelPool(grpc.Channel):
+    """A GRPC channel spreading its RPCs over several channels.
+
+    One channel is one HTTP/2 connection, and through the proxy one
+    websocket, so concurrent queries from several threads all share its
+    bandwidth. A pool sends each RPC over one of its channels, so that the
+    RPCs in flight together can use several connections.
+
+    Parameters
+    ----------
+    channels : list of grpc.Channel
+        The channels to spread the RPCs over. They are closed with the pool.
+    policy : str
+        `"least_loaded"` to send each RPC over the channel with the fewest
+        RPCs in flight, or `"round_robin"` to use each channel in turn.
+    """
+
+    def __init__(self, channels, policy=POOL_LEAST_LOADED):
+        if not channels:
+            raise ValueError("A channel pool needs at least one channel")
+        if policy not in POOL_POLICIES:
+            raise ValueError(
+                f"Unsupported pool policy {policy!r}. "
+                f"Supported policies: {list(POOL_POLICIES)}"
+            )
+        self._channels = list(channels)
+        self._policy = policy
+        self._lock = threading.Lock()
+        self._in_flight = [0] * len(self._channels)
+        self._calls = [0] * len(self._channels)
+        self._next = 0
+
+    @property
+    def channels(self):
+        """The channels of the pool"""
+        return list(self._channels)
+
+    def _select(self):
+        with self._lock:
+            if self._policy == POOL_ROUND_ROBIN:
+                index = self._next
+                self._next = (index + 1) % len(self._channels)
+            else:
+                # Ties go to the next channel in turn, so that an idle pool
+                # still spreads sequential RPCs.
+                count = len(self._channels)
+                index = min(
+                    ((self._next + i) % count for i in range(count)),
+                    key=lambda i: self._in_flight[i],
+                )
+                self._next = (index + 1) % count
+            self._in_flight[index] += 1
+            self._calls[index] += 1
+            return index
+
+    def _done(self, index):
+        with self._lock:
+            self._in_flight[index] -= 1
+
+    def stats(self):
+        """Return the RPCs sent over each channel of the pool.
+
+        Returns:
+            A list with, for each channel, a dict of the RPCs `in_flight`
+            and the total number of `calls` sent over it.
+        """
+        with self._lock:
+            return [
+                {"in_flight": in_flight, "calls": calls}
+                for in_flight, calls in zip(self._in_flight, self._calls)
+            ]
+
+    def _multicallable(self, kind, method, args, kwargs, streaming):
+        return _PooledMultiCallable(
+            self,
+            [
+                getattr(channel, kind)(method, *args, **kwargs)
+                for channel in self._channels
+            ],
+            streaming,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+
+    def stream_stream(self, method, *args, **kwargs):
+        return self._multicallable(
+            "stream_stream", method, args, kwargs, streaming=True
+        )
+
+    def stream_unary(self, method, *args, **kwargs):
+        return self._multicallable(
+            "stream_unary", method, args, kwargs, streaming=False
+        )
+
+    def subscribe(self, *args, **kwargs):
+        return self._channels[0].subscribe(*args, **kwargs)
+
+    def unary_stream(self, method, *args, **kwargs):
+        return self._multicallable(
+            "unary_stream", method, args, kwargs, streaming=True
+        )
+
+    def unary_unary(self, method, *args, **kwargs):
+        return self._multicallable(
+            "unary_unary", method, args, kwargs, streaming=False
+        )
+
+    def unsubscribe(self, *args, **kwargs):
+        return self._channels[0].unsubscribe(*args, **kwargs)
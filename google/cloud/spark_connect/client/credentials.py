@@ -0,0 +1,163 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import logging
+import threading
+
+from google import auth as googleauth
+from google.auth.transport import requests as googleauthrequests
+
+logger = logging.getLogger(__name__)
+
+CLOUD_PLATFORM_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+def _utcnow():
+    # Credential expiry times are naive datetimes in UTC.
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CredentialManager(object):
+    """Caches Google credentials and refreshes them before they expire.
+
+    The access token is refreshed in a background thread shortly before it
+    expires, so callers normally get a cached token without blocking. If a
+    caller does find the token missing or about to expire, it refreshes it
+    synchronously; concurrent callers wait for that single refresh rather
+    than starting their own.
+
+    Args:
+        scopes: The OAuth scopes to request for the default credentials.
+        refresh_margin: How long before expiry the background refresh runs.
+        min_validity: Tokens that expire sooner than this are never handed
+          out, and are refreshed synchronously instead.
+        credentials: Credentials to manage. Defaults to the Google
+          Application Default Credentials.
+    """
+
+    def __init__(
+        self,
+        scopes=CLOUD_PLATFORM_SCOPES,
+        refresh_margin=datetime.timedelta(minutes=5),
+        min_validity=datetime.timedelta(seconds=30),
+        credentials=None,
+    ):
+        self._scopes = scopes
+        self._refresh_margin = refresh_margin
+        self._min_validity = min_validity
+        self._credentials = credentials
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresh_timer = None
+        self._refresh_count = 0
+
+    @property
+    def credentials(self):
+        """The managed credentials, loaded on first use.
+
+        These can be passed to Google Cloud clients so that they share the
+        token cached and refreshed by this manager.
+        """
+        with self._lock:
+            if self._credentials is None:
+                self._credentials, _ = googleauth.default(scopes=self._scopes)
+            return self._credentials
+
+    @property
+    def refresh_count(self):
+        """The number of times the credentials have been refreshed"""
+        return self._refresh_count
+
+    def _valid_for(self, creds, duration):
+        if not creds.token:
+            return False
+        if creds.expiry is None:
+            return True
+        return creds.expiry - _utcnow() > duration
+
+    def cached_token(self):
+        """Return the cached token, or `None` if it needs to be refreshed.
+
+        Unlike `token`, this never blocks on loading or refreshing the
+        credentials.
+        """
+        creds = self._credentials
+        if creds is not None and self._valid_for(creds, self._min_validity):
+            return creds.token
+        return None
+
+    def token(self):
+        """Return a valid access token, refreshing it if necessary."""
+        creds = self.credentials
+        if not self._valid_for(creds, self._min_validity):
+            self._refresh(creds, self._min_validity)
+        return creds.token
+
+    def _refresh(self, creds, min_validity=None):
+        with self._refresh_lock:
+            # Another caller may have refreshed while we waited for the lock.
+            if min_validity is not None and self._valid_for(
+                creds, min_validity
+            ):
+                return
+            creds.refresh(googleauthrequests.Request())
+            self._refresh_count += 1
+            self._schedule_refresh(creds)
+
+    def _schedule_refresh(self, creds):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if creds.expiry is None:
+            return
+        delay = creds.expiry - _utcnow() - self._refresh_margin
+        self._refresh_timer = threading.Timer(
+            max(delay.total_seconds(), 0), self._background_refresh
+        )
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        creds = self.credentials
+        try:
+            self._refresh(creds)
+        except Exception as ex:
+            logger.debug(f"Background credential refresh failed: {ex}")
+            # Retry later, leaving callers to refresh synchronously if the
+            # token gets too close to expiry in the meantime.
+            self._refresh_timer = threading.Timer(
+                self._min_validity.total_seconds(), self._background_refresh
+            )
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def close(self):
+        """Stop refreshing the credentials in the background."""
+        with self._refresh_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+
+
+_default_credential_manager = None
+_default_credential_manager_lock = threading.Lock()
+
+
+def default_credential_manager():
+    """The process-wide `CredentialManager` for the default credentials."""
+    global _default_credential_manager
+    with _default_credential_manager_lock:
+        if _default_credential_manager is None:
+            _default_credential_manager = CredentialManager()
+        return _default_credential_manager
@@ -0,0 +1,376 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A long-lived session proxy shared by the Python processes on a host.
+
+Every kernel that starts its own `proxy.DataprocSessionProxy` pays for its
+own threads, credentials and websockets. A `ProxyDaemon` runs one proxy per
+target host for every process of the same user, with pooled bridge
+connections, and is controlled over a Unix domain socket that only that
+user can access.
+
+The control protocol is one JSON object per line in each direction. Each
+request has a `command`:
+
+    register    {"command": "register", "target_host": HOST}
+                Starts routing connections to HOST, if it is not already, and
+                replies with the `port` and `unix_socket_path` the proxy for
+                HOST listens on.
+    unregister  {"command": "unregister", "target_host": HOST}
+                Releases one registration of HOST. The proxy for HOST stops
+                once no registrations are left.
+    stats       {"command": "stats"}
+                Replies with the registrations and connection counts of
+                every proxy.
+
+Replies have `"ok": true`, or `"ok": false` and an `error` message. A
+process's registrations are released when its control connection closes,
+so a kernel that exits without unregistering does not keep a proxy alive.
+
+Usage:
+    python -m google.cloud.spark_connect.client.daemon [--control-socket PATH]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import tempfile
+import threading
+
+from . import proxy
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--control-socket",
+    help="The path of the control socket. Defaults to a per-user path",
+)
+parser.add_argument(
+    "--pool-size",
+    type=int,
+    default=1,
+    help="The number of pre-warmed websocket connections per target host",
+)
+parser.add_argument(
+    "--multiplex",
+    action="store_true",
+    help="Carry every connection to a host over one shared websocket",
+)
+parser.add_argument(
+    "--max-connections",
+    type=int,
+    help="The most connections each proxy forwards at once",
+)
+parser.add_argument(
+    "--idle-timeout",
+    type=float,
+    help="Close connections that carry no traffic for this many seconds",
+)
+
+
+def default_control_socket_path():
+    """The control socket path shared by every process of the current user.
+
+    The socket lives in a directory only the current user can access, under
+    `$XDG_RUNTIME_DIR` if it is set and the temporary directory otherwise.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    socket_dir = os.path.join(runtime_dir, f"dataproc-proxy-{os.getuid()}")
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    os.chmod(socket_dir, 0o700)
+    return os.path.join(socket_dir, "control.sock")
+
+
+def daemon_running(control_path):
+    """Whether a daemon is accepting connections on `control_path`."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(control_path)
+        except OSError:
+            return False
+    return True
+
+
+class ProxyDaemon(object):
+    """Runs a session proxy per target host, shared by several processes.
+
+    Args:
+        control_path: The path of the control socket. Defaults to
+          `default_control_socket_path()`.
+        **proxy_options: Options passed to every `proxy.DataprocSessionProxy`
+          the daemon starts. Unless set, each proxy keeps one pre-warmed
+          bridge connection.
+    """
+
+    def __init__(self, control_path=None, **proxy_options):
+        self._control_path = control_path or default_control_socket_path()
+        self._socket_dir = os.path.dirname(self._control_path)
+        self._proxy_options = {"pool_size": 1, **proxy_options}
+        self._lock = threading.Lock()
+        self._proxies = {}
+        self._registrations = {}
+        self._proxy_number = 0
+        self._clients = set()
+        self._server = None
+        self._thread = None
+        self._started = False
+        self._stopped = False
+
+    @property
+    def control_path(self):
+        """The path of the control socket"""
+        return self._control_path
+
+    def start(self, daemon=True):
+        """Start listening on the control socket.
+
+        By the time this method returns the control socket accepts
+        connections.
+        """
+        if self._started:
+            raise Exception("Proxy daemon already started")
+        if daemon_running(self._control_path):
+            raise Exception(
+                f"A proxy daemon is already listening on {self._control_path}"
+            )
+        self._started = True
+        self._server = proxy.create_unix_server(self._control_path)
+        self._thread = threading.Thread(
+            target=self._accept_clients, name="proxy-daemon", daemon=daemon
+        )
+        self._thread.start()
+
+    def _accept_clients(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                # The control socket was closed by `stop`.
+                return
+            with self._lock:
+                if self._stopped:
+                    conn.close()
+                    return
+                self._clients.add(conn)
+            threading.Thread(
+                target=self._serve_client,
+                args=[conn],
+                name="proxy-daemon-client",
+                daemon=True,
+            ).start()
+
+    def _serve_client(self, conn):
+        registered = []
+        try:
+            with conn, conn.makefile("rb") as requests:
+                for line in requests:
+                    try:
+                        reply = self._handle(json.loads(line), registered)
+                    except Exception as ex:
+                        reply = {"ok": False, "error": str(ex)}
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+        except OSError as ex:
+            logger.debug(f"Control connection failed: {ex}")
+        finally:
+            with self._lock:
+                self._clients.discard(conn)
+            for target_host in registered:
+                self._release(target_host)
+
+    def _handle(self, request, registered):
+        command = request.get("command")
+        if command == "register":
+            target_host = request["target_host"]
+            p = self._acquire(target_host)
+            registered.append(target_host)
+            return {
+                "ok": True,
+                "port": p.port,
+                "unix_socket_path": p.unix_socket_path,
+            }
+        if command == "unregister":
+            target_host = request["target_host"]
+            if target_host not in registered:
+                raise ValueError(f"{target_host} is not registered")
+            registered.remove(target_host)
+            self._release(target_host)
+            return {"ok": True}
+        if command == "stats":
+            return {"ok": True, "proxies": self.stats()}
+        raise ValueError(f"Unknown command {command!r}")
+
+    def _acquire(self, target_host):
+        with self._lock:
+            if self._stopped:
+                raise Exception("Proxy daemon is stopped")
+            p = self._proxies.get(target_host)
+            if p is None:
+                self._proxy_number += 1
+                unix_socket_path = os.path.join(
+                    self._socket_dir, f"proxy-{self._proxy_number}.sock"
+                )
+                p = proxy.DataprocSessionProxy(
+                    0,
+                    target_host,
+                    unix_socket_path=unix_socket_path,
+                    **self._proxy_options,
+                )
+                p.start()
+                logger.debug(f"Started a proxy for {target_host}")
+                self._proxies[target_host] = p
+            self._registrations[target_host] = (
+                self._registrations.get(target_host, 0) + 1
+            )
+            return p
+
+    def _release(self, target_host):
+        with self._lock:
+            if target_host not in self._registrations:
+                # The daemon has been stopped.
+                return
+            self._registrations[target_host] -= 1
+            if self._registrations[target_host]:
+                return
+            del self._registrations[target_host]
+            p = self._proxies.pop(target_host)
+        p.stop()
+        logger.debug(f"Stopped the proxy for {target_host}")
+
+    def stats(self):
+        """Return the registrations and connection counts of every proxy."""
+        with self._lock:
+            proxies = list(self._proxies.items())
+            registrations = dict(self._registrations)
+        stats = {}
+        for target_host, p in proxies:
+            snapshot = p.metrics.snapshot()
+            stats[target_host] = {
+                "registrations": registrations.get(target_host, 0),
+                "connections_open": snapshot["connections_open"],
+                "connections_total": snapshot["connections_total"],
+                "connections_lost": snapshot["connections_lost"],
+            }
+            if p.connection_pool is not None:
+                stats[target_host]["pool"] = p.connection_pool.stats()
+        return stats
+
+    def stop(self):
+        """Stop the daemon, and every proxy it started."""
+        with self._lock:
+            self._stopped = True
+            clients = list(self._clients)
+            proxies = list(self._proxies.values())
+            self._proxies.clear()
+            self._registrations.clear()
+        if self._server is not None:
+            # Shutting down the control socket wakes up the blocked accept.
+            with contextlib.suppress(OSError):
+                self._server.shutdown(socket.SHUT_RDWR)
+            self._server.close()
+            proxy.remove_unix_socket(self._control_path)
+        for conn in clients:
+            with contextlib.suppress(OSError):
+                conn.shutdown(socket.SHUT_RDWR)
+        if self._thread is not None:
+            self._thread.join()
+        for p in proxies:
+            p.stop()
+
+
+class DaemonClient(object):
+    """A connection to the control socket of a `ProxyDaemon`.
+
+    Registrations made through a client are released when it is closed.
+
+    Args:
+        control_path: The path of the daemon's control socket. Defaults to
+          `default_control_socket_path()`.
+    """
+
+    def __init__(self, control_path=None):
+        self._conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._conn.connect(control_path or default_control_socket_path())
+        except OSError:
+            self._conn.close()
+            raise
+        self._replies = self._conn.makefile("rb")
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, request):
+        with self._lock:
+            self._conn.sendall(json.dumps(request).encode() + b"\n")
+            line = self._replies.readline()
+        if not line:
+            raise ConnectionError("The proxy daemon closed the connection")
+        reply = json.loads(line)
+        if not reply.pop("ok"):
+            raise Exception(f"Proxy daemon error: {reply['error']}")
+        return reply
+
+    def register(self, target_host):
+        """Start routing connections to `target_host` through the daemon.
+
+        Returns:
+            A dict with the `port` and `unix_socket_path` that the daemon's
+            proxy for `target_host` listens on.
+        """
+        return self._request(
+            {"command": "register", "target_host": target_host}
+        )
+
+    def unregister(self, target_host):
+        """Release one registration of `target_host`."""
+        self._request({"command": "unregister", "target_host": target_host})
+
+    def stats(self):
+        """Return the daemon's per target host statistics."""
+        return self._request({"command": "stats"})["proxies"]
+
+    def close(self):
+        self._replies.close()
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    proxy_daemon = ProxyDaemon(
+        args.control_socket,
+        pool_size=args.pool_size,
+        multiplex=args.multiplex,
+        max_connections=args.max_connections,
+        idle_timeout=args.idle_timeout,
+    )
+    proxy_daemon.start(daemon=False)
+    print(f"Proxy daemon listening on {proxy_daemon.control_path}")
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+    try:
+        # Sleep until interrupted; the daemon's threads block on their
+        # sockets, so an idle daemon uses no CPU.
+        stopping.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy_daemon.stop()
@@ -0,0 +1,321 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Resolution of, and racing between, the addresses of a bridge backend.
+
+Connecting to a host name connects to its first resolved address, and only
+tries the next one once that has failed, which can take seconds over a
+broken IPv6 path. An `EndpointResolver` caches the resolved addresses for a
+while, orders them alternating between address families as in RFC 8305
+("Happy Eyeballs"), and moves addresses that have been slow or failing to
+the end. `race` then starts a connection attempt to each address in turn, a
+short delay apart, and keeps whichever completes first.
+"""
+
+import functools
+import queue
+import socket
+import threading
+import time
+import urllib.request
+
+# How long, in seconds, resolved addresses are reused. `getaddrinfo` does
+# not report the record TTLs, so this is a fixed, short time.
+DEFAULT_DNS_TTL = 60.0
+
+# How long, in seconds, to wait for a connection attempt before starting the
+# next one, as recommended by RFC 8305.
+DEFAULT_ATTEMPT_DELAY = 0.25
+
+# The weight of the newest observation in each address's average latency.
+_LATENCY_WEIGHT = 0.3
+
+# How long, in seconds, to wait for the TCP connection of one attempt.
+_CONNECT_TIMEOUT = 10.0
+
+# The latency, in seconds, recorded for a failed connection attempt.
+_FAILURE_LATENCY = 10.0
+
+# Addresses whose average latency is more than this many times that of the
+# fastest address are tried last.
+_SLOW_FACTOR = 2.0
+
+
+def uses_http_proxy(host, port, secure):
+    """Whether connections to `host` are configured to go through a proxy.
+
+    The websockets library honors the proxy environment variables, and a
+    connection through a proxy cannot be raced across addresses.
+    """
+    if urllib.request.proxy_bypass(f"{host}:{port}"):
+        return False
+    proxies = urllib.request.getproxies()
+    if secure:
+        schemes = ["wss", "socks", "https"]
+    else:
+        schemes = ["ws", "socks", "https", "http"]
+    return any(scheme in proxies for scheme in schemes)
+
+
+def format_address(sockaddr):
+    """Format a socket address as `host:port`, bracketing IPv6 hosts."""
+    host, port = sockaddr[:2]
+    if ":" in host:
+        return f"[{host}]:{port}"
+    return f"{host}:{port}"
+
+
+def _interleave_families(addresses):
+    """Alternate between address families, keeping each family's order."""
+    by_family = {}
+    for address in addresses:
+        by_family.setdefault(address[0], []).append(address)
+    families = list(by_family.values())
+    interleaved = []
+    for i in range(max((len(f) for f in families), default=0)):
+        interleaved.extend(f[i] for f in families if i < len(f))
+    return interleaved
+
+
+class EndpointResolver(object):
+    """Resolves host names, and tracks the connection latency of addresses.
+
+    Args:
+        ttl: How long, in seconds, resolved addresses are reused.
+        getaddrinfo: The resolver function, for tests.
+    """
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL, getaddrinfo=socket.getaddrinfo):
+        self._ttl = ttl
+        self._getaddrinfo = getaddrinfo
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._latency = {}
+        self._attempts = {}
+        self._failures = {}
+
+    def _resolve(self, host, port):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get((host, port))
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        addresses = [
+            (family, type_, proto, sockaddr)
+            for family, type_, proto, _, sockaddr in self._getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+        ]
+        # Resolvers may return the same address once per protocol.
+        addresses = list(dict.fromkeys(addresses))
+        with self._lock:
+            self._cache[(host, port)] = (now + self._ttl, addresses)
+        return addresses
+
+    def addresses(self, host, port):
+        """Return the addresses of `host`, in the order to try them.
+
+        Returns:
+            A list of `(family, type, proto, sockaddr)` tuples.
+        """
+        addresses = _interleave_families(self._resolve(host, port))
+        with self._lock:
+            latency = {a[3]: self._latency.get(a[3]) for a in addresses}
+        known = [value for value in latency.values() if value is not None]
+        if not known:
+            return addresses
+        fastest = min(known)
+
+        def order(address):
+            value = latency[address[3]]
+            if value is None:
+                return (False, float("inf"))
+            return (value > _SLOW_FACTOR * fastest, value)
+
+        return sorted(addresses, key=order)
+
+    def invalidate(self, host, port):
+        """Resolve `host` again the next time its addresses are needed."""
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def _observe(self, sockaddr, seconds):
+        with self._lock:
+            previous = self._latency.get(sockaddr)
+            if previous is None:
+                self._latency[sockaddr] = seconds
+            else:
+                self._latency[sockaddr] = (
+                    1 - _LATENCY_WEIGHT
+                ) * previous + _LATENCY_WEIGHT * seconds
+            self._attempts[sockaddr] = self._attempts.get(sockaddr, 0) + 1
+
+    def connected(self, sockaddr, seconds):
+        """Record that connecting to `sockaddr` took `seconds`."""
+        self._observe(sockaddr, seconds)
+
+    def failed(self, sockaddr):
+        """Record that connecting to `sockaddr` failed."""
+        self._observe(sockaddr, _FAILURE_LATENCY)
+        with self._lock:
+            self._failures[sockaddr] = self._failures.get(sockaddr, 0) + 1
+
+    def stats(self):
+        """Return the connection statistics of every address tried.
+
+        Returns:
+            A dict from the address, formatted as a string, to its
+            `attempts`, `failures` and average `latency` in seconds, with
+            failures counted as a fixed, long latency.
+        """
+        with self._lock:
+            return {
+                format_address(sockaddr): {
+                    "attempts": self._attempts[sockaddr],
+                    "failures": self._failures.get(sockaddr, 0),
+                    "latency": latency,
+                }
+                for sockaddr, latency in self._latency.items()
+            }
+
+
+# The resolver shared by every bridge connection in the process.
+default_endpoint_resolver = EndpointResolver()
+
+
+def race(attempts, delay=DEFAULT_ATTEMPT_DELAY, discard=None):
+    """Run `attempts` a staggered delay apart, and return the first result.
+
+    Each attempt starts `delay` seconds after the previous one, or as soon
+    as the previous one fails. Attempts still running once one succeeds are
+    left to finish in the background, and their results passed to
+    `discard`.
+
+    Args:
+        attempts: A list of callables, each returning a result or raising.
+        delay: How long, in seconds, to wait before starting the next
+          attempt.
+        discard: Called with the result of every successful attempt but the
+          first.
+
+    Returns:
+        The result of the first attempt to succeed.
+
+    Raises:
+        The exception of the last attempt to fail, if every one fails.
+    """
+    if not attempts:
+        raise ValueError("No connection attempts to race")
+    results = queue.Queue()
+
+    def run(attempt):
+        try:
+            results.put((attempt(), None))
+        except Exception as ex:
+            results.put((None, ex))
+
+    started = 0
+    pending = 0
+    error = None
+    while True:
+        timeout = None
+        if started < len(attempts):
+            threading.Thread(
+                target=run,
+                args=[attempts[started]],
+                name="bridge-connect",
+                daemon=True,
+            ).start()
+            started += 1
+            pending += 1
+            timeout = delay
+        elif not pending:
+            raise error
+        try:
+            result, ex = results.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        pending -= 1
+        if ex is None:
+            break
+        error = ex
+    if pending and discard is not None:
+
+        def discard_late_results(remaining):
+            for _ in range(remaining):
+                late, ex = results.get()
+                if ex is None:
+                    discard(late)
+
+        threading.Thread(
+            target=discard_late_results,
+            args=[pending],
+            name="bridge-connect-discard",
+            daemon=True,
+        ).start()
+    return result
+
+
+def connect_fastest(
+    resolver, host, port, connect, close, delay=DEFAULT_ATTEMPT_DELAY
+):
+    """Race connections to the addresses of `host`, keeping the first.
+
+    Each attempt opens a TCP connection to one address and passes it to
+    `connect`, so an attempt only wins once `connect`, for example a
+    websocket handshake, has completed on it. The time each attempt takes,
+    or its failure, is recorded in `resolver`.
+
+    Args:
+        resolver: The `EndpointResolver` to resolve `host` with.
+        host: The host name to connect to.
+        port: The port to connect to.
+        connect: Called with a connected, blocking socket, returning the
+          connection. It must bound its own handshake.
+        close: Called with the connections of attempts that lost the race.
+        delay: How long, in seconds, to wait before starting the next
+          attempt.
+
+    Returns:
+        The connection returned by `connect` for the winning attempt.
+    """
+
+    def attempt(address):
+        family, type_, proto, sockaddr = address
+        start = time.perf_counter()
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.settimeout(_CONNECT_TIMEOUT)
+            sock.connect(sockaddr)
+            # The timeout only bounds the TCP connect. `connect` bounds its
+            # own handshake, and the connection then stays open while idle.
+            sock.settimeout(None)
+            conn = connect(sock)
+        except Exception:
+            sock.close()
+            resolver.failed(sockaddr)
+            raise
+        resolver.connected(sockaddr, time.perf_counter() - start)
+        return conn
+
+    addresses = resolver.addresses(host, port)
+    try:
+        return race(
+            [functools.partial(attempt, address) for address in addresses],
+            delay,
+            discard=close,
+        )
+    except Exception:
+        # The addresses may be stale.
+        resolver.invalidate(host, port)
+        raise
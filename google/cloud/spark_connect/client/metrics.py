@@ -0,0 +1,489 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Metrics recorded by the Dataproc session proxy.
+
+These separate the time a connection spends waiting on the local client,
+waiting on the websocket bridge, and encoding or decoding frames, so that a
+slow query can be attributed to Spark, the network, or local CPU.
+"""
+
+import bisect
+import collections
+import http
+import http.server
+import json
+import threading
+import time
+
+# Upper bounds, in seconds, of the connection setup latency buckets.
+SETUP_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+FORWARD = "forward"
+BACKWARD = "backward"
+
+# How many closed connections to keep per-connection metrics for.
+_MAX_CLOSED_CONNECTIONS = 100
+
+OPENMETRICS_CONTENT_TYPE = (
+    "application/openmetrics-text; version=1.0.0; charset=utf-8"
+)
+
+
+class Histogram(object):
+    """A thread-safe histogram with fixed, cumulative buckets.
+
+    Args:
+        buckets: The sorted upper bounds of the buckets.
+    """
+
+    def __init__(self, buckets):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observation."""
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Return the cumulative bucket counts, sum and count.
+
+        Returns:
+            A dict with `buckets`, a list of `(upper_bound, count)` pairs
+            ending with `float("inf")`, and the `sum` and `count` of all
+            observations.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {"buckets": cumulative, "sum": total, "count": running}
+
+
+class DirectionMetrics(object):
+    """Counters for bytes flowing in one direction of a connection.
+
+    Each direction is forwarded by a single thread, which is the only one
+    updating its counters.
+
+    Besides the counters in `FIELDS`, `peak_buffered_bytes` is the most bytes
+    the proxy held at once for this direction: received from the sending
+    side but not yet written to the receiving side. Totals report the
+    largest peak of any connection.
+
+    `uncompressed_bytes` and `compressed_bytes` only count messages that
+    went through permessage-deflate, so their difference is the number of
+    bytes compression saved on the wire.
+
+    `last_active` is the `time.perf_counter()` value of the last time bytes
+    were forwarded, or of when the direction was created.
+    """
+
+    FIELDS = (
+        "bytes",
+        "frames_received",
+        "frames_sent",
+        "recv_seconds",
+        "send_seconds",
+        "encode_seconds",
+        "decode_seconds",
+        "uncompressed_bytes",
+        "compressed_bytes",
+        "compression_seconds",
+    )
+    GAUGES = ("peak_buffered_bytes",)
+
+    def __init__(self):
+        self.bytes = 0
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.recv_seconds = 0.0
+        self.send_seconds = 0.0
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.compression_seconds = 0.0
+        self.peak_buffered_bytes = 0
+        self.last_active = time.perf_counter()
+
+    def observe_buffered(self, n):
+        """Record that `n` bytes are held by the proxy for this direction."""
+        if n > self.peak_buffered_bytes:
+            self.peak_buffered_bytes = n
+
+    def add_to(self, totals):
+        for field in self.FIELDS:
+            totals[field] += getattr(self, field)
+        for field in self.GAUGES:
+            totals[field] = max(totals[field], getattr(self, field))
+
+    def snapshot(self):
+        return {
+            field: getattr(self, field) for field in self.FIELDS + self.GAUGES
+        }
+
+
+class ConnectionMetrics(object):
+    """Metrics for one proxied connection.
+
+    The `forward` direction carries bytes from the local client to the
+    backend, and the `backward` direction carries the replies.
+
+    Time spent blocked in `recv` shows which side is slow to produce bytes,
+    and time spent in `send` (which includes encoding) shows which side is
+    slow to accept them.
+    """
+
+    def __init__(self, conn_number):
+        self.conn_number = conn_number
+        self.opened = time.time()
+        self.setup_seconds = None
+        self.closed = None
+        self.forward = DirectionMetrics()
+        self.backward = DirectionMetrics()
+
+    def snapshot(self):
+        return {
+            "connection": self.conn_number,
+            "opened": self.opened,
+            "closed": self.closed,
+            "setup_seconds": self.setup_seconds,
+            FORWARD: self.forward.snapshot(),
+            BACKWARD: self.backward.snapshot(),
+        }
+
+    @property
+    def last_active(self):
+        """The `time.perf_counter()` value of the last forwarded bytes"""
+        return max(self.forward.last_active, self.backward.last_active)
+
+
+class ProxyMetrics(object):
+    """Metrics for every connection handled by a proxy.
+
+    Totals cover every connection since the proxy started. Per-connection
+    metrics are kept for open connections and the most recently closed
+    ones.
+
+    Backend websockets that fail, rather than closing cleanly, are counted
+    as lost, and the time taken to open each replacement is recorded as the
+    reconnect latency.
+
+    Connections turned away because the proxy was at its connection limit
+    are counted as rejected, and connections closed for carrying no traffic
+    as idle closed. The peak is the most connections open at once.
+    """
+
+    def __init__(self, setup_buckets=SETUP_LATENCY_BUCKETS):
+        self._lock = threading.Lock()
+        self._open = {}
+        self._closed = collections.deque(maxlen=_MAX_CLOSED_CONNECTIONS)
+        self._closed_totals = {
+            name: dict.fromkeys(
+                DirectionMetrics.FIELDS + DirectionMetrics.GAUGES, 0
+            )
+            for name in (FORWARD, BACKWARD)
+        }
+        self._connections_total = 0
+        self._connections_lost = 0
+        self._connections_peak = 0
+        self._connections_rejected = 0
+        self._connections_idle_closed = 0
+        self._setup_latency = Histogram(setup_buckets)
+        self._reconnect_latency = Histogram(setup_buckets)
+
+    @property
+    def setup_latency(self):
+        """The `Histogram` of connection setup times, in seconds"""
+        return self._setup_latency
+
+    @property
+    def reconnect_latency(self):
+        """The `Histogram` of times to replace a lost websocket, in seconds"""
+        return self._reconnect_latency
+
+    def connection_lost(self):
+        """Record that a backend websocket failed."""
+        with self._lock:
+            self._connections_lost += 1
+
+    def connection_rejected(self):
+        """Record that a connection was turned away at the connection limit."""
+        with self._lock:
+            self._connections_rejected += 1
+
+    def connection_idle_closed(self):
+        """Record that a connection was closed for carrying no traffic."""
+        with self._lock:
+            self._connections_idle_closed += 1
+
+    def idle_connections(self, idle_seconds):
+        """Return the connections that forwarded nothing for `idle_seconds`.
+
+        Connections still connecting to the backend are never idle.
+
+        Returns:
+            The connection numbers of the idle connections.
+        """
+        cutoff = time.perf_counter() - idle_seconds
+        with self._lock:
+            return [
+                conn_number
+                for conn_number, conn_metrics in self._open.items()
+                if conn_metrics.setup_seconds is not None
+                and conn_metrics.last_active <= cutoff
+            ]
+
+    def reconnected(self, seconds):
+        """Record how long it took to replace a lost backend websocket."""
+        self._reconnect_latency.observe(seconds)
+
+    def open_connection(self, conn_number):
+        """Start recording metrics for a new connection."""
+        conn_metrics = ConnectionMetrics(conn_number)
+        with self._lock:
+            self._open[conn_number] = conn_metrics
+            self._connections_total += 1
+            self._connections_peak = max(
+                self._connections_peak, len(self._open)
+            )
+        return conn_metrics
+
+    def connection_setup(self, conn_metrics, seconds):
+        """Record how long it took to connect a connection to the backend."""
+        conn_metrics.setup_seconds = seconds
+        conn_metrics.forward.last_active = time.perf_counter()
+        self._setup_latency.observe(seconds)
+
+    def close_connection(self, conn_metrics):
+        """Stop recording metrics for a connection."""
+        conn_metrics.closed = time.time()
+        with self._lock:
+            self._open.pop(conn_metrics.conn_number, None)
+            self._closed.append(conn_metrics)
+            conn_metrics.forward.add_to(self._closed_totals[FORWARD])
+            conn_metrics.backward.add_to(self._closed_totals[BACKWARD])
+
+    def snapshot(self):
+        """Return all of the metrics as a JSON-serializable dict."""
+        with self._lock:
+            open_conns = list(self._open.values())
+            closed_conns = list(self._closed)
+            totals = {
+                name: dict(fields)
+                for name, fields in self._closed_totals.items()
+            }
+            connections_total = self._connections_total
+            connections_lost = self._connections_lost
+            connections_peak = self._connections_peak
+            connections_rejected = self._connections_rejected
+            connections_idle_closed = self._connections_idle_closed
+        for conn_metrics in open_conns:
+            conn_metrics.forward.add_to(totals[FORWARD])
+            conn_metrics.backward.add_to(totals[BACKWARD])
+        return {
+            "connections_total": connections_total,
+            "connections_open": len(open_conns),
+            "connections_lost": connections_lost,
+            "connections_peak": connections_peak,
+            "connections_rejected": connections_rejected,
+            "connections_idle_closed": connections_idle_closed,
+            "totals": totals,
+            "setup_latency": self._setup_latency.snapshot(),
+            "reconnect_latency": self._reconnect_latency.snapshot(),
+            "connections": [
+                conn_metrics.snapshot()
+                for conn_metrics in open_conns + closed_conns
+            ],
+        }
+
+    def openmetrics(self, prefix="dataproc_session_proxy"):
+        """Return the metrics in the OpenMetrics text exposition format.
+
+        Per-connection series are only exported for open connections, to
+        keep the number of series bounded.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, metric_type, help_text):
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+
+        family("connections", "counter", "Connections accepted.")
+        lines.append(
+            f"{prefix}_connections_total {snapshot['connections_total']}"
+        )
+        family("connections_lost", "counter", "Backend websockets that failed.")
+        lines.append(
+            f"{prefix}_connections_lost_total {snapshot['connections_lost']}"
+        )
+        family(
+            "connections_rejected",
+            "counter",
+            "Connections turned away at the connection limit.",
+        )
+        lines.append(
+            f"{prefix}_connections_rejected_total"
+            f" {snapshot['connections_rejected']}"
+        )
+        family(
+            "connections_idle_closed",
+            "counter",
+            "Connections closed for carrying no traffic.",
+        )
+        lines.append(
+            f"{prefix}_connections_idle_closed_total"
+            f" {snapshot['connections_idle_closed']}"
+        )
+        family("open_connections", "gauge", "Connections currently open.")
+        lines.append(
+            f"{prefix}_open_connections {snapshot['connections_open']}"
+        )
+        family(
+            "peak_open_connections", "gauge", "Most connections open at once."
+        )
+        lines.append(
+            f"{prefix}_peak_open_connections {snapshot['connections_peak']}"
+        )
+        open_conns = [
+            conn for conn in snapshot["connections"] if conn["closed"] is None
+        ]
+        for field, help_text in [
+            ("bytes", "Bytes forwarded."),
+            ("frames_received", "Reads from the sending side."),
+            ("frames_sent", "Writes to the receiving side."),
+            ("recv_seconds", "Time blocked reading."),
+            ("send_seconds", "Time blocked writing, including encoding."),
+            ("encode_seconds", "Time spent encoding frames."),
+            ("decode_seconds", "Time spent decoding frames."),
+            ("uncompressed_bytes", "Bytes of deflated messages, uncompressed."),
+            ("compressed_bytes", "Bytes of deflated messages, compressed."),
+            ("compression_seconds", "Time spent compressing or inflating."),
+        ]:
+            family(field, "counter", help_text)
+            for direction in (FORWARD, BACKWARD):
+                value = snapshot["totals"][direction][field]
+                lines.append(
+                    f'{prefix}_{field}_total{{direction="{direction}"}} {value}'
+                )
+                for conn in open_conns:
+                    value = conn[direction][field]
+                    lines.append(
+                        f"{prefix}_{field}_total{{"
+                        f'connection="{conn["connection"]}",'
+                        f'direction="{direction}"}} {value}'
+                    )
+        family(
+            "peak_buffered_bytes",
+            "gauge",
+            "Most bytes held between reading and writing them.",
+        )
+        for direction in (FORWARD, BACKWARD):
+            value = snapshot["totals"][direction]["peak_buffered_bytes"]
+            lines.append(
+                f'{prefix}_peak_buffered_bytes{{direction="{direction}"}} {value}'
+            )
+            for conn in open_conns:
+                value = conn[direction]["peak_buffered_bytes"]
+                lines.append(
+                    f"{prefix}_peak_buffered_bytes{{"
+                    f'connection="{conn["connection"]}",'
+                    f'direction="{direction}"}} {value}'
+                )
+        for name, help_text in [
+            (
+                "setup_latency",
+                "Time to connect a new connection to the backend.",
+            ),
+            ("reconnect_latency", "Time to replace a lost backend websocket."),
+        ]:
+            family(f"{name}_seconds", "histogram", help_text)
+            histogram = snapshot[name]
+            for bound, count in histogram["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f'{prefix}_{name}_seconds_bucket{{le="{le}"}} {count}'
+                )
+            lines.append(f"{prefix}_{name}_seconds_sum {histogram['sum']}")
+            lines.append(f"{prefix}_{name}_seconds_count {histogram['count']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Serve `metrics` over HTTP in a background thread.
+
+    `/metrics` returns the OpenMetrics text format, for scraping by a
+    monitoring agent, and `/metrics.json` returns the full snapshot.
+
+    Args:
+        metrics: The `ProxyMetrics` to serve.
+        port: The local port to listen on. Use `0` to pick a free port.
+        host: The local address to listen on.
+
+    Returns:
+        The running `http.server.ThreadingHTTPServer`. Call its `shutdown`
+        method to stop serving.
+    """
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.openmetrics().encode()
+                content_type = OPENMETRICS_CONTENT_TYPE
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(http.HTTPStatus.NOT_FOUND)
+                return
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="proxy-metrics", daemon=True
+    ).start()
+    return server
@@ -0,0 +1,316 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Multiplexing of several TCP streams over one bridge websocket.
+
+Every websocket message is a binary frame starting with a one byte frame
+type and a four byte stream id, both in network byte order:
+
+    OPEN    Opens a new stream, with the four byte flow control window both
+            directions of the stream use. Sent by the client only.
+    DATA    Carries bytes for a stream.
+    CLOSE   The sender will not send any more bytes on the stream. Once both
+            sides have sent one, the stream is gone.
+    WINDOW  Grants the sender permission to send more bytes on the stream,
+            as a four byte increment.
+
+Each direction of each stream starts with a window's worth of credit.
+A sender may only have that many unacknowledged bytes in flight, and the
+receiver grants more credit as the bytes are read from the stream, so one
+slow reader never stalls the other streams sharing the websocket.
+"""
+
+import collections
+import logging
+import socket
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Websocket subprotocol used to negotiate multiplexing with the backend.
+MUX_SUBPROTOCOL = "mux.tcp-bridge.dataproc.google.com"
+
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_CLOSE = 3
+FRAME_WINDOW = 4
+
+_HEADER = struct.Struct("!BI")
+_WINDOW_INCREMENT = struct.Struct("!I")
+
+DEFAULT_INITIAL_WINDOW = 256 * 1024
+
+
+class mux_stream(object):
+    """Socket-like object for one stream of a `MultiplexedBridge`.
+
+    Like a TCP socket, each direction of a stream is closed independently:
+    `shutdown(socket.SHUT_WR)` tells the remote side that no more bytes are
+    coming, while bytes can still be received from it.
+    """
+
+    def __init__(self, bridge, stream_id, initial_window):
+        self._bridge = bridge
+        self._stream_id = stream_id
+        self._initial_window = initial_window
+        self._cond = threading.Condition()
+        self._received = collections.deque()
+        self._buffered = 0
+        self._peak_buffered = 0
+        self._unacknowledged = 0
+        self._send_window = initial_window
+        self._remote_closed = False
+        self._read_closed = False
+        self._write_closed = False
+        self._reset = False
+
+    @property
+    def stream_id(self):
+        """The id of this stream within its bridge"""
+        return self._stream_id
+
+    @property
+    def peak_buffered_bytes(self):
+        """The most bytes received on this stream and not yet read at once.
+
+        The flow control window bounds this, however slowly the stream is
+        read.
+        """
+        return self._peak_buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def recv(self, buff_size):
+        with self._cond:
+            while not (
+                self._received or self._remote_closed or self._read_closed
+            ):
+                self._cond.wait()
+            if not self._received or self._read_closed:
+                return b""
+            chunk = self._received.popleft()
+            if len(chunk) > buff_size:
+                self._received.appendleft(chunk[buff_size:])
+                chunk = chunk[:buff_size]
+            self._buffered -= len(chunk)
+            increment = self._acknowledge(len(chunk))
+        self._send_window_update(increment)
+        return chunk
+
+    def _acknowledge(self, n):
+        self._unacknowledged += n
+        if self._unacknowledged < self._initial_window // 2:
+            return 0
+        increment = self._unacknowledged
+        self._unacknowledged = 0
+        return increment
+
+    def _send_window_update(self, increment):
+        if increment:
+            self._bridge.send_frame(
+                FRAME_WINDOW,
+                self._stream_id,
+                _WINDOW_INCREMENT.pack(increment),
+            )
+
+    def send(self, msg_bytes):
+        with self._cond:
+            while self._send_window <= 0 and not (
+                self._write_closed or self._reset
+            ):
+                self._cond.wait()
+            if self._write_closed or self._reset:
+                raise ConnectionError(f"Stream {self._stream_id} is closed")
+            n = min(len(msg_bytes), self._send_window)
+            self._send_window -= n
+        self._bridge.send_frame(FRAME_DATA, self._stream_id, msg_bytes[:n])
+        return n
+
+    def shutdown(self, how):
+        """Shut down one or both directions of the stream."""
+        send_close = False
+        with self._cond:
+            if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+                self._read_closed = True
+                self._received.clear()
+                self._buffered = 0
+            if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+                send_close = not self._write_closed
+                self._write_closed = True
+            self._cond.notify_all()
+        if send_close and not self._reset:
+            try:
+                self._bridge.send_frame(FRAME_CLOSE, self._stream_id)
+            except Exception as ex:
+                logger.debug(
+                    f"[stream-{self._stream_id}] Exception closing: {ex}"
+                )
+
+    def close(self):
+        self.shutdown(socket.SHUT_RDWR)
+        with self._cond:
+            done = self._remote_closed
+        if done:
+            self._bridge.remove_stream(self._stream_id)
+
+    def _on_data(self, payload):
+        with self._cond:
+            if not self._read_closed:
+                self._received.append(payload)
+                self._buffered += len(payload)
+                self._peak_buffered = max(self._peak_buffered, self._buffered)
+                self._cond.notify_all()
+                return
+            # Nobody will read these bytes, but the sender still gets its
+            # credit back so that it never blocks on this stream.
+            increment = self._acknowledge(len(payload))
+        self._send_window_update(increment)
+
+    def _on_window(self, increment):
+        with self._cond:
+            self._send_window += increment
+            self._cond.notify_all()
+
+    def _on_close(self, reset=False):
+        with self._cond:
+            self._remote_closed = True
+            self._reset = self._reset or reset
+            done = self._read_closed and self._write_closed
+            self._cond.notify_all()
+        if done:
+            self._bridge.remove_stream(self._stream_id)
+
+
+class MultiplexedBridge(object):
+    """Carries many TCP streams over a single websocket connection.
+
+    Args:
+        websocket_conn: A websocket connection that negotiated the
+          `MUX_SUBPROTOCOL`.
+        on_open: Called with each stream that the remote side opens. Only
+          the backend side of a connection accepts streams.
+        initial_window: The flow control window of each stream opened from
+          this side, in bytes. Streams opened by the remote side use the
+          window it asks for.
+        on_close: Called with the bridge once the websocket has closed, for
+          whatever reason, and every stream has been reset.
+    """
+
+    def __init__(
+        self,
+        websocket_conn,
+        on_open=None,
+        initial_window=DEFAULT_INITIAL_WINDOW,
+        on_close=None,
+    ):
+        self._conn = websocket_conn
+        self._on_open = on_open
+        self._on_close = on_close
+        self._initial_window = initial_window
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._next_stream_id = 1
+        self._closed = False
+        self._closed_event = threading.Event()
+        self._reader = threading.Thread(
+            target=self._read_frames, name="mux-reader", daemon=True
+        )
+        self._reader.start()
+
+    @property
+    def closed(self):
+        """Whether the underlying websocket connection has closed"""
+        return self._closed
+
+    @property
+    def stream_count(self):
+        """The number of currently open streams"""
+        with self._lock:
+            return len(self._streams)
+
+    def open_stream(self):
+        """Open a new stream to the backend."""
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("Multiplexed bridge is closed")
+            stream_id = self._next_stream_id
+            self._next_stream_id += 1
+            stream = mux_stream(self, stream_id, self._initial_window)
+            self._streams[stream_id] = stream
+        self.send_frame(
+            FRAME_OPEN, stream_id, _WINDOW_INCREMENT.pack(self._initial_window)
+        )
+        return stream
+
+    def wait_closed(self):
+        """Block until the underlying websocket connection has closed."""
+        self._closed_event.wait()
+
+    def remove_stream(self, stream_id):
+        with self._lock:
+            self._streams.pop(stream_id, None)
+
+    def send_frame(self, frame_type, stream_id, payload=b""):
+        self._conn.send(_HEADER.pack(frame_type, stream_id) + bytes(payload))
+
+    def _read_frames(self):
+        try:
+            for msg in self._conn:
+                frame_type, stream_id = _HEADER.unpack_from(msg)
+                payload = memoryview(msg)[_HEADER.size :]
+                if frame_type == FRAME_OPEN:
+                    (window,) = _WINDOW_INCREMENT.unpack(payload)
+                    self._accept_stream(stream_id, window)
+                    continue
+                with self._lock:
+                    stream = self._streams.get(stream_id)
+                if stream is None:
+                    continue
+                if frame_type == FRAME_DATA:
+                    stream._on_data(payload)
+                elif frame_type == FRAME_WINDOW:
+                    stream._on_window(_WINDOW_INCREMENT.unpack(payload)[0])
+                elif frame_type == FRAME_CLOSE:
+                    stream._on_close()
+        except Exception as ex:
+            logger.debug(f"Exception reading multiplexed frames: {ex}")
+        finally:
+            with self._lock:
+                self._closed = True
+                streams = list(self._streams.values())
+            for stream in streams:
+                stream._on_close(reset=True)
+            self._closed_event.set()
+            if self._on_close is not None:
+                self._on_close(self)
+
+    def _accept_stream(self, stream_id, window):
+        stream = mux_stream(self, stream_id, window)
+        if self._on_open is None:
+            logger.debug(f"Refusing stream {stream_id} opened by the remote")
+            stream.close()
+            return
+        with self._lock:
+            self._streams[stream_id] = stream
+        threading.Thread(
+            target=self._on_open, args=[stream], daemon=True
+        ).start()
+
+    def close(self):
+        """Close the websocket connection, and with it every stream."""
+        self._conn.close()
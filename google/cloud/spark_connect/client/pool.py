@@ -0,0 +1,168 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import logging
+import threading
+import time
+
+from websockets.protocol import State
+
+logger = logging.getLogger(__name__)
+
+# Bounds on how long the pool waits before retrying after a failed connect.
+_MIN_RETRY_DELAY = 1.0
+_MAX_RETRY_DELAY = 30.0
+
+
+class BridgeConnectionPool(object):
+    """A pool of idle, already-authenticated websocket connections.
+
+    Opening a websocket to the TCP-bridge backend costs a DNS lookup, a TCP
+    and TLS handshake and the websocket upgrade. The pool pays that cost
+    ahead of time in a background thread, so that a new local connection can
+    start forwarding bytes immediately.
+
+    Args:
+        connect: Callable that opens a new websocket connection.
+        size: The number of idle connections to keep ready.
+        max_idle: How long, in seconds, a connection may sit idle in the pool
+          before it is considered stale and closed.
+        check_interval: How often, in seconds, idle connections are checked,
+          so that ones that have died are replaced before they are needed.
+          Defaults to half of `max_idle`.
+    """
+
+    def __init__(self, connect, size=1, max_idle=60.0, check_interval=None):
+        self._connect = connect
+        self._size = size
+        self._max_idle = max_idle
+        self._check_interval = (
+            check_interval if check_interval is not None else max_idle / 2
+        )
+        self._idle = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def start(self):
+        """Start filling the pool in the background."""
+        self._thread = threading.Thread(
+            target=self._refill, name="bridge-connection-pool", daemon=True
+        )
+        self._thread.start()
+
+    def stats(self):
+        """Return the pool's hit, miss and eviction counters."""
+        with self._cond:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "idle": len(self._idle),
+            }
+
+    def _usable(self, created, conn, now):
+        return (
+            now - created < self._max_idle
+            and getattr(conn, "state", State.OPEN) is State.OPEN
+        )
+
+    def acquire(self):
+        """Take an idle connection, or open a new one if none is ready."""
+        stale = []
+        conn = None
+        with self._cond:
+            now = time.monotonic()
+            while self._idle:
+                created, candidate = self._idle.pop()
+                if self._usable(created, candidate, now):
+                    conn = candidate
+                    break
+                stale.append(candidate)
+            self._evictions += len(stale)
+            if conn is not None:
+                self._hits += 1
+            else:
+                self._misses += 1
+            self._cond.notify()
+        self._close_all(stale)
+        return conn if conn is not None else self._connect()
+
+    def _evict_stale(self):
+        with self._cond:
+            now = time.monotonic()
+            usable = [
+                (created, conn)
+                for created, conn in self._idle
+                if self._usable(created, conn, now)
+            ]
+            stale = [
+                conn
+                for created, conn in self._idle
+                if not self._usable(created, conn, now)
+            ]
+            self._idle = collections.deque(usable)
+            self._evictions += len(stale)
+        self._close_all(stale)
+
+    def _refill(self):
+        retry_delay = _MIN_RETRY_DELAY
+        while True:
+            self._evict_stale()
+            with self._cond:
+                if self._closed:
+                    return
+                if len(self._idle) >= self._size:
+                    # Wake up when a connection is taken, and often enough
+                    # to evict connections before they go stale.
+                    self._cond.wait(timeout=self._check_interval)
+                    continue
+            try:
+                conn = self._connect()
+            except Exception as ex:
+                logger.debug(f"Failed to pre-warm a bridge connection: {ex}")
+                with self._cond:
+                    self._cond.wait(timeout=retry_delay)
+                retry_delay = min(2 * retry_delay, _MAX_RETRY_DELAY)
+                continue
+            retry_delay = _MIN_RETRY_DELAY
+            with self._cond:
+                if not self._closed:
+                    self._idle.append((time.monotonic(), conn))
+                    continue
+            self._close_all([conn])
+
+    def refresh(self):
+        """Check the idle connections now, replacing any that have died."""
+        with self._cond:
+            self._cond.notify()
+
+    def _close_all(self, conns):
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception as ex:
+                logger.debug(f"Exception closing a pooled connection: {ex}")
+
+    def close(self):
+        """Stop refilling the pool and close every idle connection."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for _, conn in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        self._close_all(idle)
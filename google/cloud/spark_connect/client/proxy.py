@@ -15,52 +15,350 @@
 # limitations under the License.
 import argparse
 import contextlib
+import functools
 import logging
+import os
+import queue
+import selectors
 import socket
+import stat
 import threading
 import time
+import urllib.parse
 
 import websockets.sync.client as websocketclient
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from websockets.protocol import State
 
-from google import auth as googleauth
-from google.auth.transport import requests as googleauthrequests
+from .capture import CaptureWriter
+from .compression import (
+    COMPRESSION_ADAPTIVE,
+    COMPRESSION_MODES,
+    CompressionPolicy,
+    MeasuredPerMessageDeflate,
+)
+from .credentials import default_credential_manager
+from .endpoints import (
+    connect_fastest,
+    default_endpoint_resolver,
+    uses_http_proxy,
+)
+from .metrics import BACKWARD, FORWARD, ProxyMetrics, serve_metrics
+from .mux import DEFAULT_INITIAL_WINDOW, MUX_SUBPROTOCOL, MultiplexedBridge
+from .pool import BridgeConnectionPool
 
 parser = argparse.ArgumentParser()
 parser.add_argument("port")
 parser.add_argument("target_host")
+parser.add_argument(
+    "--unix-socket",
+    help="Listen on this Unix domain socket path instead of the local port",
+)
+parser.add_argument(
+    "--hex-frames",
+    action="store_true",
+    help="Always use hex-encoded text frames instead of negotiating binary frames",
+)
+parser.add_argument(
+    "--multiplex",
+    action="store_true",
+    help="Carry every connection over one shared websocket if supported",
+)
+parser.add_argument(
+    "--compression",
+    choices=COMPRESSION_MODES,
+    default=COMPRESSION_ADAPTIVE,
+    help="Whether websockets use permessage-deflate",
+)
+parser.add_argument(
+    "--coalesce-delay",
+    type=float,
+    help="Batch small writes, waiting up to this many seconds for more bytes",
+)
+parser.add_argument(
+    "--ping-interval",
+    type=float,
+    help="Seconds between websocket pings, used to detect dead connections",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help="Serve OpenMetrics at /metrics on this local port",
+)
+parser.add_argument(
+    "--backward-watermarks",
+    type=int,
+    nargs=2,
+    metavar=("HIGH", "LOW"),
+    help="Pause reading from the backend above HIGH buffered bytes, until LOW",
+)
+parser.add_argument(
+    "--max-connections",
+    type=int,
+    help="The most local connections to forward at once",
+)
+parser.add_argument(
+    "--accept-policy",
+    choices=["queue", "reject"],
+    default="queue",
+    help="Whether connections over the limit wait or are closed",
+)
+parser.add_argument(
+    "--idle-timeout",
+    type=float,
+    help="Close connections that carry no traffic for this many seconds",
+)
+parser.add_argument(
+    "--capture",
+    help="Write the forwarded bytes to this capture file, for replay",
+)
+parser.add_argument(
+    "--pool-size",
+    type=int,
+    default=0,
+    help="The number of pre-warmed websocket connections to keep open",
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+# Websocket subprotocol used to negotiate binary framing with the backend.
+#
+# Backends that do not recognize this subprotocol will not select it, in
+# which case we fall back to the original hex-encoded text framing.
+BINARY_FRAMES_SUBPROTOCOL = "binary.tcp-bridge.dataproc.google.com"
+
+BRIDGE_PATH = "tcp-over-websocket-bridge/35218cb7-1201-4940-89e8-48d8f03fed96"
+
+# How often, in seconds, websockets are pinged, and how long to wait for the
+# pong before the connection is considered dead. These are shorter than the
+# websockets library's defaults so that a dead bridge is noticed, and
+# replaced, before the next RPC needs it.
+DEFAULT_PING_INTERVAL = 10.0
+DEFAULT_PING_TIMEOUT = 5.0
+
+# How long, in seconds, opening a websocket to the bridge may take, from the
+# TCP connection through the end of the handshake.
+DEFAULT_OPEN_TIMEOUT = 10.0
+
+# The default high and low watermarks, in bytes, of the data buffered for
+# one direction of a connection.
+DEFAULT_WATERMARKS = (4 * 1024 * 1024, 1024 * 1024)
+
+# What the proxy does with new connections while at its connection limit:
+# leave them waiting in the listen backlog until a connection closes, or
+# accept and immediately close them.
+ACCEPT_QUEUE = "queue"
+ACCEPT_REJECT = "reject"
+
+ACCEPT_POLICIES = (ACCEPT_QUEUE, ACCEPT_REJECT)
+
+
+def check_watermarks(watermarks):
+    """Validate a `(high, low)` pair of buffering watermarks, in bytes."""
+    high, low = watermarks
+    if high <= 0 or low < 0 or low > high:
+        raise ValueError(f"Invalid watermarks: high={high}, low={low}")
+    return high, low
+
+
+class _QueuedBytes(queue.SimpleQueue):
+    """Receive queue of a websocket that reports its size in bytes.
+
+    The websockets library pauses reading from the network while the size of
+    a connection's receive queue is above the high limit of its `max_queue`
+    option, and resumes once it is down to the low limit. Measuring the queue
+    in bytes rather than frames makes those limits bound the bytes received
+    but not yet read, however large the backend's frames are.
+
+    Frames are counted as they arrive, so hex-encoded text frames count twice
+    the bytes they carry.
+
+    This relies on websockets internals, which is why setup.py bounds the
+    supported websockets versions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.peak_bytes = 0
+
+    def put(self, frame, block=True, timeout=None):
+        # The end of the stream is marked by putting `None`.
+        size = len(frame.data) if frame is not None else 0
+        with self._lock:
+            self._bytes += size
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+        super().put(frame)
+
+    def get(self, block=True, timeout=None):
+        frame = super().get(block, timeout)
+        if frame is not None:
+            with self._lock:
+                self._bytes -= len(frame.data)
+        return frame
+
+    def qsize(self):
+        return self._bytes
+
+
+class _ByteBoundedConnection(websocketclient.ClientConnection):
+    """Websocket client connection whose receive queue is bounded in bytes.
+
+    The `(high, low)` limits of the `max_queue` option are byte watermarks
+    for this connection, rather than numbers of frames.
+    """
+
+    @property
+    def recv_messages(self):
+        return self._recv_messages
+
+    @recv_messages.setter
+    def recv_messages(self, assembler):
+        # Set while the connection is created, before any frame is received.
+        assembler.frames = _QueuedBytes()
+        self._recv_messages = assembler
+
+    @property
+    def peak_queued_bytes(self):
+        """The most bytes received but not yet read at once"""
+        return self._recv_messages.frames.peak_bytes
+
+
 class bridged_socket(object):
     """Socket-like object that uses a websocket-over-TCP Bridge transport.
 
     See: https://github.com/google/inverting-proxy/tree/master/utils/tcpbridge
+
+    Bytes are carried as binary websocket frames if the backend accepted the
+    `BINARY_FRAMES_SUBPROTOCOL` during the handshake, and as hex-encoded text
+    frames otherwise.
+
+    If `metrics` is set to a `metrics.ConnectionMetrics`, the time spent
+    encoding and decoding frames, and compressing them, is recorded in it.
+
+    A websocket that fails, for example because it stopped answering pings,
+    raises `websockets.exceptions.ConnectionClosedError` and is marked as
+    `lost`, whereas a clean close reads as the end of the stream.
     """
 
-    def __init__(self, websocket_conn):
+    def __init__(self, websocket_conn, binary_frames=None):
         self._conn = websocket_conn
+        self._metrics = None
+        self._lost = False
+        if binary_frames is None:
+            binary_frames = (
+                getattr(websocket_conn, "subprotocol", None)
+                == BINARY_FRAMES_SUBPROTOCOL
+            )
+        self._binary_frames = binary_frames
+
+    @property
+    def binary_frames(self):
+        """Whether bytes are sent as binary frames rather than hex text."""
+        return self._binary_frames
+
+    @property
+    def lost(self):
+        """Whether the websocket failed rather than closing cleanly"""
+        return self._lost
+
+    @property
+    def peak_buffered_bytes(self):
+        """The most bytes waiting in the websocket's receive queue at once"""
+        return getattr(self._conn, "peak_queued_bytes", 0)
+
+    @property
+    def metrics(self):
+        """The `metrics.ConnectionMetrics` recorded for this connection"""
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._metrics = metrics
+        protocol = getattr(self._conn, "protocol", None)
+        for extension in getattr(protocol, "extensions", []):
+            if isinstance(extension, MeasuredPerMessageDeflate):
+                extension.metrics = metrics
 
     def recv(self, buff_size):
         # N.B. The websockets [recv method](https://websockets.readthedocs.io/en/stable/reference/sync/client.html#websockets.sync.client.ClientConnection.recv)
-        # does not support the buff_size parameter, but it does add a `timeout` keyword parameter not supported by normal
-        # socket objects.
+        # does not support the buff_size parameter.
         #
-        # We set that timeout to 60 seconds to prevent any scenarios where we wind up stuck waiting for a message from a websocket connection
-        # that never comes.
-        msg = self._conn.recv(timeout=60)
-        return bytes.fromhex(msg)
+        # No timeout is needed: a close from either side, including from
+        # another thread calling `close`, wakes up a blocked `recv`.
+        try:
+            msg = self._conn.recv()
+        except ConnectionClosedOK:
+            return b""
+        except ConnectionClosedError:
+            self._lost = True
+            raise
+        if not isinstance(msg, str):
+            return msg
+        start = time.perf_counter()
+        msg_bytes = bytes.fromhex(msg)
+        if self._metrics is not None:
+            self._metrics.backward.decode_seconds += time.perf_counter() - start
+        return msg_bytes
 
     def send(self, msg_bytes):
-        msg = bytes.hex(msg_bytes)
-        self._conn.send(msg)
+        if self._binary_frames:
+            msg = msg_bytes
+        else:
+            start = time.perf_counter()
+            msg = msg_bytes.hex()
+            if self._metrics is not None:
+                self._metrics.forward.encode_seconds += (
+                    time.perf_counter() - start
+                )
+        try:
+            self._conn.send(msg)
+        except ConnectionClosedError:
+            self._lost = True
+            raise
+        return len(msg_bytes)
+
+    def shutdown(self, how):
+        # Websockets cannot be half-closed, so shutting down either direction
+        # closes the connection once everything sent so far is delivered.
+        # Only a multiplexed stream can carry a half-close to the backend.
+        self._conn.close()
 
     def close(self):
         return self._conn.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-def connect_tcp_bridge(hostname):
+
+def bridge_url(hostname, use_ssl=True):
+    """The websocket URL of the TCP-bridge backend on the given host."""
+    scheme = "wss" if use_ssl else "ws"
+    return f"{scheme}://{hostname}/{BRIDGE_PATH}"
+
+
+def bridge_auth_headers(token):
+    """The headers used to authenticate with the TCP-bridge backend."""
+    return {"Authorization": f"Bearer {token}"}
+
+
+def connect_tcp_bridge(
+    hostname,
+    binary_frames=True,
+    use_ssl=True,
+    credential_manager=None,
+    multiplex=False,
+    queue_watermarks=DEFAULT_WATERMARKS,
+    compression=None,
+    ping_interval=DEFAULT_PING_INTERVAL,
+    ping_timeout=DEFAULT_PING_TIMEOUT,
+    resolver=None,
+):
     """Create a socket-like connection to the given hostname using websocket.
 
     The backend server connected to over the websocket connection must be
@@ -68,70 +366,512 @@ def connect_tcp_bridge(hostname):
 
     Args:
         hostname: The hostname of the server running the TCP-bridge backend.
+        binary_frames: Whether to offer binary framing to the backend. The
+          hex-encoded text framing is used if the backend does not accept it.
+        use_ssl: Whether to connect using `wss` rather than `ws`. Only local
+          stand-in backends should ever be connected to without SSL.
+        credential_manager: The `CredentialManager` providing the access
+          token. Defaults to the process-wide manager.
+        multiplex: Whether to offer multiplexing of several streams over the
+          connection, in preference to binary framing.
+        queue_watermarks: The `(high, low)` watermarks, in bytes, of the
+          websocket's receive queue. Reading from the network pauses while
+          more than `high` bytes are waiting to be received, and resumes once
+          no more than `low` are.
+        compression: The `compression.CompressionPolicy` deciding whether to
+          offer permessage-deflate. Defaults to the websockets library's
+          default of always offering it.
+        ping_interval: How often, in seconds, to ping the backend. `None`
+          disables pings.
+        ping_timeout: How long, in seconds, to wait for a pong before the
+          connection is closed as dead. `None` waits forever.
+        resolver: If set, the `endpoints.EndpointResolver` used to resolve
+          the hostname and race the handshake across its addresses. The
+          hostname is connected to directly when this is `None`, or when an
+          HTTP proxy is configured for it.
 
     Returns:
-        A socket-like object with `recv` and `send` methods.
+        A websocket connection to be wrapped in a `bridged_socket`, or in a
+        `mux.MultiplexedBridge` if the backend accepted multiplexing.
     """
-    path = "tcp-over-websocket-bridge/35218cb7-1201-4940-89e8-48d8f03fed96"
-    creds, _ = googleauth.default(
-        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    credential_manager = credential_manager or default_credential_manager()
+    subprotocols = []
+    if multiplex:
+        subprotocols.append(MUX_SUBPROTOCOL)
+    if binary_frames:
+        subprotocols.append(BINARY_FRAMES_SUBPROTOCOL)
+    options = {}
+    if compression is not None:
+        options.update(compression.connect_options())
+    url = bridge_url(hostname, use_ssl)
+    connect = functools.partial(
+        websocketclient.connect,
+        url,
+        additional_headers=bridge_auth_headers(credential_manager.token()),
+        subprotocols=subprotocols or None,
+        ping_interval=ping_interval,
+        ping_timeout=ping_timeout,
+        open_timeout=DEFAULT_OPEN_TIMEOUT,
+        max_queue=check_watermarks(queue_watermarks),
+        create_connection=_ByteBoundedConnection,
+        **options,
     )
-    creds.refresh(googleauthrequests.Request())
-
-    return websocketclient.connect(
-        f"wss://{hostname}/{path}",
-        additional_headers={"Authorization": f"Bearer {creds.token}"},
+    if resolver is None:
+        return connect()
+    parsed = urllib.parse.urlsplit(url)
+    port = parsed.port or (443 if use_ssl else 80)
+    if uses_http_proxy(parsed.hostname, port, use_ssl):
+        return connect()
+    return connect_fastest(
+        resolver,
+        parsed.hostname,
+        port,
+        lambda sock: connect(sock=sock),
+        lambda websocket_conn: websocket_conn.close(),
     )
 
 
-def forward_bytes(name, from_sock, to_sock):
+class MultiplexedConnector(object):
+    """Opens backend streams over one shared, multiplexed websocket.
+
+    The websocket is opened on first use. If it fails, a replacement is
+    opened in the background right away, so that the next connection does
+    not wait for it. If the backend does not accept multiplexing, this falls
+    back to a dedicated websocket per connection from then on.
+
+    Args:
+        connect: Callable that opens a new websocket connection, offering
+          the `mux.MUX_SUBPROTOCOL`.
+        metrics: An optional `metrics.ProxyMetrics` to record lost websockets
+          and the time taken to replace them in.
+        **bridge_options: Additional options for the `MultiplexedBridge`.
+    """
+
+    def __init__(self, connect, metrics=None, **bridge_options):
+        self._connect = connect
+        self._metrics = metrics
+        self._bridge_options = bridge_options
+        self._lock = threading.Lock()
+        self._bridge = None
+        self._supported = True
+        self._closed = False
+
+    @property
+    def bridge(self):
+        """The current `MultiplexedBridge`, if one has been opened"""
+        return self._bridge
+
+    def __call__(self):
+        with self._lock:
+            if not self._supported:
+                return bridged_socket(self._connect())
+            if self._bridge is None or self._bridge.closed:
+                websocket_conn = self._connect()
+                if websocket_conn.subprotocol != MUX_SUBPROTOCOL:
+                    logger.debug("The backend does not support multiplexing")
+                    self._supported = False
+                    return bridged_socket(websocket_conn)
+                self._bridge = self._open_bridge(websocket_conn)
+            bridge = self._bridge
+        return bridge.open_stream()
+
+    def _open_bridge(self, websocket_conn):
+        return MultiplexedBridge(
+            websocket_conn,
+            on_close=self._on_bridge_closed,
+            **self._bridge_options,
+        )
+
+    def _on_bridge_closed(self, bridge):
+        if self._closed:
+            return
+        logger.debug("The multiplexed bridge websocket was lost")
+        if self._metrics is not None:
+            self._metrics.connection_lost()
+        threading.Thread(
+            target=self._reconnect, name="mux-reconnect", daemon=True
+        ).start()
+
+    def _reconnect(self):
+        start = time.perf_counter()
+        with self._lock:
+            if self._closed or (
+                self._bridge is not None and not self._bridge.closed
+            ):
+                return
+            try:
+                self._bridge = self._open_bridge(self._connect())
+            except Exception as ex:
+                # The next connection tries again.
+                logger.debug(f"Failed to replace the multiplexed bridge: {ex}")
+                return
+        if self._metrics is not None:
+            self._metrics.reconnected(time.perf_counter() - start)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._bridge is not None:
+                self._bridge.close()
+
+
+class BufferPool(object):
+    """A thread-safe pool of reusable receive buffers.
+
+    Buffer sizes are powers of two between `min_size` and `max_size`, so
+    that buffers released by one connection can be reused by another rather
+    than allocating fresh `bytes` for every read.
+
+    Args:
+        min_size: The size of the smallest buffer handed out.
+        max_size: The size of the largest buffer handed out. This also bounds
+          the size of each websocket message sent to the backend.
+        max_pooled: The maximum number of idle buffers kept for each size.
+    """
+
+    def __init__(self, min_size=16 * 1024, max_size=256 * 1024, max_pooled=8):
+        if min_size <= 0 or max_size < min_size:
+            raise ValueError(
+                f"Invalid buffer sizes: min_size={min_size}, max_size={max_size}"
+            )
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_pooled = max_pooled
+        self._free = {}
+        self._lock = threading.Lock()
+
+    @property
+    def min_size(self):
+        """The size of the smallest buffer handed out by the pool"""
+        return self._min_size
+
+    @property
+    def max_size(self):
+        """The size of the largest buffer handed out by the pool"""
+        return self._max_size
+
+    def _round_size(self, size):
+        rounded = self._min_size
+        while rounded < size and rounded < self._max_size:
+            rounded *= 2
+        return min(rounded, self._max_size)
+
+    def acquire(self, size):
+        """Get a buffer of at least `size` bytes, capped at `max_size`."""
+        size = self._round_size(size)
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                return free.pop()
+        return bytearray(size)
+
+    def release(self, buf):
+        """Return a buffer to the pool so that it can be reused."""
+        with self._lock:
+            free = self._free.setdefault(len(buf), [])
+            if len(free) < self._max_pooled:
+                free.append(buf)
+
+
+default_buffer_pool = BufferPool()
+
+
+# The selector used to wait for a single socket. Unlike `select.select`, it
+# handles descriptors numbered above `FD_SETSIZE`, which a proxy with many
+# open connections reaches, and `poll` needs no kernel object per call.
+_ReadinessSelector = getattr(
+    selectors, "PollSelector", selectors.DefaultSelector
+)
+
+
+class WriteCoalescer(object):
+    """Batches small reads from a socket into fewer, larger writes.
+
+    gRPC control traffic is made of many tiny writes, and forwarding each of
+    them as its own websocket message costs a frame header and a send call
+    per write. After each read, the coalescer waits up to `delay` seconds
+    for more bytes to arrive, and forwards everything read in that time as
+    one message, up to `max_bytes`. With a `delay` of `0`, only bytes that
+    have already arrived are batched, which adds no latency.
+
+    Args:
+        delay: How long, in seconds, to wait for more bytes after a read.
+        max_bytes: Stop waiting once this many bytes have been gathered.
+    """
+
+    def __init__(self, delay=0.0, max_bytes=16 * 1024):
+        self._delay = delay
+        self._max_bytes = max_bytes
+
+    def fill(self, sock, buf, n):
+        """Read more bytes from `sock` into `buf`, after the first `n`.
+
+        Returns:
+            The number of bytes in `buf` after coalescing.
+        """
+        limit = min(len(buf), self._max_bytes)
+        if n >= limit:
+            return n
+        deadline = time.monotonic() + self._delay
+        view = memoryview(buf)
+        with _ReadinessSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            while n < limit:
+                # Once the delay is up, only bytes that are already waiting
+                # are gathered.
+                remaining = max(deadline - time.monotonic(), 0)
+                if not selector.select(remaining):
+                    break
+                more = sock.recv_into(view[n:limit])
+                if not more:
+                    # The next read reports the end of the stream.
+                    break
+                n += more
+        return n
+
+
+def create_unix_server(path, mode=0o600):
+    """Create a listening Unix domain socket that only its owner can use.
+
+    The socket file is given its permissions before the socket starts
+    listening, so no other local user can ever connect to it. A stale socket
+    file left at `path` by an earlier process is replaced.
+
+    Args:
+        path: The filesystem path of the socket.
+        mode: The permissions of the socket file.
+
+    Returns:
+        The listening socket. The caller is responsible for removing the
+        socket file once it is closed.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen()
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def remove_unix_socket(path):
+    """Remove a socket file created by `create_unix_server`, if it exists."""
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+def tune_socket(sock, tcp_nodelay=True, buffer_size=None):
+    """Set latency and buffering options on an accepted local socket.
+
+    Args:
+        sock: The socket to configure.
+        tcp_nodelay: Whether to disable Nagle's algorithm, so that small
+          writes such as gRPC pings are sent without waiting for an ACK.
+          Ignored for Unix domain sockets.
+        buffer_size: If set, the size of the kernel send and receive buffers.
+    """
+    if tcp_nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
+
+# The number of consecutive reads that use less than a quarter of the buffer
+# before the buffer is swapped for a smaller one.
+_SHRINK_AFTER_SMALL_READS = 16
+
+# How long `stop` waits for forwarding threads to exit once their
+# connections have been closed.
+_THREAD_EXIT_TIMEOUT = 1.0
+
+
+def _send_all(to_sock, data, slice_size):
+    """Send all of `data`, handing it to `to_sock` in bounded slices.
+
+    The slices are views into `data`, so large messages are written without
+    copying them first. Timeouts are retried from the last sent offset.
+
+    Returns:
+        The number of `send` calls made.
+    """
+    view = memoryview(data)
+    sends = 0
+    while view:
+        try:
+            sent = to_sock.send(view[:slice_size])
+        except TimeoutError:
+            continue
+        sends += 1
+        view = view[sent:]
+    return sends
+
+
+def _shutdown(sock, how):
+    """Shut down `sock` if it supports that, ignoring errors."""
+    shutdown = getattr(sock, "shutdown", None)
+    if shutdown is None:
+        return
+    try:
+        shutdown(how)
+    except OSError:
+        # The socket is already closed or disconnected.
+        pass
+
+
+def _abort(name, *socks):
+    """Close `socks`, waking up any thread blocked reading or writing them."""
+    for sock in socks:
+        _shutdown(sock, socket.SHUT_RDWR)
+        try:
+            sock.close()
+        except Exception as ex:
+            logger.debug(f"[{name}] Exception closing a socket: {ex}")
+
+
+def forward_bytes(
+    name,
+    from_sock,
+    to_sock,
+    buffer_pool=None,
+    coalescer=None,
+    metrics=None,
+    recorder=None,
+):
     """Continuously stream bytes from the `from_sock` to the `to_sock`.
 
-    This method terminates when either the `from_sock` is closed (causing
-    it to return a Falsy value from its `recv` method), or the first time
-    it hits an exception.
+    When the `from_sock` is closed (causing it to return a Falsy value from
+    its `recv` method), this shuts down the sending side of the `to_sock`,
+    so that the end of the stream reaches the other side promptly, and
+    returns. The first time it hits an exception, it closes both sockets so
+    that the thread forwarding in the other direction stops too.
+
+    Socket reads go into buffers borrowed from `buffer_pool`. The buffer is
+    swapped for a larger one whenever a read fills it, and for a smaller one
+    after a run of reads that use only a small part of it.
 
     This method is intended to be run in a separate thread of execution.
 
     Args:
         from_sock: A socket-like object to stream bytes from.
         to_sock: A socket-like object to stream bytes to.
+        buffer_pool: The `BufferPool` to borrow receive buffers from.
+        coalescer: An optional `WriteCoalescer` that batches small reads from
+          a real socket into fewer writes to the `to_sock`.
+        metrics: An optional `metrics.DirectionMetrics` to record the bytes
+          forwarded and the time spent blocked reading and writing in.
+        recorder: An optional function called with a copy of each chunk of
+          bytes before it is forwarded, and with empty bytes at the end of
+          the stream, such as a `capture.CaptureWriter.recorder`.
     """
-    while True:
-        try:
-            bs = from_sock.recv(1024)
-            if not bs:
+    if buffer_pool is None:
+        buffer_pool = default_buffer_pool
+    # Websocket connections deliver whole messages, so only real sockets
+    # are read into the pooled buffers.
+    use_buffers = hasattr(from_sock, "recv_into")
+    buf = buffer_pool.acquire(buffer_pool.min_size) if use_buffers else None
+    small_reads = 0
+    try:
+        while True:
+            try:
+                start = time.perf_counter()
+                if use_buffers:
+                    n = from_sock.recv_into(buf)
+                    if n and coalescer is not None:
+                        n = coalescer.fill(from_sock, buf, n)
+                    bs = memoryview(buf)[:n]
+                else:
+                    bs = from_sock.recv(buffer_pool.max_size)
+                    n = len(bs)
+                received = time.perf_counter()
+                if recorder is not None:
+                    recorder(bytes(bs))
+                if not n:
+                    _shutdown(to_sock, socket.SHUT_WR)
+                    return
+                sends = _send_all(to_sock, bs, buffer_pool.max_size)
+                if metrics is not None:
+                    metrics.recv_seconds += received - start
+                    metrics.send_seconds += time.perf_counter() - received
+                    metrics.bytes += n
+                    metrics.last_active = received
+                    metrics.frames_received += 1
+                    metrics.frames_sent += sends
+                    # Bytes still waiting in the websocket's receive queue,
+                    # or in a multiplexed stream, count too.
+                    metrics.observe_buffered(
+                        max(n, getattr(from_sock, "peak_buffered_bytes", 0))
+                    )
+                if not use_buffers:
+                    continue
+                if n == len(buf) and n < buffer_pool.max_size:
+                    small_reads = 0
+                    buffer_pool.release(buf)
+                    buf = buffer_pool.acquire(2 * n)
+                elif n < len(buf) // 4 and len(buf) > buffer_pool.min_size:
+                    small_reads += 1
+                    if small_reads >= _SHRINK_AFTER_SMALL_READS:
+                        small_reads = 0
+                        buffer_pool.release(buf)
+                        buf = buffer_pool.acquire(len(buf) // 2)
+                else:
+                    small_reads = 0
+            except TimeoutError:
+                # On timeouts during a receive, we retry the entire flow.
+                pass
+            except Exception as ex:
+                logger.debug(f"[{name}] Exception forwarding bytes: {ex}")
+                _abort(name, from_sock, to_sock)
                 return
-            while bs:
-                try:
-                    to_sock.send(bs)
-                    bs = None
-                except TimeoutError:
-                    # On timeouts during a send, we retry just the send
-                    # to make sure we don't lose any bytes.
-                    pass
-        except TimeoutError:
-            # On timeouts during a receive, we retry the entire flow.
-            pass
-        except Exception as ex:
-            logger.debug(f"[{name}] Exception forwarding bytes: {ex}")
-            to_sock.close()
-            return
+    finally:
+        if buf is not None:
+            buffer_pool.release(buf)
 
 
-def connect_sockets(conn_number, from_sock, to_sock):
+def connect_sockets(
+    conn_number,
+    from_sock,
+    to_sock,
+    buffer_pool=None,
+    coalescer=None,
+    metrics=None,
+    capture=None,
+):
     """Create a connection between the two given ports.
 
     This method continuously streams bytes in both directions between the
     given `from_sock` and `to_sock` socket-like objects.
 
+    If `metrics` is a `metrics.ConnectionMetrics`, bytes flowing from the
+    `from_sock` are recorded as its `forward` direction. If `capture` is a
+    `capture.CaptureWriter`, the bytes of both directions are written to it.
+
     The caller is responsible for creating and closing the supplied socekts.
     """
+    forward_metrics = metrics.forward if metrics is not None else None
+    backward_metrics = metrics.backward if metrics is not None else None
+    forward_recorder = backward_recorder = None
+    if capture is not None:
+        forward_recorder = capture.recorder(conn_number, FORWARD)
+        backward_recorder = capture.recorder(conn_number, BACKWARD)
     forward_name = f"{conn_number}-forward"
     t1 = threading.Thread(
         name=forward_name,
         target=forward_bytes,
-        args=[forward_name, from_sock, to_sock],
+        args=[
+            forward_name,
+            from_sock,
+            to_sock,
+            buffer_pool,
+            coalescer,
+            forward_metrics,
+            forward_recorder,
+        ],
         daemon=True,
     )
     t1.start()
@@ -139,7 +879,15 @@ def connect_sockets(conn_number, from_sock, to_sock):
     t2 = threading.Thread(
         name=backward_name,
         target=forward_bytes,
-        args=[backward_name, to_sock, from_sock],
+        args=[
+            backward_name,
+            to_sock,
+            from_sock,
+            buffer_pool,
+            coalescer,
+            backward_metrics,
+            backward_recorder,
+        ],
         daemon=True,
     )
     t2.start()
@@ -147,23 +895,64 @@ def connect_sockets(conn_number, from_sock, to_sock):
     t2.join()
 
 
-def forward_connection(conn_number, conn, addr, target_host):
+def forward_connection(
+    conn_number,
+    conn,
+    addr,
+    connect_backend,
+    buffer_pool=None,
+    coalescer=None,
+    metrics=None,
+    on_backend_lost=None,
+    capture=None,
+):
     """Create a connection to the target and forward `conn` to it.
 
-    This method creates a socket-like object holding a connection to the given
-    target host, and then continuously streams bytes in both directions between
-    `conn` and that newly created connection.
+    This method obtains a socket-like connection to the target host by
+    calling `connect_backend`, and then continuously streams bytes in both
+    directions between `conn` and that connection.
 
     Both the supplied incoming connection (`conn`) and the created outgoing
     connection are automatically closed when this method terminates.
 
+    If `metrics` is a `metrics.ProxyMetrics`, the connection's setup time
+    and traffic are recorded in it. If the backend connection is a
+    `bridged_socket` whose websocket failed, `on_backend_lost` is called
+    once the connection is closed. If `capture` is a `capture.CaptureWriter`,
+    the forwarded bytes are written to it.
+
     This method should be run inside of a daemon thread so that it will not
     block program termination.
     """
-    with conn:
-        with connect_tcp_bridge(target_host) as websocket_conn:
-            backend_socket = bridged_socket(websocket_conn)
-            connect_sockets(conn_number, conn, backend_socket)
+    conn_metrics = None
+    if metrics is not None:
+        conn_metrics = metrics.open_connection(conn_number)
+    try:
+        with conn:
+            start = time.perf_counter()
+            with connect_backend() as backend_socket:
+                if conn_metrics is not None:
+                    metrics.connection_setup(
+                        conn_metrics, time.perf_counter() - start
+                    )
+                    if isinstance(backend_socket, bridged_socket):
+                        backend_socket.metrics = conn_metrics
+                connect_sockets(
+                    conn_number,
+                    conn,
+                    backend_socket,
+                    buffer_pool,
+                    coalescer,
+                    conn_metrics,
+                    capture,
+                )
+            if getattr(backend_socket, "lost", False):
+                logger.debug(f"[{conn_number}] The bridge websocket was lost")
+                if on_backend_lost is not None:
+                    on_backend_lost()
+    finally:
+        if conn_metrics is not None:
+            metrics.close_connection(conn_metrics)
 
 
 class DataprocSessionProxy(object):
@@ -175,13 +964,172 @@ class DataprocSessionProxy(object):
 
     The tunneled requests are authenticated using the Google Application
     Default Credentials.
+
+    Args:
+        port: The local port to listen on. Use `0` to pick a free port.
+        target_host: The backend to proxy connections to.
+        binary_frames: Whether to negotiate binary websocket frames with the
+          backend instead of hex-encoded text frames.
+        use_ssl: Whether to connect to the backend using SSL.
+        unix_socket_path: If set, listen on a Unix domain socket at this path
+          instead of the local port. The socket file is only accessible to
+          the current user, so other local users cannot use the tunnel.
+        buffer_pool: The `BufferPool` used for receive buffers. Defaults to a
+          pool shared by every proxy in the process.
+        credential_manager: The `CredentialManager` used to authenticate with
+          the backend. Defaults to the process-wide manager.
+        pool_size: The number of idle, pre-warmed websocket connections to
+          keep open to the backend. `0` disables the connection pool.
+        pool_max_idle: How long, in seconds, a pre-warmed connection may stay
+          idle before it is replaced.
+        multiplex: Whether to carry every local connection over one shared
+          websocket, if the backend supports it. This takes precedence over
+          the connection pool.
+        mux_window: The per-stream flow control window, in bytes, used when
+          multiplexing.
+        tcp_nodelay: Whether to disable Nagle's algorithm on accepted local
+          connections.
+        socket_buffer_size: If set, the kernel send and receive buffer size
+          of accepted local connections.
+        coalesce_delay: If set, batch small writes from local connections,
+          waiting up to this many seconds for more bytes before forwarding
+          what was read. `0` batches only bytes that have already arrived.
+        coalesce_bytes: The most bytes to gather before forwarding them,
+          when `coalesce_delay` is set.
+        compression: Whether websockets use permessage-deflate compression:
+          `"off"`, `"always"`, or `"adaptive"` to stop compressing when
+          sampled traffic does not shrink enough, for example when the
+          results are already compressed.
+        ping_interval: How often, in seconds, websockets are pinged to detect
+          dead connections. `None` disables pings.
+        ping_timeout: How long, in seconds, to wait for a pong before closing
+          a websocket as dead.
+        backward_watermarks: The `(high, low)` watermarks, in bytes, of the
+          replies buffered from the backend. Once more than `high` bytes are
+          waiting for a slow local client, the proxy stops reading from the
+          backend until no more than `low` are. Hex-encoded frames count at
+          their encoded size. Multiplexed streams are bounded by
+          `mux_window` instead. In the forward direction each read
+          is written out before the next one, so nothing builds up there.
+        max_connections: If set, the most local connections forwarded at
+          once. This bounds the threads and bridge connections one client
+          can take up on a shared host.
+        accept_policy: What to do with new connections while
+          `max_connections` are open: `"queue"` leaves them waiting in the
+          listen backlog until a connection closes, and `"reject"` closes
+          them at once.
+        idle_timeout: If set, close connections, and their websockets, once
+          they carry no traffic in either direction for this many seconds.
+          gRPC reconnects on the next RPC, but an RPC waiting that long for
+          a reply is cut off too.
+        endpoint_resolver: The `endpoints.EndpointResolver` that caches the
+          backend's addresses and races new websockets across them, keeping
+          the first to complete its handshake. Defaults to the resolver
+          shared by every proxy in the process. `None` connects to the
+          backend's host name directly.
+        capture_path: If set, write every byte forwarded, with timestamps,
+          to a capture file at this path, for `replay` to serve later. The
+          capture holds the unencrypted session traffic.
     """
 
-    def __init__(self, port, target_host):
+    def __init__(
+        self,
+        port,
+        target_host,
+        binary_frames=True,
+        use_ssl=True,
+        unix_socket_path=None,
+        buffer_pool=None,
+        credential_manager=None,
+        pool_size=0,
+        pool_max_idle=60.0,
+        multiplex=False,
+        mux_window=DEFAULT_INITIAL_WINDOW,
+        tcp_nodelay=True,
+        socket_buffer_size=None,
+        coalesce_delay=None,
+        coalesce_bytes=16 * 1024,
+        compression=COMPRESSION_ADAPTIVE,
+        ping_interval=DEFAULT_PING_INTERVAL,
+        ping_timeout=DEFAULT_PING_TIMEOUT,
+        backward_watermarks=DEFAULT_WATERMARKS,
+        max_connections=None,
+        accept_policy=ACCEPT_QUEUE,
+        idle_timeout=None,
+        endpoint_resolver=default_endpoint_resolver,
+        capture_path=None,
+    ):
+        if max_connections is not None and max_connections < 1:
+            raise ValueError(
+                f"max_connections must be at least 1, got {max_connections}"
+            )
+        if accept_policy not in ACCEPT_POLICIES:
+            raise ValueError(
+                f"Unsupported accept policy {accept_policy!r}. "
+                f"Supported policies: {list(ACCEPT_POLICIES)}"
+            )
         self._port = port
         self._target_host = target_host
+        self._unix_socket_path = unix_socket_path
+        self._buffer_pool = buffer_pool
+        self._tcp_nodelay = tcp_nodelay
+        self._socket_buffer_size = socket_buffer_size
+        self._max_connections = max_connections
+        self._accept_policy = accept_policy
+        self._idle_timeout = idle_timeout
+        self._capture_path = capture_path
+        self._capture = None
+        self._metrics = ProxyMetrics()
+        self._compression_policy = CompressionPolicy(compression)
+        self._coalescer = None
+        if coalesce_delay is not None:
+            self._coalescer = WriteCoalescer(coalesce_delay, coalesce_bytes)
+        connect_websocket = functools.partial(
+            connect_tcp_bridge,
+            target_host,
+            binary_frames=binary_frames,
+            use_ssl=use_ssl,
+            credential_manager=credential_manager,
+            multiplex=multiplex,
+            queue_watermarks=check_watermarks(backward_watermarks),
+            compression=self._compression_policy,
+            ping_interval=ping_interval,
+            ping_timeout=ping_timeout,
+            resolver=endpoint_resolver,
+        )
+        self._open_websocket = connect_websocket
+        self._connection_pool = None
+        self._multiplexed_connector = None
+        # A websocket opened to replace one that was lost, for the next
+        # connection to use.
+        self._spare = None
+        self._spare_lock = threading.Lock()
+        if multiplex:
+            self._multiplexed_connector = MultiplexedConnector(
+                connect_websocket,
+                metrics=self._metrics,
+                initial_window=mux_window,
+            )
+            self._connect_backend = self._multiplexed_connector
+        else:
+            if pool_size > 0:
+                self._connection_pool = BridgeConnectionPool(
+                    connect_websocket,
+                    size=pool_size,
+                    max_idle=pool_max_idle,
+                    check_interval=ping_interval,
+                )
+                connect_websocket = self._connection_pool.acquire
+            self._connect_backend = lambda: bridged_socket(
+                self._take_spare() or connect_websocket()
+            )
         self._started = False
         self._killed = False
+        self._wakeup_reader = None
+        self._wakeup_writer = None
+        self._thread = None
+        self._connections = {}
+        self._connections_lock = threading.Lock()
         self._conn_number = 0
 
     @property
@@ -189,6 +1137,31 @@ class DataprocSessionProxy(object):
         """The local port the proxy is listening on"""
         return self._port
 
+    @property
+    def unix_socket_path(self):
+        """The Unix domain socket the proxy is listening on, if enabled"""
+        return self._unix_socket_path
+
+    @property
+    def connection_pool(self):
+        """The pool of pre-warmed backend connections, if enabled"""
+        return self._connection_pool
+
+    @property
+    def multiplexed_connector(self):
+        """The connector sharing one websocket between connections, if enabled"""
+        return self._multiplexed_connector
+
+    @property
+    def metrics(self):
+        """The `metrics.ProxyMetrics` recorded for proxied connections"""
+        return self._metrics
+
+    @property
+    def compression_policy(self):
+        """The `compression.CompressionPolicy` used for new websockets"""
+        return self._compression_policy
+
     def start(self, daemon=True):
         """Start the proxy.
 
@@ -198,41 +1171,237 @@ class DataprocSessionProxy(object):
         if self._started:
             raise Exception("Dataproc session proxy already started")
         self._started = True
+        if self._capture_path is not None:
+            self._capture = CaptureWriter(self._capture_path)
+        if self._connection_pool is not None:
+            self._connection_pool.start()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
         s = threading.Semaphore(value=0)
-        t = threading.Thread(target=self._run, args=[s], daemon=daemon)
-        t.start()
+        self._thread = threading.Thread(
+            target=self._run, args=[s], daemon=daemon
+        )
+        self._thread.start()
         s.acquire()
 
     def _run(self, s):
-        with socket.create_server(("127.0.0.1", self._port)) as frontend_socket:
-            if self._port == 0:
-                self._port = frontend_socket.getsockname()[1]
+        with contextlib.ExitStack() as stack:
+            if self._unix_socket_path is not None:
+                stack.callback(remove_unix_socket, self._unix_socket_path)
+                frontend_socket = stack.enter_context(
+                    create_unix_server(self._unix_socket_path)
+                )
+            else:
+                frontend_socket = stack.enter_context(
+                    socket.create_server(("127.0.0.1", self._port))
+                )
+                if self._port == 0:
+                    self._port = frontend_socket.getsockname()[1]
+            selector = stack.enter_context(selectors.DefaultSelector())
+            stack.enter_context(self._wakeup_reader)
+            stack.enter_context(self._wakeup_writer)
+            frontend_socket.setblocking(False)
+            selector.register(frontend_socket, selectors.EVENT_READ)
+            selector.register(self._wakeup_reader, selectors.EVENT_READ)
             s.release()
+            # While at the connection limit with the queue policy, the
+            # listening socket is left out of the selector, so that new
+            # connections wait in the backlog.
+            listening = True
             while not self._killed:
-                conn, addr = frontend_socket.accept()
-                # Set a timeout on how long we will allow send/recv calls to block
-                #
-                # The code that reads and writes to this connection will retry
-                # on timeouts, so this is a safe change.
-                #
-                # The chosen timeout is a very short one because it allows us
-                # to more quickly detect when a connection has been closed.
-                conn.settimeout(1)
+                if self._accept_policy == ACCEPT_QUEUE:
+                    at_limit = self._at_connection_limit()
+                    if listening and at_limit:
+                        selector.unregister(frontend_socket)
+                    elif not listening and not at_limit:
+                        selector.register(frontend_socket, selectors.EVENT_READ)
+                    listening = not at_limit
+                # Block until a connection arrives, a connection closes, or
+                # `stop` wakes us up, so an idle proxy uses no CPU and stops
+                # without delay. With an idle timeout, also wake up to reap
+                # idle connections.
+                for key, _ in selector.select(self._reap_interval()):
+                    if key.fileobj is self._wakeup_reader:
+                        self._wakeup_reader.recv(4096)
+                if self._idle_timeout is not None:
+                    self._close_idle_connections()
+                if not listening:
+                    continue
+                try:
+                    conn, addr = frontend_socket.accept()
+                except BlockingIOError:
+                    continue
+                if self._at_connection_limit():
+                    logger.debug(
+                        f"Rejected a connection from {addr}: "
+                        f"{self._max_connections} connections are open"
+                    )
+                    self._metrics.connection_rejected()
+                    conn.close()
+                    continue
+                # Connections are forwarded with blocking reads and writes.
+                # A closed connection wakes up its blocked forwarding thread
+                # immediately, so no timeouts are needed to notice it.
+                conn.setblocking(True)
+                tune_socket(conn, self._tcp_nodelay, self._socket_buffer_size)
                 logger.debug(f"Accepted a connection from {addr}...")
                 self._conn_number += 1
-                threading.Thread(
-                    target=forward_connection,
-                    args=[self._conn_number, conn, addr, self._target_host],
+                t = threading.Thread(
+                    target=self._forward_connection,
+                    args=[self._conn_number, conn, addr],
                     daemon=True,
-                ).start()
+                )
+                with self._connections_lock:
+                    self._connections[self._conn_number] = (t, conn)
+                t.start()
 
-    def stop(self):
-        """Stop the proxy."""
+    def _at_connection_limit(self):
+        if self._max_connections is None:
+            return False
+        with self._connections_lock:
+            return len(self._connections) >= self._max_connections
+
+    def _reap_interval(self):
+        if self._idle_timeout is None:
+            return None
+        return self._idle_timeout / 2
+
+    def _close_idle_connections(self):
+        for conn_number in self._metrics.idle_connections(self._idle_timeout):
+            with self._connections_lock:
+                entry = self._connections.get(conn_number)
+            if entry is None:
+                continue
+            logger.debug(f"[{conn_number}] Closing idle connection")
+            self._metrics.connection_idle_closed()
+            # Closing the local connection makes its forwarding threads
+            # close the websocket too.
+            _abort(conn_number, entry[1])
+
+    def _wake_up(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            # The proxy has already been stopped.
+            pass
+
+    def _forward_connection(self, conn_number, conn, addr):
+        try:
+            forward_connection(
+                conn_number,
+                conn,
+                addr,
+                self._connect_backend,
+                self._buffer_pool,
+                self._coalescer,
+                self._metrics,
+                self._on_backend_lost,
+                self._capture,
+            )
+        finally:
+            with self._connections_lock:
+                self._connections.pop(conn_number, None)
+            if self._max_connections is not None:
+                # Let the accept loop take a queued connection.
+                self._wake_up()
+
+    def _take_spare(self):
+        with self._spare_lock:
+            spare, self._spare = self._spare, None
+        if spare is None or spare.state is State.OPEN:
+            return spare
+        spare.close()
+        return None
+
+    def _on_backend_lost(self):
+        self._metrics.connection_lost()
+        if self._killed:
+            return
+        if self._connection_pool is not None:
+            # Whatever killed this websocket may have killed idle ones too.
+            self._connection_pool.refresh()
+        threading.Thread(
+            target=self._replace_lost_connection,
+            name="bridge-reconnect",
+            daemon=True,
+        ).start()
+
+    def _replace_lost_connection(self):
+        """Open a websocket ahead of time for the next connection to use.
+
+        gRPC reconnects as soon as it sees its connection close, so paying
+        for the websocket handshake here takes it off that path.
+        """
+        start = time.perf_counter()
+        try:
+            websocket_conn = self._open_websocket()
+        except Exception as ex:
+            logger.debug(f"Failed to replace a lost bridge connection: {ex}")
+            return
+        self._metrics.reconnected(time.perf_counter() - start)
+        with self._spare_lock:
+            old, self._spare = self._spare, websocket_conn
+            if self._killed:
+                old, self._spare = websocket_conn, None
+        if old is not None:
+            old.close()
+
+    def _open_connections(self):
+        with self._connections_lock:
+            return list(self._connections.items())
+
+    def stop(self, drain_timeout=0.0):
+        """Stop the proxy.
+
+        The proxy stops accepting connections immediately. Connections that
+        are still open are given up to `drain_timeout` seconds to finish on
+        their own, and are then closed along with their websockets. This
+        method returns once every thread started by the proxy has exited.
+
+        Args:
+            drain_timeout: How long, in seconds, to wait for open connections
+              to finish before closing them.
+
+        Returns:
+            How long the shutdown took, in seconds.
+        """
+        start = time.monotonic()
         self._killed = True
+        if self._wakeup_writer is not None:
+            self._wake_up()
+        if self._thread is not None:
+            self._thread.join()
+        deadline = start + drain_timeout
+        for _, (t, _) in self._open_connections():
+            t.join(max(deadline - time.monotonic(), 0))
+        open_connections = self._open_connections()
+        for conn_number, (_, conn) in open_connections:
+            logger.debug(f"[{conn_number}] Closing connection on proxy stop")
+            _abort(conn_number, conn)
+        if self._connection_pool is not None:
+            self._connection_pool.close()
+        if self._multiplexed_connector is not None:
+            self._multiplexed_connector.close()
+        with self._spare_lock:
+            spare, self._spare = self._spare, None
+        if spare is not None:
+            spare.close()
+        # Closing the connections wakes up their forwarding threads, so
+        # these exit promptly.
+        deadline = time.monotonic() + _THREAD_EXIT_TIMEOUT
+        for _, (t, _) in open_connections:
+            t.join(max(deadline - time.monotonic(), 0))
+        if self._capture is not None:
+            self._capture.close()
+        duration = time.monotonic() - start
+        logger.debug(
+            f"Proxy on port {self._port} stopped in {duration * 1e3:.1f} ms, "
+            f"closing {len(open_connections)} open connections"
+        )
+        return duration
 
 
 @contextlib.contextmanager
-def dataproc_session_proxy(port, target_host):
+def dataproc_session_proxy(port, target_host, **kwargs):
     """Context manager for creating a Dataproc Session proxy.
 
     Usage:
@@ -243,11 +1412,12 @@ def dataproc_session_proxy(port, target_host):
     Args:
         port: The local port to listen on. Use `0` to pick a free port.
         target_host: The backend to proxy connections to.
+        **kwargs: Additional options passed to `DataprocSessionProxy`.
 
     Returns:
         A context manager wrapping a DataprocSessionProxy instance.
     """
-    proxy = DataprocSessionProxy(port, target_host)
+    proxy = DataprocSessionProxy(port, target_host, **kwargs)
     try:
         proxy.start(daemon=False)
         yield proxy
@@ -257,10 +1427,37 @@ def dataproc_session_proxy(port, target_host):
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    with dataproc_session_proxy(int(args.port), args.target_host) as p:
-        print(f"Proxy listening on port {p.port}")
+    with dataproc_session_proxy(
+        int(args.port),
+        args.target_host,
+        unix_socket_path=args.unix_socket,
+        binary_frames=not args.hex_frames,
+        pool_size=args.pool_size,
+        multiplex=args.multiplex,
+        coalesce_delay=args.coalesce_delay,
+        compression=args.compression,
+        ping_interval=args.ping_interval or DEFAULT_PING_INTERVAL,
+        backward_watermarks=args.backward_watermarks or DEFAULT_WATERMARKS,
+        max_connections=args.max_connections,
+        accept_policy=args.accept_policy,
+        idle_timeout=args.idle_timeout,
+        capture_path=args.capture,
+    ) as p:
+        if p.unix_socket_path is not None:
+            print(f"Proxy listening on {p.unix_socket_path}")
+        else:
+            print(f"Proxy listening on port {p.port}")
+        metrics_server = None
+        if args.metrics_port is not None:
+            metrics_server = serve_metrics(p.metrics, args.metrics_port)
+            metrics_port = metrics_server.server_address[1]
+            print(f"Serving metrics at http://127.0.0.1:{metrics_port}/metrics")
         try:
-            while True:
-                pass
+            # Sleep until interrupted, rather than spinning; the proxy's own
+            # threads block on their sockets.
+            threading.Event().wait()
         except KeyboardInterrupt:
             pass
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        print(p.metrics.openmetrics(), end="")
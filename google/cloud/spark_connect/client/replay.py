@@ -0,0 +1,260 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serves a captured session to a Spark Connect client, without a session.
+
+The proxy's capture mode records the bytes of every connection. This tool
+plays back the backend's side of those connections behind a local stand-in
+bridge and a session proxy, so that re-running the captured client code
+against it exercises the client, the proxy, and Arrow decoding the same way
+every time.
+
+The Nth connection to the replay is served the Nth captured connection.
+Each recorded reply is sent once the client has sent as many bytes as it
+had before that reply was recorded, or after `sync_timeout` seconds, so the
+client must repeat the captured workload, from creating the session on.
+
+Usage:
+    python -m google.cloud.spark_connect.client.replay CAPTURE [--pace]
+
+This prints an `sc://` URL to pass to `SparkSession.builder.remote`.
+"""
+
+import argparse
+import collections
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+from google.oauth2 import credentials as oauth2credentials
+
+from .bridge import local_tcp_bridge
+from .capture import read_capture
+from .credentials import CredentialManager
+from .metrics import BACKWARD
+from .proxy import DataprocSessionProxy
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("capture", help="The capture file to serve")
+parser.add_argument(
+    "--port", type=int, default=0, help="The local port of the proxy"
+)
+parser.add_argument(
+    "--pace",
+    action="store_true",
+    help="Wait as long as the backend took before sending each reply",
+)
+parser.add_argument(
+    "--sync-timeout",
+    type=float,
+    default=1.0,
+    help="The longest to wait for the client's request before each reply",
+)
+
+# How long to wait for the client to close a connection once every recorded
+# reply has been sent.
+_CLOSE_TIMEOUT = 5.0
+
+
+def load_connections(path):
+    """Read a capture file into the records of each connection.
+
+    Returns:
+        A list with the `capture.CaptureRecord`s of each connection, in the
+        order the connections were opened.
+    """
+    connections = collections.OrderedDict()
+    for record in read_capture(path):
+        connections.setdefault(record.connection, []).append(record)
+    return list(connections.values())
+
+
+class _ClientReader(object):
+    """Counts the bytes a client sends, discarding them."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._condition = threading.Condition()
+        self._received = 0
+        self._closed = False
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self._conn.recv(64 * 1024)
+                if not data:
+                    break
+                with self._condition:
+                    self._received += len(data)
+                    self._condition.notify_all()
+        except OSError:
+            pass
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def wait_for(self, count, timeout):
+        """Wait until `count` bytes have arrived, or the client closed."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._received >= count or self._closed, timeout
+            )
+
+
+class ReplayServer(object):
+    """A TCP server playing back the backend side of captured connections.
+
+    Args:
+        path: The capture file to serve.
+        pace: Whether to wait, before sending each reply, as long as the
+          backend took to send it after the preceding request bytes.
+        sync_timeout: The longest to wait, in seconds, for the client to
+          send the request bytes preceding each reply.
+    """
+
+    def __init__(self, path, pace=False, sync_timeout=1.0):
+        self._connections = load_connections(path)
+        self._pace = pace
+        self._sync_timeout = sync_timeout
+        self._server = None
+        self._served = 0
+
+    @property
+    def address(self):
+        """The `(host, port)` the server listens on"""
+        return self._server.getsockname()
+
+    def start(self):
+        """Start serving.
+
+        By the time this method returns the server accepts connections.
+        """
+        if self._server is not None:
+            raise Exception("Replay server already started")
+        self._server = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                # The server was stopped.
+                return
+            if self._served >= len(self._connections):
+                logger.debug("No captured connections left to replay")
+                conn.close()
+                continue
+            records = self._connections[self._served]
+            self._served += 1
+            threading.Thread(
+                target=self._serve, args=[conn, records], daemon=True
+            ).start()
+
+    def _serve(self, conn, records):
+        with conn:
+            reader = _ClientReader(conn)
+            expected = 0
+            last_request = None
+            try:
+                for record in records:
+                    if record.direction != BACKWARD:
+                        expected += len(record.data)
+                        last_request = record.timestamp
+                        continue
+                    if not reader.wait_for(expected, self._sync_timeout):
+                        logger.debug(
+                            f"Replying after waiting {self._sync_timeout}s "
+                            f"for {expected} request bytes"
+                        )
+                    if self._pace and last_request is not None:
+                        time.sleep(max(record.timestamp - last_request, 0))
+                        last_request = None
+                    if record.data:
+                        conn.sendall(record.data)
+                    else:
+                        conn.shutdown(socket.SHUT_WR)
+                reader.wait_for(float("inf"), _CLOSE_TIMEOUT)
+            except OSError as ex:
+                logger.debug(f"Replayed connection failed: {ex}")
+
+    def stop(self):
+        """Stop accepting connections."""
+        if self._server is not None:
+            with contextlib.suppress(OSError):
+                self._server.shutdown(socket.SHUT_RDWR)
+            self._server.close()
+
+
+@contextlib.contextmanager
+def replay_session(path, port=0, pace=False, sync_timeout=1.0, **proxy_options):
+    """Serve a capture behind a local bridge and a session proxy.
+
+    Usage:
+        with replay_session("session.cap") as p:
+            spark = SparkSession.builder.remote(
+                f"sc://localhost:{p.port}"
+            ).create()
+            ...
+
+    Args:
+        path: The capture file to serve.
+        port: The local port of the proxy. Use `0` to pick a free port.
+        pace: Whether to reproduce the backend's recorded reply delays.
+        sync_timeout: The longest to wait for each request, in seconds.
+        **proxy_options: Options passed to `DataprocSessionProxy`.
+
+    Yields:
+        The started `DataprocSessionProxy`.
+    """
+    server = ReplayServer(path, pace, sync_timeout)
+    server.start()
+    credential_manager = CredentialManager(
+        credentials=oauth2credentials.Credentials("replay-token")
+    )
+    try:
+        with local_tcp_bridge(server.address) as bridge:
+            p = DataprocSessionProxy(
+                port,
+                bridge.host,
+                use_ssl=False,
+                credential_manager=credential_manager,
+                **proxy_options,
+            )
+            p.start()
+            try:
+                yield p
+            finally:
+                p.stop()
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with replay_session(
+        args.capture,
+        pace=args.pace,
+        sync_timeout=args.sync_timeout,
+        port=args.port,
+    ) as p:
+        print(f"Replaying {args.capture} at sc://localhost:{p.port}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -20,7 +20,7 @@ import string
 import time
 import datetime
 from time import sleep
-from typing import Any, cast, ClassVar, Dict, Optional
+from typing import Any, cast, ClassVar, Dict, List, Optional, Tuple
 
 from google.api_core import retry
 from google.api_core.future.polling import POLLING_PREDICATE
@@ -29,6 +29,18 @@ from google.api_core.exceptions import FailedPrecondition, InvalidArgument, NotF
 from google.cloud.dataproc_v1.types import sessions
 
 from google.cloud.spark_connect.client import DataprocChannelBuilder
+from google.cloud.spark_connect.client.compression import COMPRESSION_MODES
+from google.cloud.spark_connect.client.core import (
+    GRPC_COMPRESSION_ALGORITHMS,
+    POOL_LEAST_LOADED,
+    POOL_POLICIES,
+    TRANSPORT_PROXY,
+    TRANSPORTS,
+    channel_options_from_params,
+)
+from google.cloud.spark_connect.client.credentials import (
+    default_credential_manager,
+)
 from google.cloud.dataproc_v1 import (
     CreateSessionRequest,
     GetSessionRequest,
@@ -90,6 +102,11 @@ class GoogleSparkSession(SparkSession):
         def __init__(self):
             self._options: Dict[str, Any] = {}
             self._channel_builder: Optional[DataprocChannelBuilder] = None
+            self._proxy_options: Dict[str, Any] = {}
+            self._channel_options: List[Tuple[str, Any]] = []
+            self._transport = TRANSPORT_PROXY
+            self._pool_size = 1
+            self._pool_policy = POOL_LEAST_LOADED
             self._dataproc_config: Optional[Session] = None
             self._project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
             self._region = os.environ.get("GOOGLE_CLOUD_REGION")
@@ -128,6 +145,128 @@ class GoogleSparkSession(SparkSession):
                     self._options[cast(str, k)] = to_str(v)
                 return self
 
+        def websocketCompression(self, mode: str):
+            """Set whether the session proxy compresses its websockets.
+
+            `mode` is `"off"`, `"always"`, or `"adaptive"` (the default),
+            which stops compressing when the traffic does not shrink enough.
+            """
+            if mode not in COMPRESSION_MODES:
+                raise ValueError(
+                    f"Unsupported compression mode {mode!r}. "
+                    f"Supported modes: {list(COMPRESSION_MODES)}"
+                )
+            self._proxy_options["compression"] = mode
+            return self
+
+        def captureTraffic(self, path: str):
+            """Record the session's traffic through the proxy to `path`.
+
+            The capture holds every byte exchanged with the session, and can
+            be served without a session by
+            `python -m google.cloud.spark_connect.client.replay`.
+            """
+            self._proxy_options["capture_path"] = path
+            return self
+
+        def transport(self, transport: str):
+            """Set how the client reaches the session.
+
+            `transport` is `"proxy"` (the default), which tunnels the gRPC
+            connection through a local proxy and a websocket, or `"direct"`,
+            which connects to the session with an authenticated gRPC channel
+            and falls back to the proxy if that cannot connect.
+            """
+            if transport not in TRANSPORTS:
+                raise ValueError(
+                    f"Unsupported transport {transport!r}. "
+                    f"Supported transports: {list(TRANSPORTS)}"
+                )
+            self._transport = transport
+            return self
+
+        def channelPool(self, size: int, policy: str = POOL_LEAST_LOADED):
+            """Spread the session's RPCs over `size` gRPC channels.
+
+            Each channel has its own connection, and through the proxy its
+            own websocket, so queries run concurrently from several threads
+            are not limited to the bandwidth of one. `policy` is
+            `"least_loaded"` (the default), which sends each RPC over the
+            channel with the fewest RPCs in flight, or `"round_robin"`.
+            """
+            if size < 1:
+                raise ValueError(f"The pool size must be positive, got {size}")
+            if policy not in POOL_POLICIES:
+                raise ValueError(
+                    f"Unsupported pool policy {policy!r}. "
+                    f"Supported policies: {list(POOL_POLICIES)}"
+                )
+            self._pool_size = size
+            self._pool_policy = policy
+            return self
+
+        def channelOption(self, key: str, value: Any):
+            """Set an option of the session's gRPC channel.
+
+            The option applies whichever transport is used, as the proxy
+            forwards the gRPC connection unchanged. See the gRPC core
+            documentation of `grpc_arg_keys.h` for the available options.
+            """
+            self._channel_options.append((key, value))
+            return self
+
+        def maxMessageSize(self, size: int):
+            """Set the largest gRPC message, in bytes, sent or received."""
+            self._channel_options.extend(
+                channel_options_from_params({"grpc_max_message_size": size})
+            )
+            return self
+
+        def keepAlive(self, interval: float, timeout: float = 20.0):
+            """Ping the session every `interval` seconds while idle.
+
+            The connection is closed if a ping is not acknowledged within
+            `timeout` seconds. Servers close connections that ping more
+            often than they permit, every five minutes by default for
+            grpc-java servers.
+            """
+            self._channel_options.extend(
+                channel_options_from_params(
+                    {
+                        "grpc_keepalive_time_ms": int(interval * 1000),
+                        "grpc_keepalive_timeout_ms": int(timeout * 1000),
+                    }
+                )
+            )
+            return self
+
+        def flowControlWindow(self, size: int):
+            """Set the initial HTTP/2 flow control window of each RPC.
+
+            gRPC grows the window from there as it measures the connection,
+            so a larger initial window mostly speeds up the start of large
+            results over connections with a long round trip.
+            """
+            self._channel_options.extend(
+                channel_options_from_params({"grpc_window_size": size})
+            )
+            return self
+
+        def grpcCompression(self, algorithm: str):
+            """Set how the client compresses the gRPC messages it sends.
+
+            `algorithm` is `"none"` (the default), `"deflate"` or `"gzip"`.
+            """
+            if algorithm not in GRPC_COMPRESSION_ALGORITHMS:
+                raise ValueError(
+                    f"Unsupported gRPC compression {algorithm!r}. "
+                    f"Supported algorithms: {list(GRPC_COMPRESSION_ALGORITHMS)}"
+                )
+            self._channel_options.extend(
+                channel_options_from_params({"grpc_compression": algorithm})
+            )
+            return self
+
         def remote(self, url: Optional[str] = None) -> "SparkSession.Builder":
             if url:
                 raise NotImplemented(
@@ -154,7 +293,14 @@ class GoogleSparkSession(SparkSession):
             spark_connect_url = spark_connect_url.replace("https", "sc")
             url = f"{spark_connect_url.replace('.com/', '.com:443/')};session_id={session_response.uuid};use_ssl=true"
             logger.debug(f"Spark Connect URL: {url}")
-            self._channel_builder = DataprocChannelBuilder(url)
+            self._channel_builder = DataprocChannelBuilder(
+                url,
+                channelOptions=self._channel_options,
+                proxy_options=self._proxy_options,
+                transport=self._transport,
+                pool_size=self._pool_size,
+                pool_policy=self._pool_policy,
+            )
 
             assert self._channel_builder is not None
             session = GoogleSparkSession(connection=self._channel_builder)
@@ -231,7 +377,8 @@ class GoogleSparkSession(SparkSession):
                             )
                         )
                     operation = SessionControllerClient(
-                        client_options=self._client_options
+                        client_options=self._client_options,
+                        credentials=default_credential_manager().credentials,
                     ).create_session(session_request)
                     print(
                         f"Interactive Session Detail View:  https://console.cloud.google.com/dataproc/interactive/{self._region}/{session_id}"
@@ -287,7 +434,8 @@ class GoogleSparkSession(SparkSession):
             state = None
             try:
                 get_session_response = SessionControllerClient(
-                    client_options=self._client_options
+                    client_options=self._client_options,
+                    credentials=default_credential_manager().credentials,
                 ).get_session(get_session_request)
                 state = get_session_response.state
             except Exception as e:
@@ -378,7 +526,8 @@ class GoogleSparkSession(SparkSession):
                 get_session_template_request = GetSessionTemplateRequest()
                 get_session_template_request.name = session_template
                 client = SessionTemplateControllerClient(
-                    client_options=self._client_options
+                    client_options=self._client_options,
+                    credentials=default_credential_manager().credentials,
                 )
                 try:
                     session_template = client.get_session_template(
@@ -524,7 +673,10 @@ def terminate_s8s_session(
     terminate_session_request.name = session_name
     state = None
     try:
-        session_client = SessionControllerClient(client_options=client_options)
+        session_client = SessionControllerClient(
+            client_options=client_options,
+            credentials=default_credential_manager().credentials,
+        )
         session_client.terminate_session(terminate_session_request)
         get_session_request = GetSessionRequest()
         get_session_request.name = session_name
@@ -31,7 +31,7 @@ setup(
         "google-api-core>=2.19.1",
         "google-cloud-dataproc>=5.15.1",
         "wheel",
-        "websockets",
+        "websockets>=14.0,<18",
         "pyspark>=3.5",
         "pandas",
         "pyarrow",
@@ -0,0 +1,358 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the direct and proxied gRPC channels to a session.
+
+Both channels reach the same local gRPC server, which stands in for the
+Spark Connect server. The direct channel is created by
+`DataprocChannelBuilder` and connects with local channel credentials and an
+access token, while the proxied channel goes through the session proxy and
+a local stand-in TCP bridge.
+
+Each transport reports the round trip time of small unary RPCs, on their
+own and while a download streams over the same channel, and the throughput
+of the download. The download goes through the `ExecutePlan` method, so the
+proxied channel carries it on its bulk lane; the `proxy-one-lane` transport
+is the proxied channel with both lanes on one connection.
+
+With `--pool-size`, each transport uses a pool of that many channels, and
+`--threads` downloads run at once to measure the aggregate throughput.
+
+Connection string parameters setting gRPC channel options, such as
+`grpc_window_size`, can be passed with `--param` to compare their effect on
+large results.
+
+Usage:
+    python -m tests.benchmark.channel_benchmark --output channels.json
+    python -m tests.benchmark.channel_benchmark --param grpc_window_size=8388608
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import platform
+import statistics
+import struct
+import threading
+import time
+from concurrent import futures
+from unittest import mock
+
+import grpc
+import pyspark.sql.connect.proto as pb2
+from google.oauth2 import credentials as oauth2credentials
+
+from google.cloud.spark_connect.client import credentials
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.core import (
+    ChannelPool,
+    DataprocChannelBuilder,
+    ProxiedChannel,
+    channel_options_from_params,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--megabytes", type=int, default=64)
+parser.add_argument("--rounds", type=int, default=3)
+parser.add_argument("--rpcs", type=int, default=2000)
+parser.add_argument(
+    "--transport",
+    action="append",
+    choices=["direct", "proxy", "proxy-one-lane"],
+    help="Only benchmark the named transport. May be repeated.",
+)
+parser.add_argument(
+    "--pool-size",
+    type=int,
+    default=1,
+    help="The number of channels, each with its own connection",
+)
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=4,
+    help="The number of downloads run at once",
+)
+parser.add_argument(
+    "--param",
+    action="append",
+    default=[],
+    metavar="NAME=VALUE",
+    help="A connection string parameter setting a channel option. "
+    "May be repeated.",
+)
+parser.add_argument("--output", help="Write the results to this JSON file")
+
+_REQUEST = struct.Struct("!Q")
+# The size of each streamed message, well below gRPC's message size limit.
+_MESSAGE = bytes(range(256)) * 4096
+
+# The download method, named like the Spark Connect result stream.
+_DOWNLOAD = "/spark.connect.SparkConnectService/ExecutePlan"
+
+
+def _echo(request, context):
+    return request
+
+
+def _analyze(request, context):
+    # Answers the direct channel's probe, which asks for the Spark version.
+    return pb2.AnalyzePlanResponse(
+        session_id=request.session_id,
+        spark_version=pb2.AnalyzePlanResponse.SparkVersion(version="3.5.0"),
+    )
+
+
+def _download(request, context):
+    (remaining,) = _REQUEST.unpack(request)
+    while remaining > 0:
+        message = _MESSAGE[:remaining]
+        remaining -= len(message)
+        yield message
+
+
+@contextlib.contextmanager
+def spark_connect_stand_in():
+    """Run a local gRPC server with echo, download and Spark version methods.
+
+    Yields:
+        The port accepting local channel credentials, and the address
+        accepting plaintext connections, for the bridge.
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "benchmark.StandIn",
+                {
+                    "Echo": grpc.unary_unary_rpc_method_handler(_echo),
+                },
+            ),
+            grpc.method_handlers_generic_handler(
+                "spark.connect.SparkConnectService",
+                {
+                    "ExecutePlan": grpc.unary_stream_rpc_method_handler(
+                        _download
+                    ),
+                    "AnalyzePlan": grpc.unary_unary_rpc_method_handler(
+                        _analyze,
+                        request_deserializer=pb2.AnalyzePlanRequest.FromString,
+                        response_serializer=(
+                            pb2.AnalyzePlanResponse.SerializeToString
+                        ),
+                    ),
+                },
+            ),
+        ]
+    )
+    secure_port = server.add_secure_port(
+        "127.0.0.1:0", grpc.local_server_credentials()
+    )
+    plaintext_port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    try:
+        yield secure_port, ("127.0.0.1", plaintext_port)
+    finally:
+        server.stop(None)
+
+
+@contextlib.contextmanager
+def channel(transport, params=(), pool_size=1):
+    """Create a channel to the stand-in with the given transport.
+
+    Args:
+        transport: The transport benchmarked.
+        params: `NAME=VALUE` connection string parameters of the channel.
+        pool_size: The number of channels in the channel's pool.
+    """
+    credential_manager = credentials.CredentialManager(
+        credentials=oauth2credentials.Credentials("benchmark-token")
+    )
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(
+            mock.patch.object(
+                credentials, "_default_credential_manager", credential_manager
+            )
+        )
+        secure_port, plaintext_address = stack.enter_context(
+            spark_connect_stand_in()
+        )
+        if transport == "direct":
+            builder = DataprocChannelBuilder(
+                f"sc://127.0.0.1:{secure_port}/;" + ";".join(params),
+                transport=transport,
+                pool_size=pool_size,
+            )
+            yield stack.enter_context(builder.toChannel())
+        else:
+            # The proxy reaches the bridge on its own port, which a Spark
+            # Connect URL cannot express, so the channel is created the way
+            # `DataprocChannelBuilder` would create it for a session host.
+            bridge = stack.enter_context(local_tcp_bridge(plaintext_address))
+            options = channel_options_from_params(
+                dict(param.split("=", 1) for param in params)
+            )
+            if pool_size > 1:
+                # As in `DataprocChannelBuilder`, pooled channels do not
+                # share connections.
+                options.append(("grpc.use_local_subchannel_pool", 1))
+            channels = [
+                ProxiedChannel(
+                    bridge.host,
+                    separate_lanes=transport != "proxy-one-lane",
+                    channel_options=options,
+                    use_ssl=False,
+                    credential_manager=credential_manager,
+                )
+                for _ in range(pool_size)
+            ]
+            if pool_size == 1:
+                yield stack.enter_context(channels[0])
+            else:
+                yield stack.enter_context(ChannelPool(channels))
+
+
+def measure_rpc_latency(ch, rpcs):
+    """Time `rpcs` small unary round trips.
+
+    Returns:
+        The median and 99th percentile round trip times, in seconds.
+    """
+    echo = ch.unary_unary("/benchmark.StandIn/Echo")
+    round_trips = []
+    for _ in range(rpcs):
+        start = time.perf_counter()
+        echo(b"ping", timeout=10)
+        round_trips.append(time.perf_counter() - start)
+    percentiles = statistics.quantiles(round_trips, n=100)
+    return statistics.median(round_trips), percentiles[98]
+
+
+def measure_loaded_rpc_latency(ch, rpcs, size):
+    """Time `rpcs` small unary round trips while downloads stream.
+
+    Returns:
+        The median and 99th percentile round trip times, in seconds.
+    """
+    download = ch.unary_stream(_DOWNLOAD)
+    stop = threading.Event()
+
+    def keep_downloading():
+        while not stop.is_set():
+            for _ in download(_REQUEST.pack(size)):
+                if stop.is_set():
+                    break
+
+    downloader = threading.Thread(target=keep_downloading)
+    downloader.start()
+    try:
+        return measure_rpc_latency(ch, rpcs)
+    finally:
+        stop.set()
+        downloader.join()
+
+
+def measure_download(ch, size, rounds):
+    """Stream `size` bytes `rounds` times and return the best MB/s."""
+    download = ch.unary_stream(_DOWNLOAD)
+    best = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        received = sum(len(m) for m in download(_REQUEST.pack(size)))
+        elapsed = time.perf_counter() - start
+        assert received == size
+        best = max(best, size / elapsed / 1e6)
+    return best
+
+
+def measure_concurrent_download(ch, size, threads):
+    """Stream `size` bytes in each of `threads` threads at once.
+
+    Returns:
+        The aggregate MB/s.
+    """
+    download = ch.unary_stream(_DOWNLOAD)
+    received = [0] * threads
+
+    def run(i):
+        received[i] = sum(len(m) for m in download(_REQUEST.pack(size)))
+
+    workers = [threading.Thread(target=run, args=[i]) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    assert received == [size] * threads
+    return size * threads / elapsed / 1e6
+
+
+def run_transport(transport, args):
+    """Benchmark one transport and return its metrics."""
+    with channel(transport, args.param, args.pool_size) as ch:
+        # The first RPC opens the connection, so it is not timed.
+        ch.unary_unary("/benchmark.StandIn/Echo")(b"ping", timeout=10)
+        rtt_p50, rtt_p99 = measure_rpc_latency(ch, args.rpcs)
+        loaded_p50, loaded_p99 = measure_loaded_rpc_latency(
+            ch, args.rpcs, args.megabytes * 1024 * 1024
+        )
+        throughput = measure_download(
+            ch, args.megabytes * 1024 * 1024, args.rounds
+        )
+        concurrent = measure_concurrent_download(
+            ch, args.megabytes * 1024 * 1024, args.threads
+        )
+    return {
+        "throughput_mb_s": throughput,
+        "concurrent_mb_s": concurrent,
+        "rtt_ms_p50": rtt_p50 * 1e3,
+        "rtt_ms_p99": rtt_p99 * 1e3,
+        "loaded_rtt_ms_p50": loaded_p50 * 1e3,
+        "loaded_rtt_ms_p99": loaded_p99 * 1e3,
+    }
+
+
+def main(args):
+    results = {
+        "config": {
+            "megabytes": args.megabytes,
+            "rounds": args.rounds,
+            "rpcs": args.rpcs,
+            "params": args.param,
+            "pool_size": args.pool_size,
+            "threads": args.threads,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "transports": {},
+    }
+    for transport in args.transport or ["direct", "proxy", "proxy-one-lane"]:
+        metrics = run_transport(transport, args)
+        results["transports"][transport] = metrics
+        print(
+            f"{transport:>14}: {metrics['throughput_mb_s']:8.1f} MB/s,"
+            f" {metrics['concurrent_mb_s']:8.1f} MB/s concurrent,"
+            f" {metrics['rtt_ms_p50']:6.3f} ms RTT p50,"
+            f" {metrics['rtt_ms_p99']:6.3f} ms RTT p99,"
+            f" {metrics['loaded_rtt_ms_p50']:6.3f} ms RTT p50 under load"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    main(parser.parse_args())
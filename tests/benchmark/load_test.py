@@ -0,0 +1,235 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Load test for the Dataproc session proxy.
+
+Opens N concurrent connections through the proxy and pushes mixed traffic
+over them: a fraction of the connections repeatedly download large results,
+and the rest send a stream of small RPCs. For each N this reports aggregate
+throughput, RPC latency percentiles, and the thread count and resident
+memory of the process running the proxy.
+
+The stand-in bridge and download server run in a child process, so that the
+threads and memory they use are not counted against the proxy. The load is
+generated from a single asyncio event loop for the same reason.
+
+Usage:
+    python -m tests.benchmark.load_test --streams 1 10 100 1000
+    python -m tests.benchmark.load_test --engine asyncio --output load.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from google.oauth2 import credentials as oauth2credentials
+
+from google.cloud.spark_connect.client.asyncio_proxy import (
+    AsyncioSessionProxy,
+)
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.credentials import CredentialManager
+from google.cloud.spark_connect.client.proxy import DataprocSessionProxy
+
+from .proxy_benchmark import _REQUEST, download_server
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--streams", type=int, nargs="+", default=[1, 10, 100])
+parser.add_argument("--duration", type=float, default=5.0)
+parser.add_argument(
+    "--bulk-fraction",
+    type=float,
+    default=0.1,
+    help="The fraction of connections downloading bulk results",
+)
+parser.add_argument("--bulk-kilobytes", type=int, default=1024)
+parser.add_argument("--rpc-bytes", type=int, default=64)
+parser.add_argument(
+    "--engine", choices=["threads", "asyncio"], default="threads"
+)
+parser.add_argument("--multiplex", action="store_true")
+parser.add_argument("--output", help="Write the results to this JSON file")
+parser.add_argument(
+    "--serve-backend",
+    action="store_true",
+    help=argparse.SUPPRESS,
+)
+
+
+def _rss_bytes():
+    """The current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux, so fall back to the peak RSS, reported in KiB.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve_backend():
+    """Run a download server behind a stand-in bridge until stdin closes."""
+    _raise_file_limit()
+    with download_server() as address:
+        with local_tcp_bridge(address) as bridge:
+            print(bridge.host, flush=True)
+            sys.stdin.read()
+
+
+@contextlib.contextmanager
+def backend_process():
+    """Run `serve_backend` in a child process and yield the bridge host."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", __spec__.name, "--serve-backend"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        yield process.stdout.readline().strip()
+    finally:
+        process.stdin.close()
+        process.wait()
+
+
+async def _read_response(reader, writer, size):
+    writer.write(_REQUEST.pack(size))
+    await writer.drain()
+    await reader.readexactly(size)
+
+
+async def _run_stream(port, bulk, args, deadline, stats):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    size = args.bulk_kilobytes * 1024 if bulk else args.rpc_bytes
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            await _read_response(reader, writer, size)
+            elapsed = time.perf_counter() - start
+            stats["bytes"] += size
+            if not bulk:
+                stats["rpc_seconds"].append(elapsed)
+    except (ConnectionError, asyncio.IncompleteReadError) as ex:
+        stats["errors"] += 1
+        logging.debug(f"Load test stream failed: {ex}")
+    finally:
+        writer.close()
+
+
+async def _generate_load(port, streams, args, sample):
+    stats = {"bytes": 0, "rpc_seconds": [], "errors": 0}
+    bulk_streams = round(streams * args.bulk_fraction)
+    deadline = time.monotonic() + args.duration
+    tasks = [
+        asyncio.create_task(
+            _run_stream(port, i < bulk_streams, args, deadline, stats)
+        )
+        for i in range(streams)
+    ]
+    # Sample resource usage half way through, while every stream is busy.
+    await asyncio.sleep(args.duration / 2)
+    sample()
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def run_load(port, streams, args):
+    """Push mixed traffic through `port` over `streams` connections."""
+    usage = {}
+
+    def sample():
+        usage["threads"] = threading.active_count()
+        usage["rss_bytes"] = _rss_bytes()
+
+    start = time.perf_counter()
+    stats = asyncio.run(_generate_load(port, streams, args, sample))
+    elapsed = time.perf_counter() - start
+    rpc_seconds = sorted(stats["rpc_seconds"])
+    result = {
+        "streams": streams,
+        "throughput_mb_s": stats["bytes"] / elapsed / 1e6,
+        "rpcs": len(rpc_seconds),
+        "errors": stats["errors"],
+        "threads": usage["threads"],
+        "rss_mb": usage["rss_bytes"] / 1e6,
+    }
+    if len(rpc_seconds) >= 2:
+        percentiles = statistics.quantiles(rpc_seconds, n=1000)
+        result["rpc_ms_p50"] = statistics.median(rpc_seconds) * 1e3
+        result["rpc_ms_p99"] = percentiles[989] * 1e3
+        result["rpc_ms_p999"] = percentiles[998] * 1e3
+    return result
+
+
+def main(args):
+    _raise_file_limit()
+    proxy_class = (
+        AsyncioSessionProxy
+        if args.engine == "asyncio"
+        else DataprocSessionProxy
+    )
+    proxy_kwargs = {"multiplex": True} if args.multiplex else {}
+    credential_manager = CredentialManager(
+        credentials=oauth2credentials.Credentials("load-test-token")
+    )
+    results = []
+    with backend_process() as bridge_host:
+        for streams in args.streams:
+            p = proxy_class(
+                0,
+                bridge_host,
+                use_ssl=False,
+                credential_manager=credential_manager,
+                **proxy_kwargs,
+            )
+            p.start()
+            try:
+                result = run_load(p.port, streams, args)
+            finally:
+                p.stop()
+            results.append(result)
+            print(
+                f"{streams:>5} streams: {result['throughput_mb_s']:8.1f} MB/s,"
+                f" RPC p50 {result.get('rpc_ms_p50', 0):7.2f} ms,"
+                f" p99 {result.get('rpc_ms_p99', 0):7.2f} ms,"
+                f" p99.9 {result.get('rpc_ms_p999', 0):7.2f} ms,"
+                f" {result['threads']:>5} threads,"
+                f" {result['rss_mb']:7.1f} MB RSS,"
+                f" {result['errors']} errors"
+            )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"engine": args.engine, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    args = parser.parse_args()
+    if args.serve_backend:
+        serve_backend()
+    else:
+        main(args)
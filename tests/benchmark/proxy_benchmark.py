@@ -0,0 +1,347 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for the Dataproc session proxy.
+
+The proxy is run against a local stand-in TCP bridge, which forwards to a
+local TCP server that streams back however many bytes it is asked for. This
+approximates large result downloads and small RPCs without needing a
+Dataproc session.
+
+Each scenario measures download throughput, the CPU time spent per GB
+downloaded, connection setup time, and the round trip time of small RPCs.
+The CPU time covers the whole benchmark process, which also runs the
+stand-in bridge and server, so it is only meaningful compared between runs.
+
+Usage:
+    python -m tests.benchmark.proxy_benchmark --output results.json
+    python -m tests.benchmark.proxy_benchmark --baseline results.json
+
+With `--baseline`, the results are compared with an earlier run, and the
+exit status is non-zero if any metric regressed by more than `--tolerance`.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import platform
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+from unittest import mock
+
+from google.oauth2 import credentials as oauth2credentials
+
+from google.cloud.spark_connect.client import proxy
+from google.cloud.spark_connect.client.asyncio_proxy import (
+    AsyncioSessionProxy,
+)
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.credentials import CredentialManager
+from google.cloud.spark_connect.client.proxy import DataprocSessionProxy
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--megabytes", type=int, default=32)
+parser.add_argument("--rounds", type=int, default=3)
+parser.add_argument("--connections", type=int, default=200)
+parser.add_argument("--rpcs", type=int, default=2000)
+parser.add_argument(
+    "--scenario",
+    action="append",
+    help="Only run the named scenario. May be repeated.",
+)
+parser.add_argument("--output", help="Write the results to this JSON file")
+parser.add_argument(
+    "--baseline", help="Compare the results with this earlier JSON output"
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.2,
+    help="The relative change in a metric that counts as a regression",
+)
+
+_REQUEST = struct.Struct("!Q")
+_CHUNK = bytes(range(256)) * 256
+
+
+def _recv_exactly(conn, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = conn.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Connection closed mid-read")
+        received += n
+    return buf
+
+
+def legacy_forward_bytes(name, from_sock, to_sock, *args):
+    """The original forwarding loop, which reads 1 KiB at a time.
+
+    This is kept as a baseline to measure `proxy.forward_bytes` against.
+    Like that, it shuts down the `to_sock` at the end of the stream, so that
+    connections wind down once the proxy is stopped. The remaining arguments
+    of `proxy.forward_bytes` are ignored.
+    """
+    while True:
+        try:
+            bs = from_sock.recv(1024)
+            if not bs:
+                to_sock.shutdown(socket.SHUT_WR)
+                return
+            while bs:
+                try:
+                    to_sock.send(bs)
+                    bs = None
+                except TimeoutError:
+                    pass
+        except TimeoutError:
+            pass
+        except Exception:
+            to_sock.close()
+            return
+
+
+def _serve_downloads(conn):
+    with conn:
+        while True:
+            try:
+                (size,) = _REQUEST.unpack(_recv_exactly(conn, _REQUEST.size))
+            except ConnectionError:
+                return
+            while size > 0:
+                chunk = _CHUNK[:size]
+                conn.sendall(chunk)
+                size -= len(chunk)
+
+
+@contextlib.contextmanager
+def download_server():
+    """Run a TCP server that streams back the requested number of bytes.
+
+    Clients send the number of bytes they want as an unsigned 64-bit
+    big-endian integer, and the server replies with exactly that many bytes.
+    """
+
+    def accept_loop(server_socket):
+        while True:
+            try:
+                conn, _ = server_socket.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=_serve_downloads, args=[conn], daemon=True
+            ).start()
+
+    with socket.create_server(("127.0.0.1", 0)) as server_socket:
+        threading.Thread(
+            target=accept_loop, args=[server_socket], daemon=True
+        ).start()
+        yield server_socket.getsockname()
+
+
+@contextlib.contextmanager
+def proxied_download_server(
+    forward=None, proxy_class=DataprocSessionProxy, **proxy_kwargs
+):
+    """Run a download server behind a local bridge and a session proxy.
+
+    Args:
+        forward: Replacement for `proxy.forward_bytes`, for comparisons.
+        proxy_class: The session proxy implementation to benchmark.
+        **proxy_kwargs: Additional options passed to `DataprocSessionProxy`.
+
+    Yields:
+        The local port of the session proxy.
+    """
+    forward = forward or proxy.forward_bytes
+    credential_manager = CredentialManager(
+        credentials=oauth2credentials.Credentials("benchmark-token")
+    )
+    with mock.patch.object(proxy, "forward_bytes", forward):
+        with download_server() as address:
+            with local_tcp_bridge(address) as bridge:
+                p = proxy_class(
+                    0,
+                    bridge.host,
+                    use_ssl=False,
+                    credential_manager=credential_manager,
+                    **proxy_kwargs,
+                )
+                p.start()
+                try:
+                    yield p.port
+                finally:
+                    p.stop()
+
+
+def measure_download(port, size, rounds):
+    """Download `size` bytes `rounds` times.
+
+    Returns:
+        The best throughput, in MB/s, and the process CPU time spent per GB
+        downloaded, in seconds.
+    """
+    best = 0.0
+    with socket.create_connection(("127.0.0.1", port)) as conn:
+        cpu_start = time.process_time()
+        for _ in range(rounds):
+            start = time.perf_counter()
+            conn.sendall(_REQUEST.pack(size))
+            _recv_exactly(conn, size)
+            elapsed = time.perf_counter() - start
+            best = max(best, size / elapsed / 1e6)
+        cpu_seconds = time.process_time() - cpu_start
+    return best, cpu_seconds / (size * rounds / 1e9)
+
+
+def measure_setup(port, connections):
+    """Open `connections` connections and return the median setup time.
+
+    Each connection is timed from the connect call until a one byte
+    download has completed, so that it includes opening the backend stream.
+    """
+    setup_times = []
+    for _ in range(connections):
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port)) as conn:
+            conn.sendall(_REQUEST.pack(1))
+            _recv_exactly(conn, 1)
+            setup_times.append(time.perf_counter() - start)
+    return statistics.median(setup_times)
+
+
+def measure_rpc_latency(port, rpcs, pieces=8, response_size=64):
+    """Time `rpcs` small request/response round trips.
+
+    Each request is written as `pieces` tiny writes, the way gRPC writes
+    HTTP/2 frame headers, payloads and window updates separately.
+
+    Returns:
+        The median and 99th percentile round trip times, in seconds.
+    """
+    request = _REQUEST.pack(response_size)
+    piece_size = -(-len(request) // pieces)
+    round_trips = []
+    with socket.create_connection(("127.0.0.1", port)) as conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(rpcs):
+            start = time.perf_counter()
+            for offset in range(0, len(request), piece_size):
+                conn.sendall(request[offset : offset + piece_size])
+            _recv_exactly(conn, response_size)
+            round_trips.append(time.perf_counter() - start)
+    percentiles = statistics.quantiles(round_trips, n=100)
+    return statistics.median(round_trips), percentiles[98]
+
+
+# Each scenario is a replacement for `proxy.forward_bytes` (or `None`) and
+# the options of the proxy under test.
+SCENARIOS = {
+    "hex-1k": (legacy_forward_bytes, {"binary_frames": False}),
+    "binary-1k": (legacy_forward_bytes, {"binary_frames": True}),
+    "hex": (None, {"binary_frames": False}),
+    "binary": (None, {"binary_frames": True}),
+    "multiplexed": (None, {"multiplex": True}),
+    "coalesced": (None, {"coalesce_delay": 0}),
+    "asyncio": (None, {"proxy_class": AsyncioSessionProxy}),
+}
+
+# Metrics are lower-is-better unless listed here.
+HIGHER_IS_BETTER = {"throughput_mb_s"}
+
+
+def run_scenario(name, args):
+    """Run one scenario and return its metrics."""
+    forward, proxy_kwargs = SCENARIOS[name]
+    size = args.megabytes * 1024 * 1024
+    with proxied_download_server(forward, **proxy_kwargs) as port:
+        throughput, cpu_per_gb = measure_download(port, size, args.rounds)
+        setup_time = measure_setup(port, args.connections)
+        rtt_p50, rtt_p99 = measure_rpc_latency(port, args.rpcs)
+    return {
+        "throughput_mb_s": throughput,
+        "cpu_s_per_gb": cpu_per_gb,
+        "setup_ms_p50": setup_time * 1e3,
+        "rtt_ms_p50": rtt_p50 * 1e3,
+        "rtt_ms_p99": rtt_p99 * 1e3,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compare `results` with an earlier run.
+
+    Returns:
+        A list of `(scenario, metric, baseline_value, value)` tuples for
+        every metric that got worse by more than `tolerance`.
+    """
+    regressions = []
+    for name, metrics in results["scenarios"].items():
+        baseline_metrics = baseline["scenarios"].get(name, {})
+        for metric, value in metrics.items():
+            before = baseline_metrics.get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            print(f"{name:>12} {metric:>16}: {before:10.3f} -> {value:10.3f}")
+            if change > tolerance:
+                regressions.append((name, metric, before, value))
+    return regressions
+
+
+def main(args):
+    results = {
+        "config": {
+            "megabytes": args.megabytes,
+            "rounds": args.rounds,
+            "connections": args.connections,
+            "rpcs": args.rpcs,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        metrics = run_scenario(name, args)
+        results["scenarios"][name] = metrics
+        print(
+            f"{name:>12}: {metrics['throughput_mb_s']:8.1f} MB/s,"
+            f" {metrics['cpu_s_per_gb']:6.2f} CPU s/GB,"
+            f" {metrics['setup_ms_p50']:6.2f} ms setup,"
+            f" {metrics['rtt_ms_p50']:6.3f} ms RTT p50,"
+            f" {metrics['rtt_ms_p99']:6.3f} ms RTT p99"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, before, value in regressions:
+            print(f"REGRESSION {name} {metric}: {before:.3f} -> {value:.3f}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,110 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""End-to-end benchmark of a PySpark workload against a replayed session.
+
+Record the workload once against a real session, with the session proxy's
+capture enabled:
+
+    spark = (
+        GoogleSparkSession.builder.captureTraffic("workload.cap")
+        .getOrCreate()
+    )
+
+The workload script is then run against a replay of that capture, so each
+round exercises the Spark Connect client, the proxy, and Arrow-to-pandas
+conversion the same way, without a session. The script runs with `spark`
+bound to a Spark Connect session, and must repeat the recorded calls.
+
+Usage:
+    python -m tests.benchmark.replay_benchmark workload.cap workload.py
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import time
+
+from pyspark.sql.connect.session import SparkSession
+
+from google.cloud.spark_connect.client.replay import replay_session
+
+parser = argparse.ArgumentParser()
+parser.add_argument("capture", help="The capture file to replay")
+parser.add_argument("script", help="The workload, run with `spark` bound")
+parser.add_argument("--rounds", type=int, default=3)
+parser.add_argument(
+    "--pace",
+    action="store_true",
+    help="Reproduce the backend's recorded reply delays",
+)
+parser.add_argument("--output", help="Write the results to this JSON file")
+
+
+def run_round(capture, code, pace=False):
+    """Run the workload once against a replay of `capture`.
+
+    Returns:
+        The wall time and process CPU time of the workload, in seconds, and
+        the proxy's time spent blocked on the backend and decoding frames.
+    """
+    with replay_session(capture, pace=pace) as p:
+        spark = SparkSession.builder.remote(f"sc://localhost:{p.port}").create()
+        try:
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            exec(code, {"spark": spark})
+            elapsed = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+        finally:
+            spark.stop()
+        backward = p.metrics.snapshot()["totals"]["backward"]
+    return {
+        "wall_s": elapsed,
+        "cpu_s": cpu_seconds,
+        "proxy_recv_s": backward["recv_seconds"],
+        "proxy_decode_s": backward["decode_seconds"],
+        "bytes": backward["bytes"],
+    }
+
+
+def main(args):
+    with open(args.script) as f:
+        code = compile(f.read(), args.script, "exec")
+    rounds = []
+    for i in range(args.rounds):
+        result = run_round(args.capture, code, args.pace)
+        rounds.append(result)
+        print(
+            f"round {i + 1}: {result['wall_s']:8.3f} s wall,"
+            f" {result['cpu_s']:8.3f} s CPU,"
+            f" {result['proxy_decode_s']:6.3f} s decoding,"
+            f" {result['bytes'] / 1e6:8.1f} MB"
+        )
+    summary = {
+        metric: statistics.median(r[metric] for r in rounds)
+        for metric in rounds[0]
+    }
+    print(
+        f"median: {summary['wall_s']:8.3f} s wall,"
+        f" {summary['cpu_s']:8.3f} s CPU"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rounds": rounds, "median": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    main(parser.parse_args())
@@ -0,0 +1,114 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+import threading
+import time
+from concurrent import futures
+from unittest import mock
+
+import grpc
+import pytest
+
+from google.cloud.spark_connect.client import credentials, proxy
+
+
+def wait_for(condition, timeout=5):
+    """Poll until `condition()` is true, failing after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for condition"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def echo_server_address():
+    def echo_messages(conn):
+        with conn:
+            try:
+                while True:
+                    bs = conn.recv(1024)
+                    if not bs:
+                        return
+                    conn.sendall(bs)
+            except OSError:
+                return
+
+    def echo_server(server_socket):
+        while True:
+            try:
+                conn, _ = server_socket.accept()
+            except (ConnectionAbortedError, OSError):
+                return
+            threading.Thread(
+                target=echo_messages, args=[conn], daemon=True
+            ).start()
+
+    with socket.create_server(("127.0.0.1", 0)) as server_socket:
+        threading.Thread(
+            target=echo_server, args=[server_socket], daemon=True
+        ).start()
+        yield server_socket.getsockname()
+
+
+@pytest.fixture
+def grpc_echo_server():
+    """A gRPC server with a `/test.Echo/Echo` method, not yet started."""
+
+    def echo(request, context):
+        return request
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "test.Echo", {"Echo": grpc.unary_unary_rpc_method_handler(echo)}
+            )
+        ]
+    )
+    yield server
+    server.stop(None)
+
+
+@pytest.fixture
+def grpc_echo_server_address(grpc_echo_server):
+    port = grpc_echo_server.add_insecure_port("127.0.0.1:0")
+    grpc_echo_server.start()
+    return ("127.0.0.1", port)
+
+
+@pytest.fixture
+def mock_credentials():
+    with mock.patch("google.auth.default") as default, mock.patch.object(
+        credentials, "_default_credential_manager", None
+    ):
+        creds = mock.MagicMock()
+        creds.token = "test-token"
+        creds.expiry = None
+        default.return_value = (creds, "test-project")
+        yield creds
+
+
+@pytest.fixture
+def recorded_websockets(monkeypatch):
+    """Record the options and connection of every websocket the proxy opens."""
+    recorded = []
+    connect = proxy.websocketclient.connect
+
+    def recording_connect(*args, **kwargs):
+        websocket_conn = connect(*args, **kwargs)
+        recorded.append((kwargs, websocket_conn))
+        return websocket_conn
+
+    monkeypatch.setattr(proxy.websocketclient, "connect", recording_connect)
+    return recorded
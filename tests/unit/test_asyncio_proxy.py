@@ -0,0 +1,155 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import os
+import socket
+import threading
+
+import pytest
+from websockets.asyncio.messages import Assembler
+from websockets.frames import Frame, Opcode
+
+from google.cloud.spark_connect.client.asyncio_proxy import (
+    _QueuedBytes,
+    AsyncioSessionProxy,
+)
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+
+
+@pytest.fixture
+def asyncio_proxy(request, echo_server_address, mock_credentials):
+    binary_frames = getattr(request, "param", True)
+    with local_tcp_bridge(
+        echo_server_address, binary_frames=binary_frames
+    ) as bridge:
+        p = AsyncioSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        yield p
+        p.stop()
+
+
+@pytest.mark.parametrize("asyncio_proxy", [True, False], indirect=True)
+def test_asyncio_proxy_echo(asyncio_proxy):
+    with socket.create_connection(("127.0.0.1", asyncio_proxy.port)) as conn:
+        for i in range(10):
+            msg = f"message {i}".encode()
+            conn.sendall(msg)
+            assert conn.recv(1024) == msg
+
+
+def test_asyncio_proxy_large_message(asyncio_proxy):
+    message = bytes(range(256)) * 4096
+    received = bytearray()
+    with socket.create_connection(("127.0.0.1", asyncio_proxy.port)) as conn:
+        conn.sendall(message)
+        while len(received) < len(message):
+            received += conn.recv(65536)
+    assert received == message
+
+
+def test_asyncio_proxy_frees_closed_connections(
+    echo_server_address, mock_credentials
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = AsyncioSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        try:
+            for i in range(5):
+                with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                    msg = f"message {i}".encode()
+                    conn.sendall(msg)
+                    assert conn.recv(1024) == msg
+        finally:
+            # Closed connections end on their own, so nothing is drained.
+            assert p.stop(drain_timeout=5) < 1
+
+
+def test_byte_bounded_queue_relies_on_websockets_internals():
+    # As for the threaded engine, this fails if a websockets release stops
+    # measuring the Assembler's frame queue with `len` to pause reading.
+    async def check():
+        paused = []
+        assembler = Assembler(
+            10, 5, pause=lambda: paused.append(True), resume=paused.clear
+        )
+        assembler.frames = _QueuedBytes()
+        assembler.put(Frame(Opcode.BINARY, b"x" * 11))
+        assert paused
+        assert await assembler.get() == b"x" * 11
+        assert not paused
+
+    asyncio.run(check())
+
+
+def test_asyncio_proxy_small_watermarks(echo_server_address, mock_credentials):
+    message = bytes(range(256)) * 4096
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = AsyncioSessionProxy(
+            0,
+            bridge.host,
+            use_ssl=False,
+            read_size=16 * 1024,
+            forward_watermarks=(64 * 1024, 16 * 1024),
+            backward_watermarks=(64 * 1024, 16 * 1024),
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                writer = threading.Thread(
+                    target=conn.sendall, args=[message], daemon=True
+                )
+                writer.start()
+                received = bytearray()
+                while len(received) < len(message):
+                    received += conn.recv(65536)
+                writer.join()
+            assert received == message
+        finally:
+            p.stop()
+
+
+def test_asyncio_proxy_constant_thread_count(asyncio_proxy):
+    conns = [
+        socket.create_connection(("127.0.0.1", asyncio_proxy.port))
+        for _ in range(100)
+    ]
+    try:
+        for i, conn in enumerate(conns):
+            conn.sendall(f"{i}".encode())
+        for i, conn in enumerate(conns):
+            assert conn.recv(1024) == f"{i}".encode()
+        # The event loop thread, plus the bounded default executor used
+        # for fetching credentials.
+        proxy_threads = [
+            t for t in threading.enumerate() if t.name.startswith("asyncio")
+        ]
+        assert len(proxy_threads) <= 1 + min(32, (os.cpu_count() or 1) + 4)
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def test_stop_waits_for_the_event_loop(echo_server_address, mock_credentials):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = AsyncioSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        with socket.create_connection(("127.0.0.1", p.port)) as conn:
+            conn.sendall(b"open")
+            assert conn.recv(1024) == b"open"
+            assert p.stop() < 1
+        assert not [
+            t
+            for t in threading.enumerate()
+            if t.name == "asyncio-session-proxy"
+        ]
@@ -0,0 +1,81 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+from tests.benchmark import channel_benchmark, load_test, proxy_benchmark
+
+
+@pytest.mark.parametrize("scenario", ["hex-1k", "binary", "multiplexed"])
+def test_benchmark_scenario_runs(scenario):
+    args = proxy_benchmark.parser.parse_args(
+        ["--megabytes", "1", "--rounds", "1", "--connections", "3"]
+        + ["--rpcs", "10"]
+    )
+    metrics = proxy_benchmark.run_scenario(scenario, args)
+    assert set(metrics) == {
+        "throughput_mb_s",
+        "cpu_s_per_gb",
+        "setup_ms_p50",
+        "rtt_ms_p50",
+        "rtt_ms_p99",
+    }
+    assert all(value > 0 for value in metrics.values())
+
+
+def test_benchmark_compare_flags_regressions():
+    baseline = {
+        "scenarios": {
+            "binary": {"throughput_mb_s": 100.0, "rtt_ms_p50": 1.0},
+        }
+    }
+    results = {
+        "scenarios": {
+            "binary": {"throughput_mb_s": 80.0, "rtt_ms_p50": 0.5},
+            "asyncio": {"throughput_mb_s": 10.0},
+        }
+    }
+    assert proxy_benchmark.compare(results, baseline, 0.1) == [
+        ("binary", "throughput_mb_s", 100.0, 80.0)
+    ]
+
+
+def test_load_test_runs():
+    args = load_test.parser.parse_args(
+        ["--duration", "0.2", "--bulk-fraction", "0.5"]
+    )
+    with proxy_benchmark.proxied_download_server() as port:
+        result = load_test.run_load(port, 4, args)
+    assert result["streams"] == 4
+    assert result["errors"] == 0
+    assert result["rpcs"] > 0
+    assert result["threads"] > 0
+
+
+@pytest.mark.parametrize("pool_size", ["1", "2"])
+@pytest.mark.parametrize("transport", ["direct", "proxy", "proxy-one-lane"])
+def test_channel_benchmark_runs(transport, pool_size):
+    args = channel_benchmark.parser.parse_args(
+        ["--megabytes", "1", "--rounds", "1", "--rpcs", "10"]
+        + ["--threads", "2", "--pool-size", pool_size]
+    )
+    metrics = channel_benchmark.run_transport(transport, args)
+    assert set(metrics) == {
+        "throughput_mb_s",
+        "concurrent_mb_s",
+        "rtt_ms_p50",
+        "rtt_ms_p99",
+        "loaded_rtt_ms_p50",
+        "loaded_rtt_ms_p99",
+    }
+    assert all(value > 0 for value in metrics.values())
@@ -0,0 +1,99 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import socket
+import threading
+
+import pytest
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.compression import (
+    CompressionPolicy,
+    DEFAULT_SAMPLE_BYTES,
+)
+from google.cloud.spark_connect.client.proxy import DataprocSessionProxy
+
+from tests.unit.conftest import wait_for
+
+
+def _echo_through_proxy(p, message):
+    with socket.create_connection(("127.0.0.1", p.port)) as conn:
+        writer = threading.Thread(
+            target=conn.sendall, args=[message], daemon=True
+        )
+        writer.start()
+        received = bytearray()
+        while len(received) < len(message):
+            received += conn.recv(65536)
+        writer.join()
+    assert received == message
+    wait_for(lambda: not p.metrics.snapshot()["connections_open"])
+    return p.metrics.snapshot()["totals"]
+
+
+@pytest.mark.parametrize("mode", ["always", "off"])
+def test_compression_modes(echo_server_address, mock_credentials, mode):
+    message = b"SELECT * FROM results; " * 10000
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, compression=mode
+        )
+        p.start()
+        try:
+            totals = _echo_through_proxy(p, message)
+        finally:
+            p.stop()
+    for direction in ("forward", "backward"):
+        if mode == "off":
+            assert totals[direction]["uncompressed_bytes"] == 0
+        else:
+            assert totals[direction]["uncompressed_bytes"] == len(message)
+            assert totals[direction]["compressed_bytes"] < len(message) / 10
+            assert totals[direction]["compression_seconds"] > 0
+
+
+def test_adaptive_compression_stops_on_random_bytes(
+    echo_server_address, mock_credentials
+):
+    message = os.urandom(2 * DEFAULT_SAMPLE_BYTES)
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        try:
+            assert p.compression_policy.offering
+            totals = _echo_through_proxy(p, message)
+            assert not p.compression_policy.offering
+        finally:
+            p.stop()
+    # Only the sample of the bytes sent was compressed.
+    assert totals["forward"]["uncompressed_bytes"] < len(message)
+
+
+def test_compression_policy_reprobes():
+    policy = CompressionPolicy("adaptive", reprobe_interval=3)
+    assert policy.connect_options()["extensions"]
+    policy.record_sample(1000, 990)
+    offered = [bool(policy.connect_options()["extensions"]) for _ in range(6)]
+    assert offered == [False, False, True, False, False, True]
+    policy.record_sample(1000, 100)
+    assert policy.connect_options()["extensions"]
+
+
+def test_compression_policy_modes():
+    assert CompressionPolicy("off").connect_options()["extensions"] is None
+    always = CompressionPolicy("always")
+    always.record_sample(1000, 1000)
+    assert always.connect_options()["extensions"]
+    with pytest.raises(ValueError):
+        CompressionPolicy("sometimes")
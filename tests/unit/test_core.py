@@ -0,0 +1,451 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import os
+import socket
+import stat
+import threading
+from unittest import mock
+
+import grpc
+import pyspark.sql.connect.proto as pb2
+import pytest
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client import core
+from google.cloud.spark_connect.client.core import (
+    LANE_BULK,
+    LANE_CONTROL,
+    ChannelPool,
+    DataprocChannelBuilder,
+    ProxiedChannel,
+    ProxyRegistry,
+)
+from google.cloud.spark_connect.client.daemon import ProxyDaemon
+
+from tests.unit.conftest import wait_for
+
+
+@pytest.fixture
+def direct_probe_results(monkeypatch):
+    results = {}
+    monkeypatch.setattr(core, "_direct_probe_results", results)
+    monkeypatch.setattr(
+        core, "_direct_probe_locks", collections.defaultdict(threading.Lock)
+    )
+    return results
+
+
+def _serve_spark_version(server):
+    """Answer the direct channel probe's Spark version request."""
+
+    def analyze(request, context):
+        assert request.HasField("spark_version")
+        return pb2.AnalyzePlanResponse(
+            session_id=request.session_id,
+            spark_version=pb2.AnalyzePlanResponse.SparkVersion(version="3.5.0"),
+        )
+
+    server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "spark.connect.SparkConnectService",
+                {
+                    "AnalyzePlan": grpc.unary_unary_rpc_method_handler(
+                        analyze,
+                        request_deserializer=pb2.AnalyzePlanRequest.FromString,
+                        response_serializer=pb2.AnalyzePlanResponse.SerializeToString,
+                    )
+                },
+            )
+        ]
+    )
+
+
+def test_direct_channel(
+    grpc_echo_server, mock_credentials, direct_probe_results
+):
+    _serve_spark_version(grpc_echo_server)
+    port = grpc_echo_server.add_secure_port(
+        "127.0.0.1:0", grpc.local_server_credentials()
+    )
+    grpc_echo_server.start()
+    builder = DataprocChannelBuilder(
+        f"sc://127.0.0.1:{port}", transport="direct"
+    )
+    for _ in range(2):
+        with builder.toChannel() as channel:
+            assert not isinstance(channel, ProxiedChannel)
+            echo = channel.unary_unary("/test.Echo/Echo")
+            assert echo(b"direct", timeout=10) == b"direct"
+    ((reachable, _),) = direct_probe_results.values()
+    assert reachable
+    assert mock_credentials.before_request.called
+
+
+def test_direct_channel_needs_a_spark_connect_server(
+    grpc_echo_server, mock_credentials, direct_probe_results
+):
+    # The server accepts HTTP/2 connections, but not Spark Connect RPCs.
+    port = grpc_echo_server.add_secure_port(
+        "127.0.0.1:0", grpc.local_server_credentials()
+    )
+    grpc_echo_server.start()
+    builder = DataprocChannelBuilder(
+        f"sc://127.0.0.1:{port}",
+        proxy_options={"use_ssl": False},
+        transport="direct",
+    )
+    with builder.toChannel() as channel:
+        assert isinstance(channel, ProxiedChannel)
+    ((reachable, _),) = direct_probe_results.values()
+    assert not reachable
+
+
+def test_direct_channel_probes_hosts_concurrently(
+    grpc_echo_server, mock_credentials, direct_probe_results
+):
+    _serve_spark_version(grpc_echo_server)
+    port = grpc_echo_server.add_secure_port(
+        "127.0.0.1:0", grpc.local_server_credentials()
+    )
+    grpc_echo_server.start()
+    # A probe to another host still in progress does not hold this one up.
+    with core._direct_probe_locks["other-host:443"]:
+        builder = DataprocChannelBuilder(
+            f"sc://127.0.0.1:{port}", transport="direct"
+        )
+        with builder.toChannel() as channel:
+            assert not isinstance(channel, ProxiedChannel)
+
+
+def test_direct_channel_falls_back_to_the_proxy(
+    grpc_echo_server, mock_credentials, direct_probe_results
+):
+    with socket.create_server(("127.0.0.1", 0)) as unused:
+        port = unused.getsockname()[1]
+    builder = DataprocChannelBuilder(
+        f"sc://127.0.0.1:{port}",
+        proxy_options={"use_ssl": False},
+        transport="direct",
+        probe_timeout=0.2,
+    )
+    with builder.toChannel() as channel:
+        assert isinstance(channel, ProxiedChannel)
+    ((reachable, probed_at),) = direct_probe_results.values()
+    assert not reachable
+    # Later channels to the host skip the probe for a while.
+    with mock.patch.object(DataprocChannelBuilder, "_probe") as probe:
+        with builder.toChannel() as channel:
+            assert isinstance(channel, ProxiedChannel)
+    assert not probe.called
+
+    # Once the failure is old enough, the host is probed again.
+    _serve_spark_version(grpc_echo_server)
+    grpc_echo_server.add_secure_port(
+        f"127.0.0.1:{port}", grpc.local_server_credentials()
+    )
+    grpc_echo_server.start()
+    direct_probe_results[builder.endpoint] = (
+        False,
+        probed_at - core.DIRECT_PROBE_RETRY_INTERVAL,
+    )
+    with builder.toChannel() as channel:
+        assert not isinstance(channel, ProxiedChannel)
+    assert direct_probe_results[builder.endpoint][0]
+
+
+def test_unsupported_transport():
+    with pytest.raises(ValueError):
+        DataprocChannelBuilder("sc://localhost", transport="carrier-pigeon")
+
+
+@pytest.mark.parametrize("unix_socket", [True, False])
+@pytest.mark.parametrize("proxy_engine", ["threads", "asyncio"])
+def test_proxied_channel(
+    grpc_echo_server_address, mock_credentials, unix_socket, proxy_engine
+):
+    with local_tcp_bridge(grpc_echo_server_address) as bridge:
+        channel = ProxiedChannel(
+            bridge.host,
+            proxy_engine=proxy_engine,
+            unix_socket=unix_socket,
+            use_ssl=False,
+        )
+        with channel:
+            echo = channel.unary_unary("/test.Echo/Echo")
+            assert echo(b"over the proxy", timeout=10) == b"over the proxy"
+            path = channel._proxy.unix_socket_path
+            if unix_socket:
+                assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+                assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == (
+                    0o700
+                )
+            else:
+                assert path is None
+    if unix_socket:
+        assert not os.path.exists(os.path.dirname(path))
+
+
+@pytest.mark.parametrize("multiplex", [False, True])
+def test_proxied_channel_stops_without_draining(
+    grpc_echo_server_address, mock_credentials, multiplex
+):
+    with local_tcp_bridge(grpc_echo_server_address) as bridge:
+        channel = ProxiedChannel(
+            bridge.host,
+            registry=ProxyRegistry(),
+            use_ssl=False,
+            multiplex=multiplex,
+            drain_timeout=5,
+        )
+        with channel:
+            echo = channel.unary_unary("/test.Echo/Echo")
+            assert echo(b"drained", timeout=10) == b"drained"
+    # Closing the channel closes its connections, so there is nothing left
+    # to wait for.
+    assert channel.shutdown_duration < 1
+
+
+def test_shared_proxy_keeps_a_warm_connection(
+    echo_server_address, mock_credentials
+):
+    registry = ProxyRegistry()
+    with local_tcp_bridge(echo_server_address) as bridge:
+        with ProxiedChannel(
+            bridge.host, registry=registry, use_ssl=False
+        ) as channel:
+            pool = channel._proxy.connection_pool
+            wait_for(lambda: pool.stats()["idle"] == 1)
+
+
+def test_proxied_channels_share_a_proxy(
+    grpc_echo_server_address, mock_credentials
+):
+    registry = ProxyRegistry()
+    with local_tcp_bridge(grpc_echo_server_address) as bridge:
+        first = ProxiedChannel(bridge.host, registry=registry, use_ssl=False)
+        second = ProxiedChannel(bridge.host, registry=registry, use_ssl=False)
+        other = ProxiedChannel(
+            bridge.host, registry=registry, use_ssl=False, multiplex=True
+        )
+        assert first._proxy is second._proxy
+        assert other._proxy is not first._proxy
+        assert registry.stats() == {bridge.host: 3}
+        shared = first._proxy
+
+        first.close()
+        first.close()
+        assert first.shutdown_duration == 0
+        assert registry.stats() == {bridge.host: 2}
+        echo = second.unary_unary("/test.Echo/Echo")
+        assert echo(b"still shared", timeout=10) == b"still shared"
+
+        second.close()
+        other.close()
+        assert registry.stats() == {}
+        if shared.unix_socket_path is not None:
+            assert not os.path.exists(shared.unix_socket_path)
+
+        third = ProxiedChannel(bridge.host, registry=registry, use_ssl=False)
+        with third:
+            assert third._proxy is not shared
+            echo = third.unary_unary("/test.Echo/Echo")
+            assert echo(b"restarted", timeout=10) == b"restarted"
+    assert registry.stats() == {}
+
+
+@pytest.mark.parametrize("separate_lanes, connections", [(True, 2), (False, 1)])
+def test_proxied_channel_lanes(
+    grpc_echo_server, mock_credentials, separate_lanes, connections
+):
+    release = threading.Event()
+
+    def execute_plan(request, context):
+        yield b"x" * 1024 * 1024
+        release.wait(10)
+        yield b"done"
+
+    grpc_echo_server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "spark.connect.SparkConnectService",
+                {
+                    "ExecutePlan": grpc.unary_stream_rpc_method_handler(
+                        execute_plan
+                    )
+                },
+            )
+        ]
+    )
+    port = grpc_echo_server.add_insecure_port("127.0.0.1:0")
+    grpc_echo_server.start()
+    with local_tcp_bridge(("127.0.0.1", port)) as bridge:
+        with ProxiedChannel(
+            bridge.host,
+            registry=ProxyRegistry(),
+            separate_lanes=separate_lanes,
+            use_ssl=False,
+        ) as channel:
+            method = "/spark.connect.SparkConnectService/ExecutePlan"
+            assert channel.lane_of(method) == LANE_BULK
+            assert channel.lane_of("/test.Echo/Echo") == LANE_CONTROL
+            responses = channel.unary_stream(method)(b"", timeout=10)
+            assert len(next(responses)) == 1024 * 1024
+            # The control RPC completes while the stream is in flight.
+            echo = channel.unary_unary("/test.Echo/Echo")
+            assert echo(b"interrupt", timeout=10) == b"interrupt"
+            release.set()
+            assert list(responses) == [b"done"]
+            snapshot = channel._proxy.metrics.snapshot()
+            assert snapshot["connections_total"] == connections
+            latency = channel.lane_latency()
+            assert latency[LANE_CONTROL]["count"] == 1
+            assert latency[LANE_BULK]["count"] == 1
+
+
+def test_channel_options_from_connection_string():
+    builder = DataprocChannelBuilder(
+        "sc://localhost:443/;grpc_max_message_size=1024;"
+        "grpc_compression=gzip;grpc_keepalive_time_ms=30000;foo=bar",
+        channelOptions=[("grpc.max_receive_message_length", 1)],
+    )
+    options = dict(builder.channel_options)
+    assert options["grpc.max_send_message_length"] == 1024
+    assert options["grpc.max_receive_message_length"] == 1024
+    assert options["grpc.default_compression_algorithm"] == int(
+        grpc.Compression.Gzip
+    )
+    assert options["grpc.keepalive_time_ms"] == 30000
+    # Only the remaining parameters are sent as request metadata.
+    assert builder.metadata() == [("foo", "bar")]
+
+
+@pytest.mark.parametrize(
+    "params",
+    ["grpc_compression=brotli", "grpc_window_size=large"],
+)
+def test_unsupported_channel_option_params(params):
+    with pytest.raises(ValueError):
+        DataprocChannelBuilder(f"sc://localhost:443/;{params}")
+
+
+def test_proxied_channel_options(grpc_echo_server_address, mock_credentials):
+    with local_tcp_bridge(grpc_echo_server_address) as bridge:
+        with ProxiedChannel(
+            bridge.host,
+            registry=ProxyRegistry(),
+            channel_options=[("grpc.max_receive_message_length", 16)],
+            use_ssl=False,
+        ) as channel:
+            echo = channel.unary_unary("/test.Echo/Echo")
+            assert echo(b"short", timeout=10) == b"short"
+            with pytest.raises(grpc.RpcError) as e:
+                echo(b"longer than sixteen bytes", timeout=10)
+            assert e.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+
+
+@pytest.mark.parametrize(
+    "policy, calls", [("round_robin", [3, 2, 2]), ("least_loaded", [2, 3, 2])]
+)
+def test_channel_pool(grpc_echo_server, mock_credentials, policy, calls):
+    release = threading.Event()
+
+    def execute_plan(request, context):
+        yield b"started"
+        release.wait(10)
+
+    grpc_echo_server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "spark.connect.SparkConnectService",
+                {
+                    "ExecutePlan": grpc.unary_stream_rpc_method_handler(
+                        execute_plan
+                    )
+                },
+            )
+        ]
+    )
+    port = grpc_echo_server.add_insecure_port("127.0.0.1:0")
+    grpc_echo_server.start()
+    registry = ProxyRegistry()
+    with local_tcp_bridge(("127.0.0.1", port)) as bridge:
+        channels = [
+            ProxiedChannel(
+                bridge.host,
+                registry=registry,
+                separate_lanes=False,
+                channel_options=[("grpc.use_local_subchannel_pool", 1)],
+                use_ssl=False,
+            )
+            for _ in range(3)
+        ]
+        with ChannelPool(channels, policy) as pool:
+            echo = pool.unary_unary("/test.Echo/Echo")
+            for _ in range(3):
+                assert echo(b"spread", timeout=10) == b"spread"
+            assert [c["calls"] for c in pool.stats()] == [1, 1, 1]
+            responses = pool.unary_stream(
+                "/spark.connect.SparkConnectService/ExecutePlan"
+            )(b"", timeout=10)
+            assert next(responses) == b"started"
+            assert [c["in_flight"] for c in pool.stats()] == [1, 0, 0]
+            for _ in range(3):
+                assert echo(b"spread", timeout=10) == b"spread"
+            assert [c["calls"] for c in pool.stats()] == calls
+            release.set()
+            assert list(responses) == []
+            wait_for(lambda: not any(c["in_flight"] for c in pool.stats()))
+            # Each channel of the pool has its own connection.
+            snapshot = channels[0]._proxy.metrics.snapshot()
+            assert snapshot["connections_total"] == 3
+    assert registry.stats() == {}
+
+
+def test_channel_builder_pool(mock_credentials):
+    registry = ProxyRegistry()
+    builder = DataprocChannelBuilder(
+        "sc://localhost:443",
+        proxy_options={"registry": registry},
+        pool_size=2,
+        pool_policy="round_robin",
+    )
+    with builder.toChannel() as pool:
+        assert isinstance(pool, ChannelPool)
+        assert len(pool.channels) == 2
+        assert registry.stats() == {"localhost": 2}
+    assert registry.stats() == {}
+    with pytest.raises(ValueError):
+        DataprocChannelBuilder("sc://localhost:443", pool_size=0)
+    with pytest.raises(ValueError):
+        DataprocChannelBuilder("sc://localhost:443", pool_policy="random")
+
+
+def test_proxied_channel_through_daemon(
+    grpc_echo_server_address, mock_credentials, tmp_path
+):
+    d = ProxyDaemon(str(tmp_path / "control.sock"), use_ssl=False)
+    d.start()
+    try:
+        with local_tcp_bridge(grpc_echo_server_address) as bridge:
+            with ProxiedChannel(
+                bridge.host, daemon_socket=d.control_path
+            ) as channel:
+                echo = channel.unary_unary("/test.Echo/Echo")
+                assert echo(b"via the daemon", timeout=10) == b"via the daemon"
+                assert d.stats()[bridge.host]["registrations"] == 1
+            wait_for(lambda: not d.stats())
+    finally:
+        d.stop()
@@ -0,0 +1,100 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import threading
+import time
+
+from google.cloud.spark_connect.client import credentials
+from google.cloud.spark_connect.client.credentials import CredentialManager
+
+from tests.unit.conftest import wait_for
+
+
+class FakeCredentials(object):
+    """Credentials that issue a new token valid for `lifetime` on refresh."""
+
+    def __init__(self, lifetime, refresh_delay=0):
+        self.token = None
+        self.expiry = None
+        self.refresh_calls = 0
+        self._lifetime = lifetime
+        self._refresh_delay = refresh_delay
+
+    def refresh(self, request):
+        time.sleep(self._refresh_delay)
+        self.refresh_calls += 1
+        self.token = f"token-{self.refresh_calls}"
+        self.expiry = credentials._utcnow() + self._lifetime
+
+
+def test_token_is_cached():
+    creds = FakeCredentials(datetime.timedelta(hours=1))
+    manager = CredentialManager(credentials=creds)
+    try:
+        assert manager.cached_token() is None
+        assert manager.token() == "token-1"
+        assert manager.token() == "token-1"
+        assert manager.cached_token() == "token-1"
+        assert creds.refresh_calls == 1
+    finally:
+        manager.close()
+
+
+def test_expiring_token_is_refreshed():
+    creds = FakeCredentials(datetime.timedelta(seconds=10))
+    manager = CredentialManager(
+        credentials=creds,
+        refresh_margin=datetime.timedelta(seconds=1),
+        min_validity=datetime.timedelta(seconds=20),
+    )
+    try:
+        assert manager.token() == "token-1"
+        assert manager.cached_token() is None
+        assert manager.token() == "token-2"
+    finally:
+        manager.close()
+
+
+def test_concurrent_callers_share_one_refresh():
+    creds = FakeCredentials(datetime.timedelta(hours=1), refresh_delay=0.2)
+    manager = CredentialManager(credentials=creds)
+    tokens = []
+    threads = [
+        threading.Thread(target=lambda: tokens.append(manager.token()))
+        for _ in range(10)
+    ]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert tokens == ["token-1"] * 10
+        assert creds.refresh_calls == 1
+    finally:
+        manager.close()
+
+
+def test_token_is_refreshed_in_background():
+    creds = FakeCredentials(datetime.timedelta(seconds=1.2))
+    manager = CredentialManager(
+        credentials=creds,
+        refresh_margin=datetime.timedelta(seconds=1),
+        min_validity=datetime.timedelta(0),
+    )
+    try:
+        assert manager.token() == "token-1"
+        wait_for(lambda: creds.refresh_calls >= 2)
+        assert manager.refresh_count == creds.refresh_calls
+    finally:
+        manager.close()
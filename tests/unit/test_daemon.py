@@ -0,0 +1,81 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import socket
+
+import pytest
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.daemon import DaemonClient, ProxyDaemon
+
+from tests.unit.conftest import wait_for
+
+
+@pytest.fixture
+def proxy_daemon(tmp_path, mock_credentials):
+    d = ProxyDaemon(str(tmp_path / "control.sock"), use_ssl=False)
+    d.start()
+    yield d
+    d.stop()
+
+
+def _echo(unix_socket_path, message):
+    with socket.socket(socket.AF_UNIX) as conn:
+        conn.connect(unix_socket_path)
+        conn.sendall(message)
+        assert conn.recv(1024) == message
+
+
+def test_processes_share_a_proxy_per_host(proxy_daemon, echo_server_address):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        first = DaemonClient(proxy_daemon.control_path)
+        second = DaemonClient(proxy_daemon.control_path)
+        address = first.register(bridge.host)
+        assert second.register(bridge.host) == address
+        _echo(address["unix_socket_path"], b"shared")
+        stats = second.stats()[bridge.host]
+        assert stats["registrations"] == 2
+        assert stats["connections_total"] == 1
+        # Closing a client releases its registrations.
+        first.close()
+        wait_for(lambda: second.stats()[bridge.host]["registrations"] == 1)
+        _echo(address["unix_socket_path"], b"still routed")
+        second.unregister(bridge.host)
+        assert second.stats() == {}
+        assert not os.path.exists(address["unix_socket_path"])
+        second.close()
+
+
+def test_daemon_errors(proxy_daemon):
+    with DaemonClient(proxy_daemon.control_path) as client:
+        with pytest.raises(Exception, match="not registered"):
+            client.unregister("unknown-host")
+    with pytest.raises(Exception, match="already listening"):
+        ProxyDaemon(proxy_daemon.control_path).start()
+
+
+def test_daemon_stop_closes_proxies(
+    tmp_path, mock_credentials, echo_server_address
+):
+    d = ProxyDaemon(str(tmp_path / "control.sock"), use_ssl=False)
+    d.start()
+    with local_tcp_bridge(echo_server_address) as bridge:
+        client = DaemonClient(d.control_path)
+        address = client.register(bridge.host)
+        d.stop()
+        assert not os.path.exists(d.control_path)
+        assert not os.path.exists(address["unix_socket_path"])
+        with pytest.raises(ConnectionError):
+            client.stats()
+        client.close()
@@ -0,0 +1,151 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+import threading
+import time
+
+import pytest
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.endpoints import (
+    EndpointResolver,
+    race,
+)
+from google.cloud.spark_connect.client.proxy import (
+    bridged_socket,
+    connect_tcp_bridge,
+)
+
+from tests.unit.conftest import wait_for
+
+
+def _fake_getaddrinfo(sockaddrs, calls):
+    def getaddrinfo(host, port, type=0):
+        calls.append((host, port))
+        return [
+            (
+                socket.AF_INET6 if ":" in sockaddr[0] else socket.AF_INET,
+                socket.SOCK_STREAM,
+                socket.IPPROTO_TCP,
+                "",
+                sockaddr,
+            )
+            for sockaddr in sockaddrs
+        ]
+
+    return getaddrinfo
+
+
+def test_resolver_interleaves_address_families():
+    calls = []
+    resolver = EndpointResolver(
+        getaddrinfo=_fake_getaddrinfo(
+            [("::1", 443), ("::2", 443), ("10.0.0.1", 443), ("10.0.0.2", 443)],
+            calls,
+        )
+    )
+    assert [a[3][0] for a in resolver.addresses("host", 443)] == [
+        "::1",
+        "10.0.0.1",
+        "::2",
+        "10.0.0.2",
+    ]
+
+
+def test_resolver_caches_addresses():
+    calls = []
+    getaddrinfo = _fake_getaddrinfo([("10.0.0.1", 443)], calls)
+    resolver = EndpointResolver(getaddrinfo=getaddrinfo)
+    resolver.addresses("host", 443)
+    resolver.addresses("host", 443)
+    assert len(calls) == 1
+    resolver.invalidate("host", 443)
+    resolver.addresses("host", 443)
+    assert len(calls) == 2
+
+    resolver = EndpointResolver(ttl=0, getaddrinfo=getaddrinfo)
+    resolver.addresses("host", 443)
+    resolver.addresses("host", 443)
+    assert len(calls) == 4
+
+
+def test_resolver_deprioritizes_slow_addresses():
+    sockaddrs = [("10.0.0.1", 443), ("10.0.0.2", 443), ("10.0.0.3", 443)]
+    resolver = EndpointResolver(getaddrinfo=_fake_getaddrinfo(sockaddrs, []))
+    resolver.connected(sockaddrs[0], 0.5)
+    resolver.connected(sockaddrs[1], 0.01)
+    # Known fast addresses come first, then untried ones, then slow ones.
+    assert [a[3] for a in resolver.addresses("host", 443)] == [
+        sockaddrs[1],
+        sockaddrs[2],
+        sockaddrs[0],
+    ]
+    resolver.failed(sockaddrs[1])
+    assert resolver.addresses("host", 443)[-1][3] == sockaddrs[1]
+    stats = resolver.stats()
+    assert stats["10.0.0.2:443"]["attempts"] == 2
+    assert stats["10.0.0.2:443"]["failures"] == 1
+
+
+def test_race_keeps_the_first_to_complete():
+    release = threading.Event()
+    discarded = []
+
+    def slow():
+        release.wait(5)
+        return "slow"
+
+    start = time.monotonic()
+    assert race([slow, lambda: "fast"], 0.05, discarded.append) == "fast"
+    assert time.monotonic() - start < 1
+    release.set()
+    wait_for(lambda: discarded)
+    assert discarded == ["slow"]
+
+
+def test_race_starts_the_next_attempt_on_failure():
+    def fail():
+        raise ConnectionRefusedError("refused")
+
+    start = time.monotonic()
+    assert race([fail, lambda: "second"], 5) == "second"
+    assert time.monotonic() - start < 1
+    with pytest.raises(ConnectionRefusedError):
+        race([fail, fail], 0.01)
+
+
+def test_connect_tcp_bridge_races_addresses(
+    echo_server_address, mock_credentials
+):
+    # The first address accepts TCP connections but never completes the
+    # websocket handshake.
+    with socket.create_server(("127.0.0.1", 0)) as silent:
+        with local_tcp_bridge(echo_server_address) as bridge:
+            _, bridge_port = bridge.host.split(":")
+            sockaddrs = [
+                ("127.0.0.1", silent.getsockname()[1]),
+                ("127.0.0.1", int(bridge_port)),
+            ]
+            resolver = EndpointResolver(
+                getaddrinfo=_fake_getaddrinfo(sockaddrs, [])
+            )
+            websocket_conn = connect_tcp_bridge(
+                bridge.host, use_ssl=False, resolver=resolver
+            )
+            # The connect timeout does not outlive the TCP connect.
+            assert websocket_conn.socket.gettimeout() is None
+            with bridged_socket(websocket_conn) as conn:
+                conn.send(b"raced")
+                assert conn.recv(1024) == b"raced"
+            assert resolver.stats()[f"127.0.0.1:{bridge_port}"]["failures"] == 0
@@ -0,0 +1,126 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+import time
+import urllib.request
+
+import pytest
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.metrics import (
+    Histogram,
+    ProxyMetrics,
+    serve_metrics,
+)
+from google.cloud.spark_connect.client.proxy import DataprocSessionProxy
+
+from tests.unit.conftest import wait_for
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram([0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 5.0]:
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == [(0.1, 2), (1.0, 3), (float("inf"), 4)]
+    assert snapshot["count"] == 4
+    assert snapshot["sum"] == pytest.approx(5.65)
+
+
+def test_session_proxy_records_metrics(echo_server_address, mock_credentials):
+    with local_tcp_bridge(echo_server_address, binary_frames=False) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"measured")
+                assert conn.recv(1024) == b"measured"
+            wait_for(lambda: not p.metrics.snapshot()["connections_open"])
+        finally:
+            p.stop()
+    snapshot = p.metrics.snapshot()
+    assert snapshot["connections_total"] == 1
+    assert snapshot["setup_latency"]["count"] == 1
+    (conn_metrics,) = snapshot["connections"]
+    assert conn_metrics["setup_seconds"] > 0
+    forward, backward = conn_metrics["forward"], conn_metrics["backward"]
+    assert forward["bytes"] == backward["bytes"] == 8
+    assert forward["frames_sent"] == backward["frames_received"] == 1
+    assert forward["encode_seconds"] > 0
+    assert backward["decode_seconds"] > 0
+    assert snapshot["totals"]["forward"]["bytes"] == 8
+
+
+def test_openmetrics_format():
+    metrics = ProxyMetrics()
+    conn_metrics = metrics.open_connection(1)
+    metrics.connection_setup(conn_metrics, 0.002)
+    conn_metrics.forward.bytes += 100
+    conn_metrics.backward.observe_buffered(4096)
+    conn_metrics.backward.observe_buffered(1024)
+    metrics.connection_lost()
+    metrics.reconnected(0.02)
+    metrics.connection_rejected()
+    metrics.close_connection(metrics.open_connection(2))
+    text = metrics.openmetrics()
+    assert text.endswith("# EOF\n")
+    assert "dataproc_session_proxy_connections_total 2" in text
+    assert "dataproc_session_proxy_connections_rejected_total 1" in text
+    assert "dataproc_session_proxy_open_connections 1" in text
+    assert "dataproc_session_proxy_peak_open_connections 2" in text
+    assert "dataproc_session_proxy_connections_lost_total 1" in text
+    assert "dataproc_session_proxy_reconnect_latency_seconds_count 1" in text
+    assert 'dataproc_session_proxy_bytes_total{direction="forward"} 100' in text
+    assert (
+        "dataproc_session_proxy_bytes_total"
+        '{connection="1",direction="forward"} 100' in text
+    )
+    assert (
+        'dataproc_session_proxy_peak_buffered_bytes{direction="backward"} 4096'
+        in text
+    )
+    assert (
+        'dataproc_session_proxy_setup_latency_seconds_bucket{le="0.0025"} 1'
+        in text
+    )
+
+
+def test_idle_connections():
+    metrics = ProxyMetrics()
+    connecting = metrics.open_connection(1)
+    idle = metrics.open_connection(2)
+    metrics.connection_setup(idle, 0.001)
+    busy = metrics.open_connection(3)
+    metrics.connection_setup(busy, 0.001)
+    time.sleep(0.05)
+    busy.backward.last_active = time.perf_counter()
+    assert metrics.idle_connections(0.05) == [2]
+    assert metrics.idle_connections(60) == []
+    assert connecting.setup_seconds is None
+
+
+def test_serve_metrics():
+    metrics = ProxyMetrics()
+    server = serve_metrics(metrics, 0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{port}/metrics"
+        ) as response:
+            assert response.headers["Content-Type"].startswith(
+                "application/openmetrics-text"
+            )
+            assert response.read().decode() == metrics.openmetrics()
+    finally:
+        server.shutdown()
@@ -0,0 +1,155 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+import threading
+import time
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.proxy import DataprocSessionProxy
+
+from tests.unit.conftest import wait_for
+
+
+def _recv_exactly(conn, size):
+    received = bytearray()
+    while len(received) < size:
+        bs = conn.recv(size - len(received))
+        assert bs, "Connection closed mid-read"
+        received += bs
+    return bytes(received)
+
+
+def test_connections_share_one_websocket(echo_server_address, mock_credentials):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False, multiplex=True)
+        p.start()
+        try:
+            conns = [
+                socket.create_connection(("127.0.0.1", p.port))
+                for _ in range(8)
+            ]
+            for i, conn in enumerate(conns):
+                conn.sendall(f"stream {i}".encode())
+            for i, conn in enumerate(conns):
+                expected = f"stream {i}".encode()
+                assert _recv_exactly(conn, len(expected)) == expected
+                conn.close()
+            assert bridge.connection_count == 1
+            assert bridge.stream_count == 8
+        finally:
+            p.stop()
+
+
+def test_flow_control_window(echo_server_address, mock_credentials):
+    message = bytes(range(256)) * 4096
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, multiplex=True, mux_window=4096
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                writer = threading.Thread(
+                    target=conn.sendall, args=[message], daemon=True
+                )
+                writer.start()
+                assert _recv_exactly(conn, len(message)) == message
+                writer.join()
+        finally:
+            p.stop()
+
+
+def test_falls_back_without_multiplexing(echo_server_address, mock_credentials):
+    with local_tcp_bridge(echo_server_address, multiplexing=False) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False, multiplex=True)
+        p.start()
+        try:
+            for i in range(2):
+                with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                    conn.sendall(b"unmultiplexed")
+                    assert _recv_exactly(conn, 13) == b"unmultiplexed"
+            assert p.multiplexed_connector.bridge is None
+            assert bridge.connection_count == 2
+        finally:
+            p.stop()
+
+
+def test_half_close(echo_server_address, mock_credentials):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False, multiplex=True)
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.settimeout(5)
+                conn.sendall(b"last words")
+                conn.shutdown(socket.SHUT_WR)
+                received = b""
+                while bs := conn.recv(1024):
+                    received += bs
+                assert received == b"last words"
+            wait_for(lambda: not p.multiplexed_connector.bridge.stream_count)
+        finally:
+            p.stop()
+
+
+def test_slow_reader_buffers_at_most_one_window(
+    echo_server_address, mock_credentials
+):
+    window = 64 * 1024
+    message = bytes(range(256)) * 4096
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, multiplex=True, mux_window=window
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                writer = threading.Thread(
+                    target=conn.sendall, args=[message], daemon=True
+                )
+                writer.start()
+                received = bytearray()
+                while len(received) < len(message):
+                    received += conn.recv(16 * 1024)
+                    time.sleep(0.001)
+                writer.join()
+            assert received == message
+        finally:
+            p.stop()
+    (conn_metrics,) = p.metrics.snapshot()["connections"]
+    assert 0 < conn_metrics["backward"]["peak_buffered_bytes"] <= window
+
+
+def test_lost_bridge_is_replaced(
+    echo_server_address, mock_credentials, recorded_websockets
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False, multiplex=True)
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"before")
+                assert _recv_exactly(conn, 6) == b"before"
+                _, websocket_conn = recorded_websockets[0]
+                websocket_conn.socket.shutdown(socket.SHUT_RDWR)
+                assert conn.recv(1024) == b""
+            wait_for(lambda: p.metrics.snapshot()["reconnect_latency"]["count"])
+            assert p.metrics.snapshot()["connections_lost"] == 1
+            assert not p.multiplexed_connector.bridge.closed
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"after")
+                assert _recv_exactly(conn, 5) == b"after"
+            assert len(recorded_websockets) == 2
+        finally:
+            p.stop()
@@ -0,0 +1,137 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+import time
+
+from websockets.protocol import State
+
+from google.cloud.spark_connect.client.pool import BridgeConnectionPool
+
+from tests.unit.conftest import wait_for
+
+
+class FakeConnection(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.state = State.OPEN
+
+    def close(self):
+        self.state = State.CLOSED
+
+
+class FakeConnector(object):
+
+    def __init__(self):
+        self.opened = []
+        self._numbers = itertools.count()
+
+    def __call__(self):
+        conn = FakeConnection(next(self._numbers))
+        self.opened.append(conn)
+        return conn
+
+
+def test_pool_prewarms_and_counts_hits():
+    connect = FakeConnector()
+    pool = BridgeConnectionPool(connect, size=2)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["idle"] == 2)
+        first = pool.acquire()
+        assert first in connect.opened
+        assert pool.stats()["hits"] == 1
+        # The pool refills in the background after a connection is taken.
+        wait_for(lambda: pool.stats()["idle"] == 2)
+        assert len(connect.opened) == 3
+    finally:
+        pool.close()
+    assert first.state is State.OPEN
+    assert all(
+        conn.state is State.CLOSED
+        for conn in connect.opened
+        if conn is not first
+    )
+
+
+def test_pool_miss_connects_directly():
+    connect = FakeConnector()
+    pool = BridgeConnectionPool(connect, size=1)
+    conn = pool.acquire()
+    assert conn is connect.opened[0]
+    assert pool.stats() == {"hits": 0, "misses": 1, "evictions": 0, "idle": 0}
+    pool.close()
+
+
+def test_pool_evicts_closed_connections():
+    connect = FakeConnector()
+    pool = BridgeConnectionPool(connect, size=1)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["idle"] == 1)
+        connect.opened[0].close()
+        conn = pool.acquire()
+        assert conn is not connect.opened[0]
+        stats = pool.stats()
+        assert stats["misses"] == 1
+        assert stats["evictions"] == 1
+    finally:
+        pool.close()
+
+
+def test_pool_evicts_stale_connections():
+    connect = FakeConnector()
+    pool = BridgeConnectionPool(connect, size=1, max_idle=0.2)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["evictions"] >= 1)
+        assert connect.opened[0].state is State.CLOSED
+        wait_for(lambda: pool.stats()["idle"] == 1)
+    finally:
+        pool.close()
+
+
+def test_pool_replaces_dead_connections_on_refresh():
+    connect = FakeConnector()
+    pool = BridgeConnectionPool(connect, size=1, check_interval=60)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["idle"] == 1)
+        # A failed keepalive ping closes an idle connection.
+        connect.opened[0].close()
+        pool.refresh()
+        wait_for(lambda: len(connect.opened) == 2)
+        wait_for(lambda: pool.stats()["idle"] == 1)
+        assert pool.acquire() is connect.opened[1]
+    finally:
+        pool.close()
+
+
+def test_pool_retries_failed_connects():
+    connect = FakeConnector()
+    attempts = []
+
+    def flaky_connect():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise ConnectionError("bridge unavailable")
+        return connect()
+
+    pool = BridgeConnectionPool(flaky_connect, size=1)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["idle"] == 1)
+        assert len(attempts) == 2
+    finally:
+        pool.close()
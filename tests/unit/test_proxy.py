@@ -11,13 +11,30 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import socket
+import stat
 import threading
 import time
 
 import pytest
+from websockets.frames import Frame, Opcode
+from websockets.sync.messages import Assembler
 
-from google.cloud.spark_connect.client.proxy import connect_sockets
+from google.cloud.spark_connect.client import proxy
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.proxy import (
+    BufferPool,
+    bridged_socket,
+    connect_sockets,
+    connect_tcp_bridge,
+    DataprocSessionProxy,
+    forward_bytes,
+    tune_socket,
+    WriteCoalescer,
+)
+
+from tests.unit.conftest import wait_for
 
 
 @pytest.fixture
@@ -149,3 +166,549 @@ def test_proxy_with_timeouts(client_wait, proxy_server_conn, test_message):
             retry_on_timeouts(proxy_server_conn.recv, 1024).decode()
         )
     assert "\n".join(sent) == "\n".join(received)
+
+
+@pytest.mark.parametrize(
+    "client_binary,bridge_binary,expected_binary",
+    [
+        (True, True, True),
+        (True, False, False),
+        (False, True, False),
+        (False, False, False),
+    ],
+)
+def test_binary_frames_negotiation(
+    echo_server_address,
+    mock_credentials,
+    client_binary,
+    bridge_binary,
+    expected_binary,
+):
+    with local_tcp_bridge(
+        echo_server_address, binary_frames=bridge_binary
+    ) as bridge:
+        with connect_tcp_bridge(
+            bridge.host, binary_frames=client_binary, use_ssl=False
+        ) as websocket_conn:
+            backend_socket = bridged_socket(websocket_conn)
+            assert backend_socket.binary_frames == expected_binary
+            backend_socket.send(b"\x00\x01binary\xff")
+            assert backend_socket.recv(1024) == b"\x00\x01binary\xff"
+
+
+@pytest.mark.parametrize("binary_frames", [True, False])
+def test_session_proxy_through_local_bridge(
+    echo_server_address, mock_credentials, test_message, binary_frames
+):
+    with local_tcp_bridge(
+        echo_server_address, binary_frames=binary_frames
+    ) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        with socket.create_connection(("127.0.0.1", p.port)) as conn:
+            for line in test_message.split():
+                conn.sendall(line.encode())
+                assert conn.recv(1024).decode() == line
+        p.stop()
+
+
+class RecordingSocket(object):
+    """Socket-like sink that accepts at most `max_send` bytes per send."""
+
+    def __init__(self, max_send=None):
+        self.received = bytearray()
+        self.send_sizes = []
+        self.closed = False
+        self._max_send = max_send
+
+    def send(self, data):
+        self.send_sizes.append(len(data))
+        n = len(data) if self._max_send is None else self._max_send
+        self.received += data[:n]
+        return min(n, len(data))
+
+    def close(self):
+        self.closed = True
+
+
+class MessageSocket(object):
+    """Socket-like source that returns whole messages, like a websocket."""
+
+    def __init__(self, messages):
+        self._messages = list(messages)
+
+    def recv(self, buff_size):
+        return self._messages.pop(0) if self._messages else b""
+
+
+def test_buffer_pool_sizes():
+    pool = BufferPool(min_size=1024, max_size=8192)
+    assert len(pool.acquire(1)) == 1024
+    assert len(pool.acquire(1025)) == 2048
+    assert len(pool.acquire(1 << 20)) == 8192
+    with pytest.raises(ValueError):
+        BufferPool(min_size=4096, max_size=1024)
+
+
+def test_buffer_pool_reuses_released_buffers():
+    pool = BufferPool(min_size=1024, max_size=8192, max_pooled=1)
+    buf = pool.acquire(2048)
+    pool.release(buf)
+    pool.release(bytearray(2048))
+    assert pool.acquire(2048) is buf
+    assert pool.acquire(2048) is not buf
+
+
+def test_forward_bytes_slices_large_messages():
+    message = bytes(range(256)) * 1024
+    sink = RecordingSocket(max_send=1000)
+    forward_bytes(
+        "test",
+        MessageSocket([message, b"tail"]),
+        sink,
+        BufferPool(min_size=1024, max_size=4096),
+    )
+    assert sink.received == message + b"tail"
+    assert max(sink.send_sizes) <= 4096
+    assert not sink.closed
+
+
+def test_forward_bytes_grows_buffers():
+    message = bytes(range(256)) * 1024
+    reader, writer = socket.socketpair()
+    sink = RecordingSocket()
+    with reader, writer:
+        t = threading.Thread(
+            target=forward_bytes,
+            args=["test", reader, sink, BufferPool(1024, 64 * 1024)],
+        )
+        t.start()
+        writer.sendall(message)
+        writer.shutdown(socket.SHUT_WR)
+        t.join()
+    assert sink.received == message
+    assert max(sink.send_sizes) > 1024
+
+
+def test_session_proxy_uses_prewarmed_connections(
+    echo_server_address, mock_credentials
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False, pool_size=1)
+        p.start()
+        try:
+            wait_for(lambda: p.connection_pool.stats()["idle"] >= 1)
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"pooled")
+                assert conn.recv(1024) == b"pooled"
+            assert p.connection_pool.stats()["hits"] == 1
+        finally:
+            p.stop()
+
+
+@pytest.fixture
+def goodbye_server_address():
+    def say_goodbye(server_socket):
+        while True:
+            try:
+                conn, _ = server_socket.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(b"goodbye")
+
+    with socket.create_server(("127.0.0.1", 0)) as server_socket:
+        threading.Thread(
+            target=say_goodbye, args=[server_socket], daemon=True
+        ).start()
+        yield server_socket.getsockname()
+
+
+@pytest.mark.parametrize("multiplex", [False, True])
+def test_session_proxy_propagates_backend_close(
+    goodbye_server_address, mock_credentials, multiplex
+):
+    with local_tcp_bridge(goodbye_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, multiplex=multiplex
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.settimeout(5)
+                received = b""
+                while bs := conn.recv(1024):
+                    received += bs
+                assert received == b"goodbye"
+        finally:
+            p.stop()
+
+
+def test_session_proxy_delivers_replies_after_half_close(
+    echo_server_address, mock_credentials
+):
+    # Only a multiplexed stream can carry a half-close to the backend.
+    message = bytes(range(256)) * 390 + bytes(160)
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False, multiplex=True)
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.settimeout(5)
+                conn.sendall(message)
+                conn.shutdown(socket.SHUT_WR)
+                received = b""
+                while len(received) < len(message):
+                    bs = conn.recv(65536)
+                    if not bs:
+                        break
+                    received += bs
+                assert received == message
+        finally:
+            p.stop()
+
+
+def test_session_proxy_stops_promptly(mock_credentials):
+    p = DataprocSessionProxy(0, "localhost:0", use_ssl=False)
+    p.start()
+    start = time.monotonic()
+    p.stop()
+    while time.monotonic() - start < 0.5:
+        try:
+            socket.create_connection(("127.0.0.1", p.port)).close()
+        except ConnectionRefusedError:
+            return
+        time.sleep(0.01)
+    pytest.fail("The proxy kept listening after it was stopped")
+
+
+def test_write_coalescer_batches_small_writes():
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        for piece in [b"header", b"payload", b"window"]:
+            writer.sendall(piece)
+        buf = bytearray(1024)
+        n = reader.recv_into(buf, 6)
+        threading.Timer(0.05, writer.sendall, args=[b"late"]).start()
+        n = WriteCoalescer(delay=1, max_bytes=23).fill(reader, buf, n)
+        assert bytes(buf[:n]) == b"headerpayloadwindowlate"
+
+
+def test_write_coalescer_without_delay_takes_waiting_bytes():
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        writer.sendall(b"first")
+        writer.sendall(b"second")
+        buf = bytearray(1024)
+        n = reader.recv_into(buf, 5)
+        n = WriteCoalescer(delay=0).fill(reader, buf, n)
+        assert bytes(buf[:n]) == b"firstsecond"
+
+
+def test_write_coalescer_with_high_descriptors():
+    fcntl = pytest.importorskip("fcntl")
+    reader, writer = socket.socketpair()
+    try:
+        high_fd = fcntl.fcntl(reader.fileno(), fcntl.F_DUPFD, 1100)
+    except OSError:
+        pytest.skip("The descriptor limit is too low")
+    with socket.socket(fileno=high_fd) as high_reader, reader, writer:
+        writer.sendall(b"firstsecond")
+        buf = bytearray(1024)
+        n = high_reader.recv_into(buf, 5)
+        threading.Timer(0.05, writer.sendall, args=[b"late"]).start()
+        n = WriteCoalescer(delay=1, max_bytes=15).fill(high_reader, buf, n)
+        assert bytes(buf[:n]) == b"firstsecondlate"
+
+
+def test_tune_socket():
+    with socket.create_server(("127.0.0.1", 0)) as server_socket:
+        with socket.create_connection(server_socket.getsockname()) as conn:
+            tune_socket(conn, tcp_nodelay=True, buffer_size=64 * 1024)
+            assert conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            assert (
+                conn.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+                >= 64 * 1024
+            )
+
+
+def _forwarding_threads():
+    return {
+        t
+        for t in threading.enumerate()
+        if t.name.endswith(("-forward", "-backward"))
+        and not t.name.startswith("bridge-")
+    }
+
+
+@pytest.mark.parametrize("multiplex", [False, True])
+def test_session_proxy_stop_closes_open_connections(
+    echo_server_address, mock_credentials, multiplex
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, multiplex=multiplex
+        )
+        p.start()
+        existing_threads = _forwarding_threads()
+        with socket.create_connection(("127.0.0.1", p.port)) as conn:
+            conn.settimeout(5)
+            conn.sendall(b"open")
+            assert conn.recv(1024) == b"open"
+            duration = p.stop()
+            assert duration < 1
+            assert conn.recv(1024) == b""
+        assert _forwarding_threads() <= existing_threads
+
+
+def test_session_proxy_stop_drains_connections(
+    echo_server_address, mock_credentials
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(0, bridge.host, use_ssl=False)
+        p.start()
+        conn = socket.create_connection(("127.0.0.1", p.port))
+        conn.sendall(b"draining")
+        assert conn.recv(1024) == b"draining"
+        threading.Timer(0.2, conn.close).start()
+        duration = p.stop(drain_timeout=5)
+        assert 0.2 <= duration < 5
+
+
+@pytest.mark.parametrize("multiplex", [False, True])
+def test_session_proxy_frees_closed_connections(
+    echo_server_address, mock_credentials, multiplex
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0,
+            bridge.host,
+            use_ssl=False,
+            multiplex=multiplex,
+            max_connections=1,
+            accept_policy="reject",
+        )
+        p.start()
+        existing_threads = _forwarding_threads()
+        try:
+            for i in range(5):
+                # Each connection only gets the one slot if the one before
+                # it was freed.
+                with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                    msg = f"message {i}".encode()
+                    conn.sendall(msg)
+                    assert conn.recv(1024) == msg
+                wait_for(lambda: not p.metrics.snapshot()["connections_open"])
+                wait_for(lambda: _forwarding_threads() <= existing_threads)
+        finally:
+            assert p.stop(drain_timeout=5) < 1
+
+
+def test_byte_bounded_queue_relies_on_websockets_internals():
+    # The byte bound replaces the frame queue of the websockets Assembler,
+    # and relies on it measuring that queue with `qsize` to pause reading.
+    # This fails if a websockets release changes either.
+    paused = []
+    assembler = Assembler(
+        10, 5, pause=lambda: paused.append(True), resume=paused.clear
+    )
+    assembler.frames = proxy._QueuedBytes()
+    assembler.put(Frame(Opcode.BINARY, b"x" * 11))
+    assert paused
+    assert assembler.get() == b"x" * 11
+    assert not paused
+    assert assembler.frames.peak_bytes == 11
+
+
+@pytest.mark.parametrize("binary_frames", [True, False])
+def test_bridged_socket_bounds_queued_bytes(
+    echo_server_address, mock_credentials, binary_frames
+):
+    # Random bytes do not compress, so each network read holds few frames.
+    message = os.urandom(1 << 20)
+    high, low = 128 << 10, 32 << 10
+    with local_tcp_bridge(
+        echo_server_address, binary_frames=binary_frames
+    ) as bridge:
+        with connect_tcp_bridge(
+            bridge.host,
+            binary_frames=binary_frames,
+            use_ssl=False,
+            queue_watermarks=(high, low),
+        ) as websocket_conn:
+            backend_socket = bridged_socket(websocket_conn)
+
+            def send():
+                for i in range(0, len(message), 64 << 10):
+                    backend_socket.send(message[i : i + (64 << 10)])
+
+            sender = threading.Thread(target=send, daemon=True)
+            sender.start()
+            # Nothing is read until the replies fill the receive queue.
+            wait_for(lambda: backend_socket.peak_buffered_bytes > high)
+            received = bytearray()
+            while len(received) < len(message):
+                received += backend_socket.recv(65536)
+            sender.join()
+    assert received == message
+    # Reading pauses once a frame takes the queue above `high`, so it only
+    # overshoots by about a frame, which is twice as large when hex-encoded.
+    assert backend_socket.peak_buffered_bytes <= high + (256 << 10)
+
+
+def test_session_proxy_bounds_the_websocket_queue(
+    echo_server_address, mock_credentials, recorded_websockets
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0,
+            bridge.host,
+            use_ssl=False,
+            backward_watermarks=(1 << 20, 256 << 10),
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"bounded")
+                assert conn.recv(1024) == b"bounded"
+        finally:
+            p.stop()
+    options, _ = recorded_websockets[0]
+    assert options["max_queue"] == (1 << 20, 256 << 10)
+
+
+def test_session_proxy_on_unix_socket(
+    echo_server_address, mock_credentials, tmp_path
+):
+    path = str(tmp_path / "proxy.sock")
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, unix_socket_path=path
+        )
+        p.start()
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+            with socket.socket(socket.AF_UNIX) as conn:
+                conn.connect(path)
+                conn.sendall(b"local only")
+                assert conn.recv(1024) == b"local only"
+        finally:
+            p.stop()
+    assert not os.path.exists(path)
+
+
+def test_session_proxy_replaces_lost_websockets(
+    echo_server_address, mock_credentials, recorded_websockets
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, ping_interval=1, ping_timeout=1
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"before")
+                assert conn.recv(1024) == b"before"
+                options, websocket_conn = recorded_websockets[0]
+                assert options["ping_interval"] == 1
+                # Drop the websocket without a closing handshake.
+                websocket_conn.socket.shutdown(socket.SHUT_RDWR)
+                assert conn.recv(1024) == b""
+            wait_for(lambda: p.metrics.snapshot()["reconnect_latency"]["count"])
+            assert p.metrics.snapshot()["connections_lost"] == 1
+            assert len(recorded_websockets) == 2
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"after")
+                assert conn.recv(1024) == b"after"
+            # The replacement was opened ahead of time and used.
+            assert len(recorded_websockets) == 2
+        finally:
+            p.stop()
+
+
+def test_session_proxy_rejects_connections_over_the_limit(
+    echo_server_address, mock_credentials
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0,
+            bridge.host,
+            use_ssl=False,
+            max_connections=2,
+            accept_policy="reject",
+        )
+        p.start()
+        try:
+            conns = [
+                socket.create_connection(("127.0.0.1", p.port))
+                for _ in range(2)
+            ]
+            for conn in conns:
+                conn.sendall(b"admitted")
+                assert conn.recv(1024) == b"admitted"
+            with socket.create_connection(("127.0.0.1", p.port)) as rejected:
+                assert rejected.recv(1024) == b""
+            for conn in conns:
+                conn.close()
+            wait_for(lambda: not p.metrics.snapshot()["connections_open"])
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"admitted again")
+                assert conn.recv(1024) == b"admitted again"
+            snapshot = p.metrics.snapshot()
+            assert snapshot["connections_rejected"] == 1
+            assert snapshot["connections_peak"] == 2
+        finally:
+            p.stop()
+
+
+def test_session_proxy_queues_connections_over_the_limit(
+    echo_server_address, mock_credentials
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, max_connections=1
+        )
+        p.start()
+        try:
+            first = socket.create_connection(("127.0.0.1", p.port))
+            first.sendall(b"first")
+            assert first.recv(1024) == b"first"
+            with socket.create_connection(("127.0.0.1", p.port)) as queued:
+                queued.sendall(b"queued")
+                queued.settimeout(0.2)
+                with pytest.raises(TimeoutError):
+                    queued.recv(1024)
+                first.close()
+                queued.settimeout(5)
+                assert queued.recv(1024) == b"queued"
+            snapshot = p.metrics.snapshot()
+            assert snapshot["connections_rejected"] == 0
+            assert snapshot["connections_peak"] == 1
+        finally:
+            p.stop()
+
+
+def test_session_proxy_closes_idle_connections(
+    echo_server_address, mock_credentials
+):
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, idle_timeout=0.2
+        )
+        p.start()
+        try:
+            with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                conn.sendall(b"active")
+                assert conn.recv(1024) == b"active"
+                conn.settimeout(5)
+                assert conn.recv(1024) == b""
+            assert p.metrics.snapshot()["connections_idle_closed"] == 1
+        finally:
+            p.stop()
+
+
+def test_session_proxy_admission_options():
+    with pytest.raises(ValueError):
+        DataprocSessionProxy(0, "localhost", max_connections=0)
+    with pytest.raises(ValueError):
+        DataprocSessionProxy(0, "localhost", accept_policy="drop")
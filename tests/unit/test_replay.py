@@ -0,0 +1,113 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import socket
+import stat
+
+import pytest
+
+from google.cloud.spark_connect.client.bridge import local_tcp_bridge
+from google.cloud.spark_connect.client.capture import (
+    CaptureWriter,
+    read_capture,
+)
+from google.cloud.spark_connect.client.core import _local_channel
+from google.cloud.spark_connect.client.proxy import DataprocSessionProxy
+from google.cloud.spark_connect.client.replay import (
+    load_connections,
+    replay_session,
+)
+
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / "session.cap")
+    with CaptureWriter(path) as capture:
+        capture.write(1, "forward", b"request")
+        capture.recorder(1, "backward")(b"reply")
+        capture.write(2, "forward", b"")
+    records = list(read_capture(path))
+    assert [(r.connection, r.direction, r.data) for r in records] == [
+        (1, "forward", b"request"),
+        (1, "backward", b"reply"),
+        (2, "forward", b""),
+    ]
+    assert records[0].timestamp <= records[1].timestamp
+
+    with open(path, "ab") as f:
+        f.write(b"\0\0")
+    with pytest.raises(ValueError):
+        list(read_capture(path))
+
+
+def test_capture_file_is_private(tmp_path):
+    path = tmp_path / "session.cap"
+    path.write_bytes(b"stale")
+    os.chmod(path, 0o644)
+    with CaptureWriter(str(path)):
+        pass
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert list(read_capture(str(path))) == []
+
+
+def test_replay_serves_captured_replies(
+    echo_server_address, mock_credentials, tmp_path
+):
+    path = str(tmp_path / "echo.cap")
+    with local_tcp_bridge(echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, capture_path=path
+        )
+        p.start()
+        try:
+            for message in [b"first", b"second"]:
+                with socket.create_connection(("127.0.0.1", p.port)) as conn:
+                    conn.sendall(message)
+                    assert conn.recv(1024) == message
+        finally:
+            p.stop()
+    connections = load_connections(path)
+    # The end of each direction is captured too.
+    assert [r.data for r in connections[0] if r.direction == "backward"] == [
+        b"first",
+        b"",
+    ]
+
+    # The echo server is not running behind the replay.
+    with replay_session(path) as replayed:
+        for message in [b"first", b"second"]:
+            with socket.create_connection(("127.0.0.1", replayed.port)) as conn:
+                conn.sendall(message)
+                assert conn.recv(1024) == message
+
+
+def test_replay_serves_captured_grpc_calls(
+    grpc_echo_server_address, mock_credentials, tmp_path
+):
+    path = str(tmp_path / "grpc.cap")
+    with local_tcp_bridge(grpc_echo_server_address) as bridge:
+        p = DataprocSessionProxy(
+            0, bridge.host, use_ssl=False, capture_path=path
+        )
+        p.start()
+        try:
+            with _local_channel(None, p.port) as channel:
+                echo = channel.unary_unary("/test.Echo/Echo")
+                assert echo(b"captured", timeout=10) == b"captured"
+        finally:
+            p.stop()
+
+    with replay_session(path) as replayed:
+        with _local_channel(None, replayed.port) as channel:
+            echo = channel.unary_unary("/test.Echo/Echo")
+            assert echo(b"captured", timeout=10) == b"captured"
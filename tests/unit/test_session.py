@@ -487,6 +487,38 @@ class DataprocRemoteSparkSessionBuilderTests(unittest.TestCase):
             ):
                 GoogleSparkSession.builder.getOrCreate()
 
+    def test_channel_options(self):
+        builder = (
+            GoogleSparkSession.builder.maxMessageSize(1024)
+            .keepAlive(30, timeout=5)
+            .flowControlWindow(8 * 1024 * 1024)
+            .grpcCompression("gzip")
+            .channelOption("grpc.http2.bdp_probe", 0)
+        )
+        self.assertEqual(
+            dict(builder._channel_options),
+            {
+                "grpc.max_send_message_length": 1024,
+                "grpc.max_receive_message_length": 1024,
+                "grpc.keepalive_time_ms": 30000,
+                "grpc.keepalive_timeout_ms": 5000,
+                "grpc.http2.lookahead_bytes": 8 * 1024 * 1024,
+                "grpc.default_compression_algorithm": 2,
+                "grpc.http2.bdp_probe": 0,
+            },
+        )
+        with self.assertRaises(ValueError):
+            builder.grpcCompression("brotli")
+
+    def test_channel_pool(self):
+        builder = GoogleSparkSession.builder.channelPool(4, "round_robin")
+        self.assertEqual(builder._pool_size, 4)
+        self.assertEqual(builder._pool_policy, "round_robin")
+        with self.assertRaises(ValueError):
+            builder.channelPool(0)
+        with self.assertRaises(ValueError):
+            builder.channelPool(2, "random")
+
     def test_create_spark_session_unsupported_dataproc_config_version(self):
         with self.assertRaises(ValueError) as e:
             with mock.patch.dict(